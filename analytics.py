@@ -0,0 +1,327 @@
+import array
+import collections
+import sys
+import time
+
+import dns_header
+import edns
+import resource_record
+
+# Heavy hitters of the query stream, the names and clients behind most
+# of the traffic, counted in fixed memory without logging queries.
+
+# A count-min sketch estimates how often any key was seen: depth rows of
+# width counters, every key adds one to a counter in each row and its
+# estimate is the smallest of them. Collisions only ever add, so the
+# estimate is never below the real count and, with width w, is above it
+# by more than 2/w of the traffic with probability at most 1/2^depth.
+
+# https://dsf.berkeley.edu/cs286/papers/countmin-latin2005.pdf
+
+# HeavyHitters keeps the k keys with the largest estimates next to the
+# sketch. A key outside them replaces the smallest once its estimate
+# passes it, so the top list costs k entries whatever the number of names.
+
+# Counts start over every window, the last complete window is kept for
+# reporting. Query types are few and counted exactly.
+
+# Signed zones deny names with NOERROR and an NSEC whose bitmap holds
+# NXNAME (compact denial, see dnssec.py), response_rcode counts those as
+# NXDOMAIN so hot spots of missing names show in signed zones too.
+
+NXDOMAIN = dns_header.Rcode.NAME_ERROR.value
+
+# NXNAME in window 0 of an NSEC type bit map, RFC 4034 section 4.1.2
+NXNAME_OCTET = resource_record.RrType.NXNAME.value >> 3
+NXNAME_BIT = 0b10000000 >> (resource_record.RrType.NXNAME.value & 0b111)
+
+
+def response_rcode(response: bytes) -> int:
+    """RCODE of a response, NXDOMAIN for a compact denial of the name
+    """
+
+    rcode = response[3] & 0x0F
+
+    # Only NOERROR without answers but with authority records can be a denial
+
+    if rcode != 0 or response[6:8] != b"\0\0" or response[8:10] == b"\0\0":
+        return rcode
+
+    offset = 12
+
+    for _ in range(int.from_bytes(response[4:6], "big")):
+        offset = edns.skip_name(response, offset) + 4
+
+    for _ in range(int.from_bytes(response[8:10], "big")):
+        offset = edns.skip_name(response, offset)
+        rr_type = int.from_bytes(response[offset:offset+2], "big")
+        rdata_length = int.from_bytes(response[offset+8:offset+10], "big")
+        offset += 10
+
+        if rr_type == resource_record.RrType.NSEC.value:
+            bitmap = edns.skip_name(response, offset)
+
+            # Windows are in ascending order, window 0 comes first if there is one
+
+            if bitmap + 2 < offset + rdata_length and response[bitmap] == 0 and \
+                    response[bitmap+1] > NXNAME_OCTET and response[bitmap+2+NXNAME_OCTET] & NXNAME_BIT:
+                return NXDOMAIN
+
+        offset += rdata_length
+
+    return rcode
+
+
+def _type_name(qtype: int) -> str:
+    try:
+        return resource_record.RrType(qtype).name
+    except ValueError:
+        return "TYPE{}".format(qtype)
+
+
+class CountMinSketch:
+    def __init__(self, width: int = 2048, depth: int = 4):
+        self._width = width
+        self._depth = depth
+        self._counters = array.array("Q", bytes(8 * width * depth))
+
+        # Offset of every row in _counters
+        self._bases = tuple(row * width for row in range(depth))
+
+    @property
+    def nbytes(self) -> int:
+        return self._counters.itemsize * len(self._counters)
+
+    def _indexes(self, key) -> 'list[int]':
+
+        # Rows are told apart by double hashing one 64 bit hash, h1 + row * h2
+
+        digest = hash(key) & 0xFFFFFFFFFFFFFFFF
+        h1 = digest & 0xFFFFFFFF
+        h2 = (digest >> 32) | 1
+
+        return [base + (h1 + row * h2) % self._width for row, base in enumerate(self._bases)]
+
+    def add(self, key, count: int = 1) -> int:
+        """Count key, returns its new estimate
+        """
+
+        # _indexes inlined, this runs for every query
+
+        digest = hash(key) & 0xFFFFFFFFFFFFFFFF
+        h = digest & 0xFFFFFFFF
+        h2 = (digest >> 32) | 1
+        width = self._width
+        counters = self._counters
+        estimate = 1 << 64
+
+        for base in self._bases:
+            index = base + h % width
+            value = counters[index] + count
+            counters[index] = value
+
+            if value < estimate:
+                estimate = value
+
+            h += h2
+
+        return estimate
+
+    def estimate(self, key) -> int:
+        return min(self._counters[index] for index in self._indexes(key))
+
+    def clear(self) -> None:
+        self._counters = array.array("Q", bytes(8 * self._width * self._depth))
+
+
+class HeavyHitters:
+    def __init__(self, k: int = 20, width: int = 2048, depth: int = 4):
+        """Args:
+            k (int): Keys kept in the top list
+            width (int): Counters per sketch row
+            depth (int): Sketch rows
+        """
+
+        self._k = k
+        self._sketch = CountMinSketch(width, depth)
+
+        # key -> estimate, for the k largest
+        self._top: 'dict[object, int]' = {}
+
+        # Estimate of the smallest key in _top when it was last looked for,
+        # estimates only grow so the real smallest is never below it
+        self._floor = 0
+
+        self.total = 0
+
+    def add(self, key) -> None:
+        self.total += 1
+
+        estimate = self._sketch.add(key)
+        top = self._top
+
+        if key in top or len(top) < self._k:
+            top[key] = estimate
+            return
+
+        if estimate <= self._floor:
+            return
+
+        smallest = min(top, key=top.get)
+
+        if estimate > top[smallest]:
+            del top[smallest]
+            top[key] = estimate
+            smallest = min(top, key=top.get)
+
+        self._floor = top[smallest]
+
+    def top(self, n: int = None) -> 'list[tuple[object, int]]':
+        return sorted(self._top.items(), key=lambda item: item[1], reverse=True)[:n]
+
+    def clear(self) -> None:
+        self._sketch.clear()
+        self._top = {}
+        self._floor = 0
+        self.total = 0
+
+
+class TrafficAnalytics:
+    def __init__(self, window: float = 60.0, k: int = 20, width: int = 2048, depth: int = 4, sample: int = 1):
+        """Args:
+            window (float): Seconds counted before the counts start over
+            k (int): Entries kept in every top list
+            width (int): Counters per sketch row
+            depth (int): Sketch rows
+            sample (int): Count one query out of every sample, counts are scaled back up
+        """
+
+        self._window = window
+        self._sample = sample
+        self._countdown = sample
+
+        self.names = HeavyHitters(k, width, depth)
+        self.clients = HeavyHitters(k, width, depth)
+        self.nxdomain = HeavyHitters(k, width, depth)
+        self.qtypes: 'collections.Counter[int]' = collections.Counter()
+
+        self._window_start = time.monotonic()
+
+        # Top lists of the last complete window
+        self.previous: dict = None
+
+    def record(self, name: str, client: str, qtype: int, rcode: int) -> None:
+        now = time.monotonic()
+
+        if now - self._window_start >= self._window:
+            self.rotate(now)
+
+        self._countdown -= 1
+
+        if self._countdown > 0:
+            return
+
+        self._countdown = self._sample
+
+        name = name.lower()
+
+        self.names.add(name)
+        self.clients.add(client)
+        self.qtypes[qtype] += 1
+
+        if rcode == NXDOMAIN:
+            self.nxdomain.add(name)
+
+    def snapshot(self, now: float = None) -> dict:
+        """Top lists of the current window, counts scaled by the sample rate
+        """
+
+        now = time.monotonic() if now is None else now
+        scale = self._sample
+
+        return {
+            "seconds": now - self._window_start,
+            "queries": self.names.total * scale,
+            "names": [(name, count * scale) for name, count in self.names.top()],
+            "clients": [(client, count * scale) for client, count in self.clients.top()],
+            "nxdomain": [(name, count * scale) for name, count in self.nxdomain.top()],
+            "qtypes": [(_type_name(qtype), count * scale) for qtype, count in self.qtypes.most_common()],
+        }
+
+    def rotate(self, now: float = None) -> None:
+        now = time.monotonic() if now is None else now
+
+        self.previous = self.snapshot(now)
+
+        self.names.clear()
+        self.clients.clear()
+        self.nxdomain.clear()
+        self.qtypes = collections.Counter()
+
+        self._window_start = now
+
+    def report(self, kind: str, n: int = 10) -> str:
+        """Text table of one top list for the current and last complete window.
+
+        Args:
+            kind (str): names, clients, qtypes or nxdomain
+            n (int): Rows per window
+        """
+
+        if kind not in ("names", "clients", "qtypes", "nxdomain"):
+            raise ValueError("top takes names, clients, qtypes or nxdomain")
+
+        lines = []
+
+        for label, window in (("current", self.snapshot()), ("previous", self.previous)):
+            if window is None:
+                continue
+
+            lines.append("{} window, {:.0f}s, {} queries".format(label, window["seconds"], window["queries"]))
+
+            for key, count in window[kind][:n]:
+                share = 100 * count / window["queries"] if window["queries"] else 0
+                lines.append("  {:>10} {:5.1f}%  {}".format(count, share, key))
+
+        return "\n".join(lines)
+
+
+if __name__ == "__main__":
+
+    # Cost per query and accuracy of the top names against exact counts,
+    # for a skewed stream of questions.
+    # Usage: python analytics.py [NAMES] [QUERIES] [K]
+
+    import random
+
+    name_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    query_count = int(sys.argv[2]) if len(sys.argv) > 2 else 500000
+    k = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+
+    rng = random.Random(1)
+    stream = [
+        ("host{}.ricklantis.com".format(int(rng.paretovariate(0.8)) % name_count), "10.0.{}.{}".format(rng.randrange(4), rng.randrange(256)))
+        for _ in range(query_count)
+    ]
+
+    traffic = TrafficAnalytics(window=3600, k=k)
+
+    start = time.perf_counter()
+
+    for name, client in stream:
+        traffic.record(name, client, 1, 0)
+
+    elapsed = time.perf_counter() - start
+
+    exact = collections.Counter(name for name, _ in stream)
+    true_top = {name for name, _ in exact.most_common(k)}
+    found = traffic.names.top()
+
+    print("{:.2f} us per query, sketches {} KB".format(
+        elapsed / query_count * 1e6, 3 * traffic.names._sketch.nbytes // 1024))
+    print("top {} names found {} of {}, largest overestimate {}".format(
+        k,
+        len(true_top & {name for name, _ in found}),
+        k,
+        max(count - exact[name] for name, count in found)
+    ))
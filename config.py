@@ -0,0 +1,545 @@
+import argparse
+import dataclasses
+import ipaddress
+import socket
+import tomllib
+
+import listeners
+import policy
+import resource_record
+
+# Server configuration. Settings come from the defaults below, then a TOML
+# (or YAML, when PyYAML is installed) file, then command line overrides.
+# Everything is validated once at startup and frozen, the packet loop only
+# ever reads plain attributes.
+
+# workers = 2
+# zone_files = ["zones/ricklantis.zone"]
+#
+# [[listen]]
+# address = "::"
+# port = 53
+# v6only = false
+#
+# [[blocklist]]
+# path = "lists/ads.txt"
+# action = "nxdomain"
+#
+# [[view]]
+# name = "office"
+# zone_files = ["zones/office.zone"]
+# prefixes = ["10.0.0.0/8", "2001:db8::/32"]
+#
+# [[health_check]]
+# name = "www.ricklantis.com"
+# type = "A"
+# kind = "http"
+# port = 80
+
+
+class ConfigError(ValueError):
+    pass
+
+
+@dataclasses.dataclass(frozen=True)
+class ListenerConfig:
+    address: str = "0.0.0.0"
+    port: int = 53
+    v6only: bool = True
+    tcp: bool = True  # also accept queries and zone transfers over TCP
+
+
+@dataclasses.dataclass(frozen=True)
+class BlocklistConfig:
+    path: str = ""
+    action: str = "nxdomain"  # nxdomain, nodata or fixed_answer
+    answer: str = ""  # address for fixed_answer
+    compiled: bool = False  # path was written by python policy.py compile and is mmap'd
+
+
+@dataclasses.dataclass(frozen=True)
+class ViewConfig:
+    name: str = ""
+    zone_files: 'tuple[str, ...]' = ()
+    prefixes: 'tuple[str, ...]' = ()
+
+
+@dataclasses.dataclass(frozen=True)
+class HealthCheckConfig:
+    name: str = ""
+    type: str = "A"
+    kind: str = "tcp"  # tcp or http
+    port: int = 80
+    path: str = "/"
+    timeout: float = 1.0
+
+
+@dataclasses.dataclass(frozen=True)
+class ServerConfig:
+    listen: 'tuple[ListenerConfig, ...]' = (
+        ListenerConfig("0.0.0.0", 53),
+        ListenerConfig("::", 53),
+    )
+
+    # Worker processes sharing the listening sockets
+    workers: int = 1
+
+    # Load zones and fill caches once in the parent before forking the
+    # workers, which then share that memory. Off, every worker loads its own
+    prefork_warmup: bool = True
+
+    # Largest datagram read from a socket, longer ones are cut to it. EDNS
+    # queries and UPDATE messages can be up to 65535 octets, and reading
+    # with a smaller buffer costs no less
+    recv_buffer_size: int = 65535
+
+    # SO_RCVBUF / SO_SNDBUF, 0 keeps the kernel default
+    socket_rcvbuf: int = 4 * 1024 * 1024
+    socket_sndbuf: int = 1024 * 1024
+
+    # Responses kept per view in the response template cache
+    response_cache_entries: int = 100000
+
+    # Leave the additional section out of NS, MX and SRV answers instead of
+    # adding the addresses the zones hold for their targets
+    minimal_responses: bool = False
+
+    # Largest UDP response sent, whatever size a client offers over EDNS.
+    # Larger answers drop their additional records, then are sent truncated
+    edns_udp_size: int = 1232
+
+    # Answer cached plain queries a whole socket drain at a time, skipping
+    # the per query parse, see batch.py
+    # Off when views, tracing, analytics, rate limits or log_every need
+    # every query parsed
+    batch_parse: bool = False
+
+    # Slots of a response cache shared by every worker, one per view, 0
+    # keeps a cache in each worker. Responses larger than a slot are not
+    # shared, entries expire after shared_cache_ttl seconds
+    shared_cache_slots: int = 0
+    shared_cache_slot_size: int = 512
+    shared_cache_ttl: int = 60
+
+    zone_files: 'tuple[str, ...]' = ()
+
+    # Names outside this suffix get a name error
+    zone_suffix: str = "ricklantis.com"
+
+    # A record returned for names in zone_suffix that no zone file defines
+    default_answer: str = "147.182.185.61"
+    default_ttl: int = 10
+
+    # Print the decoded query and raw response for one query out of every
+    # log_every, 0 turns query logging off
+    log_every: int = 1
+
+    # Print every label generated while encoding names
+    debug_labels: bool = True
+
+    health_check_interval: float = 5.0
+
+    # Clients allowed to run AXFR and IXFR
+    transfer_allow: 'tuple[str, ...]' = ("127.0.0.1/32", "::1/128")
+
+    # Open TCP connections per worker, and seconds one may stay idle
+    tcp_max_connections: int = 256
+    tcp_idle_timeout: float = 10.0
+
+    # DNS over TLS and DNS over HTTPS/1.1 endpoints, see tls_server.py.
+    # Ex: ["0.0.0.0:853"], ["[::]:443"]. Both need the PEM certificate
+    # chain and key
+    dot_listen: 'tuple[str, ...]' = ()
+    doh_listen: 'tuple[str, ...]' = ()
+    doh_path: str = "/dns-query"
+    tls_certificate: str = ""
+    tls_private_key: str = ""
+
+    # Open DoT and DoH connections per worker, seconds one may stay idle,
+    # and TLS 1.3 session tickets handed out per full handshake
+    tls_max_connections: int = 256
+    tls_idle_timeout: float = 30.0
+    tls_session_tickets: int = 2
+
+    # Clients allowed to send dynamic updates, none by default
+    update_allow: 'tuple[str, ...]' = ()
+
+    # Directory holding one <view>.journal file per view, updates are only
+    # kept in memory without one
+    journal_dir: str = ""
+
+    # Most seconds between a journal write and its fsync
+    journal_fsync_interval: float = 0.05
+
+    # Directory of <zone>.pem signing keys, made with python dnssec.py,
+    # zones without a key are served unsigned
+    dnssec_key_dir: str = ""
+
+    # Seconds signatures stay valid, and between refreshes of every signature
+    dnssec_signature_validity: int = 14 * 86400
+    dnssec_refresh_interval: int = 86400
+
+    # Processes signing zones at startup, 0 starts one per CPU
+    dnssec_presign_processes: int = 0
+
+    # Unix socket the running server hands its listening sockets over on,
+    # see upgrade.py. A server started with --upgrade (upgrade = true)
+    # takes them from there. The old one then stops reading and gives
+    # open TCP and TLS connections drain_seconds to finish, as on SIGTERM
+    upgrade_socket: str = ""
+    upgrade: bool = False
+    drain_seconds: float = 5.0
+
+    # Unix socket taking commands like profile and trace, see control.py.
+    # Every worker binds <control_socket>.<worker> when there are several
+    control_socket: str = ""
+
+    # SIGUSR1, or the profile command, samples a worker's stacks for
+    # profile_seconds and writes a .folded flame graph file to profile_dir,
+    # the temporary directory when empty. The parent passes it on to every worker
+    profile_dir: str = ""
+    profile_seconds: float = 10.0
+    profile_interval: float = 0.005
+
+    # Time every stage of the query path from startup, see profiler.StageTracer
+    trace_stages: bool = False
+
+    # Seconds per window of heavy hitter counts, top names, clients, query
+    # types and NXDOMAIN names shown by the control socket's top command.
+    # 0 turns them off. Every analytics_sample-th query is counted
+    analytics_window: int = 0
+    analytics_top: int = 20
+    analytics_sketch_width: int = 2048
+    analytics_sample: int = 1
+
+    # Answer DNS Cookies, RFC 7873. Servers given the same cookie_secret,
+    # 32 hex digits, accept each other's cookies, a random secret is made
+    # at startup when empty. The key derived from it changes every
+    # cookie_rotation seconds
+    dns_cookies: bool = False
+    cookie_secret: str = ""
+    cookie_rotation: int = 86400
+
+    # Response rate limiting of UDP answers per client network, 0 turns it
+    # off, see rrl.py. Every rrl_slip-th limited response is sent truncated
+    # instead of dropped. Clients returning a valid server cookie are not
+    # limited with rrl_exempt_cookies
+    rrl_responses_per_second: float = 0.0
+    rrl_window: float = 15.0
+    rrl_slip: int = 2
+    rrl_table_size: int = 65536
+    rrl_ipv4_prefix: int = 24
+    rrl_ipv6_prefix: int = 56
+    rrl_exempt_cookies: bool = True
+
+    blocklist: 'tuple[BlocklistConfig, ...]' = ()
+    view: 'tuple[ViewConfig, ...]' = ()
+    health_check: 'tuple[HealthCheckConfig, ...]' = ()
+
+
+# Tables of a config file that hold a list of nested sections
+NESTED_SECTIONS = {
+    "listen": ListenerConfig,
+    "blocklist": BlocklistConfig,
+    "view": ViewConfig,
+    "health_check": HealthCheckConfig,
+}
+
+
+def _field_defaults(cls) -> 'dict[str, object]':
+    return {field.name: field.default for field in dataclasses.fields(cls)}
+
+
+def _build(cls, values: dict, where: str):
+    if not isinstance(values, dict):
+        raise ConfigError("{} must be a table".format(where))
+
+    defaults = _field_defaults(cls)
+    arguments = {}
+
+    for key, value in values.items():
+        if key not in defaults:
+            raise ConfigError("Unknown setting {}.{}".format(where, key) if where else "Unknown setting {}".format(key))
+
+        name = "{}.{}".format(where, key) if where else key
+        default = defaults[key]
+
+        if key in NESTED_SECTIONS and cls is ServerConfig:
+            if not isinstance(value, list):
+                raise ConfigError("{} must be a list of tables".format(name))
+            value = tuple(
+                _build(NESTED_SECTIONS[key], item, "{}[{}]".format(name, index))
+                for index, item in enumerate(value)
+            )
+
+        elif isinstance(default, tuple):
+            if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+                raise ConfigError("{} must be a list of strings".format(name))
+            value = tuple(value)
+
+        elif isinstance(default, bool):
+            if not isinstance(value, bool):
+                raise ConfigError("{} must be true or false".format(name))
+
+        elif isinstance(default, float):
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ConfigError("{} must be a number".format(name))
+            value = float(value)
+
+        elif not isinstance(value, type(default)) or isinstance(value, bool) != isinstance(default, bool):
+            raise ConfigError("{} must be of type {}".format(name, type(default).__name__))
+
+        arguments[key] = value
+
+    return cls(**arguments)
+
+
+def validate(server_config: 'ServerConfig') -> 'ServerConfig':
+    if not server_config.listen:
+        raise ConfigError("At least one listen address is required")
+
+    for listener in server_config.listen:
+        if not 0 <= listener.port <= 65535:
+            raise ConfigError("Invalid port {}".format(listener.port))
+
+    if server_config.workers < 1:
+        raise ConfigError("workers must be at least 1")
+
+    if not 512 <= server_config.recv_buffer_size <= 65535:
+        raise ConfigError("recv_buffer_size must be between 512 and 65535")
+
+    if server_config.socket_rcvbuf < 0 or server_config.socket_sndbuf < 0:
+        raise ConfigError("Socket buffer sizes can not be negative")
+
+    if not 512 <= server_config.edns_udp_size <= 65535:
+        raise ConfigError("edns_udp_size must be between 512 and 65535")
+
+    if server_config.recv_buffer_size < server_config.edns_udp_size:
+        raise ConfigError("recv_buffer_size can not be smaller than edns_udp_size")
+
+    if server_config.response_cache_entries < 0:
+        raise ConfigError("response_cache_entries can not be negative")
+
+    if server_config.shared_cache_slots < 0:
+        raise ConfigError("shared_cache_slots can not be negative")
+
+    if server_config.shared_cache_slots:
+        if not 128 <= server_config.shared_cache_slot_size <= 65536:
+            raise ConfigError("shared_cache_slot_size must be between 128 and 65536")
+
+        if server_config.shared_cache_ttl < 1:
+            raise ConfigError("shared_cache_ttl must be at least 1")
+
+        # The cache has to exist before the workers are forked to be shared
+
+        if server_config.workers > 1 and not server_config.prefork_warmup:
+            raise ConfigError("shared_cache_slots needs prefork_warmup")
+
+    try:
+        socket.inet_aton(server_config.default_answer)
+    except OSError:
+        raise ConfigError("default_answer must be an IPv4 address")
+
+    if not 0 <= server_config.default_ttl <= 0x7FFFFFFF:
+        raise ConfigError("default_ttl must fit in 31 bits")
+
+    if server_config.log_every < 0:
+        raise ConfigError("log_every can not be negative")
+
+    if server_config.health_check_interval <= 0:
+        raise ConfigError("health_check_interval must be positive")
+
+    for blocklist in server_config.blocklist:
+        if blocklist.action.upper() not in policy.PolicyAction.__members__:
+            raise ConfigError("Unknown blocklist action {}".format(blocklist.action))
+
+        if blocklist.action.upper() == "FIXED_ANSWER" and not blocklist.answer:
+            raise ConfigError("fixed_answer blocklist {} needs an answer".format(blocklist.path))
+
+    for prefix in server_config.transfer_allow:
+        try:
+            ipaddress.ip_network(prefix, strict=False)
+        except ValueError:
+            raise ConfigError("Invalid transfer_allow prefix {}".format(prefix))
+
+    for prefix in server_config.update_allow:
+        try:
+            ipaddress.ip_network(prefix, strict=False)
+        except ValueError:
+            raise ConfigError("Invalid update_allow prefix {}".format(prefix))
+
+    # Every worker holds its own copy of the zones, an update would only
+    # reach the worker that happened to read it
+
+    if server_config.update_allow and server_config.workers > 1:
+        raise ConfigError("update_allow needs workers = 1")
+
+    # Without prefork_warmup every worker would replay and compact the same
+    # journal file on its own
+
+    if server_config.journal_dir and server_config.workers > 1 and not server_config.prefork_warmup:
+        raise ConfigError("journal_dir with several workers needs prefork_warmup")
+
+    if server_config.journal_fsync_interval <= 0:
+        raise ConfigError("journal_fsync_interval must be positive")
+
+    if server_config.dnssec_refresh_interval < 1 or \
+            server_config.dnssec_signature_validity <= server_config.dnssec_refresh_interval:
+        raise ConfigError("dnssec_signature_validity must be longer than a positive dnssec_refresh_interval")
+
+    if server_config.dnssec_presign_processes < 0:
+        raise ConfigError("dnssec_presign_processes can not be negative")
+
+    if server_config.upgrade and not server_config.upgrade_socket:
+        raise ConfigError("upgrade needs the upgrade_socket of the running server")
+
+    if server_config.drain_seconds < 0:
+        raise ConfigError("drain_seconds can not be negative")
+
+    if server_config.profile_seconds <= 0 or server_config.profile_interval <= 0:
+        raise ConfigError("profile_seconds and profile_interval must be positive")
+
+    if server_config.analytics_window < 0:
+        raise ConfigError("analytics_window can not be negative")
+
+    if server_config.analytics_top < 1 or server_config.analytics_sketch_width < 64 or server_config.analytics_sample < 1:
+        raise ConfigError("analytics_top and analytics_sample must be at least 1, analytics_sketch_width at least 64")
+
+    if server_config.cookie_secret:
+        try:
+            if len(bytes.fromhex(server_config.cookie_secret)) != 16:
+                raise ValueError
+        except ValueError:
+            raise ConfigError("cookie_secret must be 32 hex digits")
+
+    # Workers loading on their own would each make up a different secret
+
+    if server_config.dns_cookies and not server_config.cookie_secret and \
+            server_config.workers > 1 and not server_config.prefork_warmup:
+        raise ConfigError("dns_cookies with several workers needs prefork_warmup or a cookie_secret")
+
+    if server_config.cookie_rotation < 3600:
+        raise ConfigError("cookie_rotation must be at least 3600, the age a cookie is accepted for")
+
+    if server_config.rrl_responses_per_second < 0 or server_config.rrl_window <= 0 or server_config.rrl_slip < 0:
+        raise ConfigError("rrl_responses_per_second and rrl_slip can not be negative, rrl_window must be positive")
+
+    if server_config.rrl_table_size < 1 or not 0 <= server_config.rrl_ipv4_prefix <= 32 or \
+            not 0 <= server_config.rrl_ipv6_prefix <= 128:
+        raise ConfigError("rrl_table_size must be positive and rrl prefixes fit their family")
+
+    if server_config.tcp_max_connections < 1:
+        raise ConfigError("tcp_max_connections must be at least 1")
+
+    if server_config.tcp_idle_timeout <= 0:
+        raise ConfigError("tcp_idle_timeout must be positive")
+
+    for endpoint in server_config.dot_listen + server_config.doh_listen:
+        try:
+            listeners.parse_endpoint(endpoint)
+        except ValueError:
+            raise ConfigError("Invalid DoT or DoH address {}".format(endpoint))
+
+    if (server_config.dot_listen or server_config.doh_listen) and \
+            not (server_config.tls_certificate and server_config.tls_private_key):
+        raise ConfigError("dot_listen and doh_listen need tls_certificate and tls_private_key")
+
+    if server_config.tls_max_connections < 1 or server_config.tls_idle_timeout <= 0 or server_config.tls_session_tickets < 0:
+        raise ConfigError("tls_max_connections and tls_idle_timeout must be positive, tls_session_tickets not negative")
+
+    if not server_config.doh_path.startswith("/"):
+        raise ConfigError("doh_path must start with /")
+
+    view_names = [view.name for view in server_config.view]
+
+    if "" in view_names or "default" in view_names or len(set(view_names)) != len(view_names):
+        raise ConfigError("Views need unique names other than default")
+
+    for view in server_config.view:
+        for prefix in view.prefixes:
+            try:
+                ipaddress.ip_network(prefix, strict=False)
+            except ValueError:
+                raise ConfigError("Invalid prefix {} in view {}".format(prefix, view.name))
+
+    for health_check in server_config.health_check:
+        if health_check.kind not in ("tcp", "http"):
+            raise ConfigError("Unknown health check kind {}".format(health_check.kind))
+
+        if health_check.type.upper() not in resource_record.RrType.__members__:
+            raise ConfigError("Unknown record type {}".format(health_check.type))
+
+    return server_config
+
+
+def from_dict(values: dict) -> 'ServerConfig':
+    return validate(_build(ServerConfig, values, ""))
+
+
+def read_file(path: str) -> dict:
+    if path.endswith((".yaml", ".yml")):
+        try:
+            import yaml
+        except ImportError:
+            raise ConfigError("PyYAML is required to read {}".format(path))
+
+        with open(path, "r") as config_file:
+            return yaml.safe_load(config_file) or {}
+
+    with open(path, "rb") as config_file:
+        return tomllib.load(config_file)
+
+
+def load(path: str) -> 'ServerConfig':
+    return from_dict(read_file(path))
+
+
+def argument_parser() -> 'argparse.ArgumentParser':
+    parser = argparse.ArgumentParser(description="Hamurai name server")
+
+    parser.add_argument("-c", "--config", help="TOML or YAML configuration file")
+    parser.add_argument("-l", "--listen", action="append", metavar="ADDRESS[:PORT]",
+                        help="Address to answer on, repeat for more. Ex: 0.0.0.0:53, [::]:53")
+    parser.add_argument("-w", "--workers", type=int)
+    parser.add_argument("-z", "--zone", action="append", dest="zone_files", metavar="PATH",
+                        help="Zone file to load, repeat for more")
+    parser.add_argument("--recv-buffer-size", type=int)
+    parser.add_argument("--socket-rcvbuf", type=int)
+    parser.add_argument("--socket-sndbuf", type=int)
+    parser.add_argument("--response-cache-entries", type=int)
+    parser.add_argument("--log-every", type=int)
+    parser.add_argument("--upgrade", action="store_true", default=None,
+                        help="Take the listening sockets of the server running on upgrade_socket")
+
+    return parser
+
+
+def from_args(argv: 'list[str]') -> 'ServerConfig':
+    """Build the configuration from the command line, reading --config first
+    """
+
+    arguments = argument_parser().parse_args(argv)
+
+    try:
+        values = read_file(arguments.config) if arguments.config else {}
+    except (OSError, tomllib.TOMLDecodeError, ConfigError) as error:
+        raise SystemExit("Can not read configuration: {}".format(error))
+
+    if arguments.listen:
+        values["listen"] = []
+        for endpoint in arguments.listen:
+            try:
+                address, port = listeners.parse_endpoint(endpoint)
+            except ValueError:
+                raise SystemExit("Invalid listen address {}".format(endpoint))
+            values["listen"].append({"address": address, "port": port})
+
+    for key in ("workers", "zone_files", "recv_buffer_size", "socket_rcvbuf",
+                "socket_sndbuf", "response_cache_entries", "log_every", "upgrade"):
+        if getattr(arguments, key) is not None:
+            values[key] = getattr(arguments, key)
+
+    try:
+        return from_dict(values)
+    except ConfigError as error:
+        raise SystemExit("Invalid configuration: {}".format(error))
@@ -0,0 +1,151 @@
+import os
+import socket
+import sys
+
+import listeners
+
+# Control socket of a running server, a Unix stream socket answering one
+# command line per connection with a text reply. Ex:
+
+# python control.py /run/hamurai/control.sock profile 30
+
+# The socket shares the packet loop's selector like the TCP listeners,
+# commands run between queries in the process that accepted them. With
+# several workers every worker binds its own socket, <path>.<worker>.
+
+# Longest command line read
+MAX_COMMAND = 4096
+
+
+class ControlServer:
+    def __init__(self, udp_listeners: 'listeners.UdpListeners', path: str):
+        """Args:
+            udp_listeners (listeners.UdpListeners): Selector the socket is registered with
+            path (str): Filesystem path of the socket, replaced if it exists
+        """
+
+        self._udp_listeners = udp_listeners
+        self._path = path
+        self._commands: 'dict[str, object]' = {}
+        self._connections: 'dict[socket.socket, bytearray]' = {}
+
+        # A socket left behind by an earlier process refuses new connections
+
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(path)
+        self._sock.listen(8)
+        self._sock.setblocking(False)
+
+        udp_listeners.register(self._sock, self._accept)
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    def command(self, name: str, function) -> None:
+        """Answer the command name with function(arguments), which returns the reply text
+        """
+
+        self._commands[name] = function
+
+    def _accept(self, sock: 'socket.socket') -> None:
+        try:
+            connection, _ = sock.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+
+        connection.settimeout(1.0)
+        self._connections[connection] = bytearray()
+        self._udp_listeners.register(connection, self._read)
+
+    def _close(self, connection: 'socket.socket') -> None:
+        self._connections.pop(connection)
+        self._udp_listeners.unregister(connection)
+        connection.close()
+
+    def _read(self, connection: 'socket.socket') -> None:
+        buffer = self._connections[connection]
+
+        try:
+            data = connection.recv(MAX_COMMAND)
+        except (BlockingIOError, InterruptedError, socket.timeout):
+            return
+        except OSError:
+            data = b""
+
+        buffer += data
+
+        if data and b"\n" not in buffer and len(buffer) < MAX_COMMAND:
+            return
+
+        line = bytes(buffer).partition(b"\n")[0].decode(errors="replace")
+
+        try:
+            connection.sendall((self.run(line) + "\n").encode())
+        except OSError:
+            pass
+
+        self._close(connection)
+
+    def run(self, line: str) -> str:
+        words = line.split()
+
+        if not words:
+            return "commands: {}".format(" ".join(sorted(self._commands)))
+
+        function = self._commands.get(words[0])
+
+        if function is None:
+            return "unknown command {}".format(words[0])
+
+        try:
+            return function(words[1:])
+        except (ValueError, IndexError) as error:
+            return "error: {}".format(error)
+
+    def close(self) -> None:
+        for connection in list(self._connections):
+            self._close(connection)
+
+        self._udp_listeners.unregister(self._sock)
+        self._sock.close()
+
+        try:
+            os.unlink(self._path)
+        except FileNotFoundError:
+            pass
+
+
+def send(path: str, line: str, timeout: float = 60.0) -> str:
+    """Send one command to a control socket and return the reply
+    """
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall(line.encode() + b"\n")
+
+        reply = bytearray()
+
+        while True:
+            data = sock.recv(65536)
+
+            if not data:
+                return reply.decode(errors="replace")
+
+            reply += data
+
+
+if __name__ == "__main__":
+
+    # Usage: python control.py SOCKET COMMAND [ARGUMENTS...]
+
+    if len(sys.argv) < 3:
+        raise SystemExit("Usage: python control.py SOCKET COMMAND [ARGUMENTS...]")
+
+    print(send(sys.argv[1], " ".join(sys.argv[2:])), end="")
@@ -16,16 +16,24 @@ RA: {}\t\t\tARCOUNT: {}'''
 
 class Rcode(Enum):
     NO_ERROR_CONDITION = 0
-    SERVER_FAILURE = 1
+    FORMAT_ERROR = 1
+    SERVER_FAILURE = 2
     NAME_ERROR = 3
     NOT_IMPLEMENTED = 4
     REFUSED = 5
+    YX_DOMAIN = 6  # Name exists when it should not
+    YX_RRSET = 7  # RRset exists when it should not
+    NX_RRSET = 8  # RRset that should exist does not
+    NOT_AUTHORITATIVE = 9
+    NOT_ZONE = 10  # Name not contained in the zone
 
 
 class OperationCode(Enum):
     STANDARD_QUERY = 0  # QUERY
     INVERSE_QUERY = 1  # IQUERY
     SERVER_STATUS_REQUEST = 2  # STATUS
+    NOTIFY = 4  # NOTIFY, RFC 1996
+    UPDATE = 5  # UPDATE, RFC 2136
 
 
 class QueryOrResponse(Enum):
@@ -118,9 +126,11 @@ class DnsHeaderSection:
         # 0               a standard query (QUERY)
         # 1               an inverse query (IQUERY)
         # 2               a server status request (STATUS)
-        # 3-15            reserved for future use
+        # 4               a zone change notification (NOTIFY)
+        # 5               a dynamic update (UPDATE)
+        # 3, 6-15         reserved for future use
 
-        return OperationCode(0b01111000 & self._header_byte_3)  # OPCODE
+        return OperationCode((0b01111000 & self._header_byte_3) >> 3)  # OPCODE
 
     @operation_code.setter
     def operation_code(self, op_code: 'OperationCode') -> None:
@@ -299,8 +309,8 @@ class DnsHeaderSection:
 
     @additional_record_count.setter
     def additional_record_count(self, value: int) -> None:
-        self._header_byte_10_12 = value.to_bytes(2, "big")
-        self.data[9:12] = self._header_byte_10_12
+        self._header_byte_10_12 = value
+        self._data[10:12] = value.to_bytes(2, "big")
 
     def __str__(self):
 
@@ -0,0 +1,446 @@
+import argparse
+import concurrent.futures
+import os
+import time
+from enum import Enum
+
+import journal
+import question
+import rdata
+import resource_record
+import rrset
+import util
+import zone
+
+# The cryptography package is only needed when zones are signed
+
+try:
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec, ed25519
+    from cryptography.hazmat.primitives.asymmetric.utils import decode_dss_signature
+except ImportError:
+    ec = None
+
+# Online DNSSEC signing.
+
+# https://datatracker.ietf.org/doc/html/rfc4034
+# https://datatracker.ietf.org/doc/html/rfc4035
+
+# Every signed zone has one combined signing key, published as the DNSKEY
+# RRset at the apex. Signatures are made per RRset and kept in a cache, so
+# a signed answer costs the same dict lookup as an unsigned one and the
+# private key is only used when an RRset changes or its signature is due
+# for a refresh. Static zones are signed in bulk at startup, spread over a
+# process pool.
+
+# Signatures are refreshed once per refresh interval. Every signature made
+# in the same interval carries the same inception and expiration, so
+# whether a cached signature is current is a comparison of two integers,
+# and the interval number doubles as part of the response cache key.
+
+#          inception          refresh        expiration
+#  ----------|------------|-------|---- ... -----|------>
+#           -1h      interval start
+#                        |<--- validity -------->|
+
+# Denial of existence uses compact answers (RFC 9824). Instead of proving
+# a gap between two names of the zone, which needs the whole zone sorted,
+# the NSEC record covers only the query name and is signed on the fly.
+# A name that does not exist gets NOERROR with an NXNAME type in its NSEC.
+
+# https://datatracker.ietf.org/doc/html/rfc9824
+
+# Clocks of validating resolvers may run behind
+INCEPTION_SKEW = 3600
+
+# Zone key with the Secure Entry Point bit, RFC 4034 section 2.1.1
+KEY_FLAGS = 257
+
+
+class Algorithm(Enum):
+    ECDSAP256SHA256 = 13
+    ED25519 = 15
+
+
+def key_tag(dnskey_rdata: bytes) -> int:
+    """RFC 4034 appendix B
+    """
+
+    accumulator = 0
+
+    for index, octet in enumerate(dnskey_rdata):
+        accumulator += octet if index & 1 else octet << 8
+
+    accumulator += (accumulator >> 16) & 0xFFFF
+
+    return accumulator & 0xFFFF
+
+
+class SigningKey:
+    def __init__(self, private_key, flags: int = KEY_FLAGS):
+        """A private key with the DNSKEY it is published as.
+
+        Args:
+            private_key: An ec.EllipticCurvePrivateKey on P-256 or an ed25519.Ed25519PrivateKey
+            flags (int): DNSKEY flags
+        """
+
+        if ec is None:
+            raise RuntimeError("The cryptography package is required for DNSSEC signing")
+
+        if isinstance(private_key, ed25519.Ed25519PrivateKey):
+            self._algorithm = Algorithm.ED25519
+            public_key = private_key.public_key().public_bytes(
+                serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+
+        elif isinstance(private_key, ec.EllipticCurvePrivateKey) and private_key.curve.name == "secp256r1":
+            self._algorithm = Algorithm.ECDSAP256SHA256
+
+            # X and Y without the leading uncompressed point marker, RFC 6605 section 4
+
+            public_key = private_key.public_key().public_bytes(
+                serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint)[1:]
+
+        else:
+            raise ValueError("Only ECDSA P-256 and Ed25519 keys are supported")
+
+        self._private_key = private_key
+        self._dnskey_rdata = flags.to_bytes(2, "big") + b"\x03" + self._algorithm.value.to_bytes(1, "big") + public_key
+        self._key_tag = key_tag(self._dnskey_rdata)
+
+    @classmethod
+    def generate(cls, algorithm: 'Algorithm' = Algorithm.ECDSAP256SHA256) -> 'SigningKey':
+        if ec is None:
+            raise RuntimeError("The cryptography package is required for DNSSEC signing")
+
+        if algorithm == Algorithm.ED25519:
+            return cls(ed25519.Ed25519PrivateKey.generate())
+
+        return cls(ec.generate_private_key(ec.SECP256R1()))
+
+    @classmethod
+    def from_pem(cls, data: bytes) -> 'SigningKey':
+        if ec is None:
+            raise RuntimeError("The cryptography package is required for DNSSEC signing")
+
+        return cls(serialization.load_pem_private_key(data, password=None))
+
+    @classmethod
+    def load(cls, path: str) -> 'SigningKey':
+        with open(path, "rb") as key_file:
+            return cls.from_pem(key_file.read())
+
+    @property
+    def pem(self) -> bytes:
+        return self._private_key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption()
+        )
+
+    def save(self, path: str) -> None:
+        descriptor = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+
+        with os.fdopen(descriptor, "wb") as key_file:
+            key_file.write(self.pem)
+
+    @property
+    def algorithm(self) -> 'Algorithm':
+        return self._algorithm
+
+    @property
+    def dnskey_rdata(self) -> bytes:
+        return self._dnskey_rdata
+
+    @property
+    def key_tag(self) -> int:
+        return self._key_tag
+
+    def sign(self, data: bytes) -> bytes:
+        if self._algorithm == Algorithm.ED25519:
+            return self._private_key.sign(data)
+
+        # DER from cryptography, the 32 octet r and s concatenated on the wire
+
+        r, s = decode_dss_signature(self._private_key.sign(data, ec.ECDSA(hashes.SHA256())))
+
+        return r.to_bytes(32, "big") + s.to_bytes(32, "big")
+
+
+def rrsig_head(owner: str, rr_type: int, ttl: int, key: 'SigningKey', apex: str, inception: int, expiration: int) -> bytes:
+    """RRSIG RDATA up to the signature, RFC 4034 section 3.1
+    """
+
+    labels = len(owner.split(".")) if owner else 0
+
+    return (
+        rr_type.to_bytes(2, "big")
+        + key.algorithm.value.to_bytes(1, "big")
+        + labels.to_bytes(1, "big")
+        + ttl.to_bytes(4, "big")
+        + (expiration % 2**32).to_bytes(4, "big")
+        + (inception % 2**32).to_bytes(4, "big")
+        + key.key_tag.to_bytes(2, "big")
+        + bytes(util.domain_to_label(apex))
+    )
+
+
+def signing_input(head: bytes, records: 'tuple[bytes, ...]') -> bytes:
+    """The RRSIG RDATA head followed by the RRset in canonical order, RFC 4034 section 3.1.8.1.
+    Records are encoded with lowercase, uncompressed owner names, so only the order is left
+    """
+
+    return head + b"".join(sorted(records, key=journal.record_rdata))
+
+
+def rrsig_record(owner: str, ttl: int, head: bytes, signature: bytes) -> bytes:
+    return bytes(resource_record.ResourceRecord(
+        question.DnsQuestion(owner, resource_record.RrType.RRSIG, resource_record.RrClass.IN),
+        ttl,
+        rdata.Rdata(rdata.RdataType.RAW, head + signature)
+    ).bytes)
+
+
+def type_bitmap(types: 'list[int]') -> bytes:
+    """NSEC type bit maps, RFC 4034 section 4.1.2
+    """
+
+    windows: 'dict[int, bytearray]' = {}
+
+    for rr_type in sorted(set(types)):
+        window = windows.setdefault(rr_type >> 8, bytearray(32))
+        window[(rr_type & 0xFF) >> 3] |= 0b10000000 >> (rr_type & 0b111)
+
+    data = b""
+
+    for number, window in sorted(windows.items()):
+        window = bytes(window).rstrip(b"\0")
+        data += number.to_bytes(1, "big") + len(window).to_bytes(1, "big") + window
+
+    return data
+
+
+def _with_ttl(record: bytes, ttl: int) -> bytes:
+    offset = util.label_length(record) + 4
+
+    return record[:offset] + ttl.to_bytes(4, "big") + record[offset+4:]
+
+
+def opt_record(udp_payload_size: int = 1232) -> bytes:
+    """OPT record with the DO bit set, RFC 3225 section 3
+    """
+
+    return b"\x00" + resource_record.RrType.OPT.value.to_bytes(2, "big") + udp_payload_size.to_bytes(2, "big") \
+        + b"\x00\x00\x80\x00" + b"\x00\x00"
+
+
+# Key of the pool worker, loaded once by _init_worker
+
+_worker_key: 'SigningKey' = None
+
+
+def _init_worker(pem: bytes) -> None:
+    global _worker_key
+    _worker_key = SigningKey.from_pem(pem)
+
+
+def _sign_batch(inputs: 'list[bytes]') -> 'list[bytes]':
+    return [_worker_key.sign(data) for data in inputs]
+
+
+class Signer:
+    def __init__(self, validity: int = 14 * 86400, refresh_interval: int = 86400, max_entries: int = 100000):
+        """Signing keys of every signed zone and the cache of their signatures.
+
+        Args:
+            validity (int): Seconds from the start of a refresh interval until its signatures expire
+            refresh_interval (int): Seconds between refreshes of every signature
+            max_entries (int): Signatures kept, the oldest are dropped past this
+        """
+
+        if validity <= refresh_interval:
+            raise ValueError("Signatures must stay valid longer than the refresh interval")
+
+        self._validity = validity
+        self._refresh_interval = refresh_interval
+        self._max_entries = max_entries
+        self._keys: 'dict[str, SigningKey]' = {}
+
+        # (owner, type value) -> (refresh interval number, records, RRSIG record)
+        self._signatures: 'dict[tuple[str, int], tuple[int, tuple[bytes, ...], bytes]]' = {}
+        self.signed = 0
+
+    def add_key(self, apex: str, key: 'SigningKey') -> None:
+        self._keys[zone.normalize(apex)] = key
+
+    def key(self, apex: str) -> 'SigningKey':
+        return self._keys.get(apex)
+
+    @property
+    def apexes(self) -> 'list[str]':
+        return list(self._keys)
+
+    def publish(self, store: 'zone.ZoneStore', ttl: int = 3600) -> None:
+        """Add the DNSKEY RRset of every signed zone the store holds
+        """
+
+        for apex, key in self._keys.items():
+            if store.get(apex, resource_record.RrType.SOA) is not None:
+                store.add(rrset.RRset(apex, resource_record.RrType.DNSKEY, ttl, [key.dnskey_rdata]))
+
+    def epoch(self) -> int:
+        """Number of the current refresh interval
+        """
+
+        return int(time.time()) // self._refresh_interval
+
+    def _window(self, epoch: int) -> 'tuple[int, int]':
+        start = epoch * self._refresh_interval
+
+        return start - INCEPTION_SKEW, start + self._validity
+
+    def _store(self, key: 'tuple[str, int]', entry: tuple) -> None:
+        if key not in self._signatures and len(self._signatures) >= self._max_entries:
+            del self._signatures[next(iter(self._signatures))]
+
+        self._signatures[key] = entry
+
+    def rrsig(self, apex: str, owner: str, rr_type: int, ttl: int, records: 'tuple[bytes, ...]') -> bytes:
+        """Encoded RRSIG record over records, from the cache while it is current
+        """
+
+        epoch = self.epoch()
+        entry = self._signatures.get((owner, rr_type))
+
+        if entry is not None and entry[0] == epoch and (entry[1] is records or entry[1] == records):
+            return entry[2]
+
+        key = self._keys[apex]
+        head = rrsig_head(owner, rr_type, ttl, key, apex, *self._window(epoch))
+        record = rrsig_record(owner, ttl, head, key.sign(signing_input(head, records)))
+
+        self._store((owner, rr_type), (epoch, records, record))
+        self.signed += 1
+
+        return record
+
+    def presign(self, store: 'zone.ZoneStore', processes: int = None) -> int:
+        """Sign every RRset of every signed zone in the store ahead of the
+        first query. Returns how many RRsets were signed
+        """
+
+        epoch = self.epoch()
+        inception, expiration = self._window(epoch)
+        total = 0
+
+        for apex, key in self._keys.items():
+            soa = store.get(apex, resource_record.RrType.SOA)
+
+            if soa is None:
+                continue
+
+            pending = []
+
+            for record_set in [soa, *store.zone_rrsets(apex)]:
+                records = record_set.live_records
+                head = rrsig_head(
+                    record_set.name, record_set.rr_type.value, record_set.ttl, key, apex, inception, expiration)
+                pending.append((record_set, records, head))
+
+            inputs = [signing_input(head, records) for _, records, head in pending]
+
+            if processes == 1 or len(inputs) < 256:
+                signatures = [key.sign(data) for data in inputs]
+            else:
+                chunk_size = 256
+                chunks = [inputs[start:start+chunk_size] for start in range(0, len(inputs), chunk_size)]
+
+                with concurrent.futures.ProcessPoolExecutor(processes, initializer=_init_worker, initargs=(key.pem,)) as pool:
+                    signatures = [signature for batch in pool.map(_sign_batch, chunks) for signature in batch]
+
+            for (record_set, records, head), signature in zip(pending, signatures):
+                self._store(
+                    (record_set.name, record_set.rr_type.value),
+                    (epoch, records, rrsig_record(record_set.name, record_set.ttl, head, signature))
+                )
+
+            total += len(pending)
+
+        return total
+
+    def signed_rrset(self, apex: str, record_set: 'rrset.RRset') -> bytes:
+        return self.rrsig(apex, record_set.name, record_set.rr_type.value, record_set.ttl, record_set.live_records)
+
+    def denial(self, store: 'zone.ZoneStore', apex: str, domain: str) -> 'list[bytes]':
+        """Authority section records proving there is no RRset of the query
+        type at domain: the SOA, a compact NSEC and their signatures
+        """
+
+        name = zone.normalize(domain)
+        soa = store.get(apex, resource_record.RrType.SOA)
+
+        # Negative answers are cached for the smaller of the SOA TTL and MINIMUM, RFC 2308 section 5
+
+        minimum = int.from_bytes(soa.values[0][-4:], "big")
+        ttl = min(soa.ttl, minimum)
+
+        types = [record_set.rr_type.value for record_set in store.rrsets_at(name)]
+
+        if not types:
+            types = [resource_record.RrType.NXNAME.value]
+
+        types += [resource_record.RrType.RRSIG.value, resource_record.RrType.NSEC.value]
+
+        # The next name is the immediate successor of the query name, so the NSEC covers nothing else
+
+        nsec_rdata = b"\x01\x00" + bytes(util.domain_to_label(name)) + type_bitmap(types)
+        nsec = bytes(resource_record.ResourceRecord(
+            question.DnsQuestion(name, resource_record.RrType.NSEC, resource_record.RrClass.IN),
+            ttl,
+            rdata.Rdata(rdata.RdataType.RAW, nsec_rdata)
+        ).bytes)
+
+        # The SOA keeps the signature made over its zone TTL, which the
+        # RRSIG carries as the original TTL, only the TTLs sent are lowered
+
+        return [
+            _with_ttl(soa.records[0], ttl),
+            _with_ttl(self.signed_rrset(apex, soa), ttl),
+            nsec,
+            self.rrsig(apex, name, resource_record.RrType.NSEC.value, ttl, (nsec,)),
+        ]
+
+
+def load_keys(key_dir: str) -> 'dict[str, SigningKey]':
+    """Every <apex>.pem in key_dir by zone apex
+    """
+
+    return {
+        zone.normalize(file_name[:-len(".pem")]): SigningKey.load(os.path.join(key_dir, file_name))
+        for file_name in sorted(os.listdir(key_dir))
+        if file_name.endswith(".pem")
+    }
+
+
+if __name__ == "__main__":
+
+    # python dnssec.py ricklantis.com --algorithm ed25519 --key-dir keys
+
+    parser = argparse.ArgumentParser(description="Create a DNSSEC signing key for a zone")
+    parser.add_argument("zone")
+    parser.add_argument("--algorithm", choices=["ecdsap256sha256", "ed25519"], default="ecdsap256sha256")
+    parser.add_argument("--key-dir", default=".")
+    parser.add_argument("--ttl", type=int, default=3600, help="TTL of the DNSKEY and DS records printed")
+    arguments = parser.parse_args()
+
+    signing_key = SigningKey.generate(Algorithm[arguments.algorithm.upper()])
+    apex = zone.normalize(arguments.zone)
+    signing_key.save(os.path.join(arguments.key_dir, "{}.pem".format(apex)))
+
+    # The DS record for the parent zone, SHA-256 digest type 2, RFC 4509
+
+    digest = hashes.Hash(hashes.SHA256())
+    digest.update(bytes(util.domain_to_label(apex)) + signing_key.dnskey_rdata)
+
+    print("{}. {} IN DS {} {} 2 {}".format(
+        apex, arguments.ttl, signing_key.key_tag, signing_key.algorithm.value, digest.finalize().hex().upper()))
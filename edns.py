@@ -0,0 +1,240 @@
+import ipaddress
+
+import resource_record
+
+# EDNS(0) OPT pseudo record parsing for queries.
+
+# https://datatracker.ietf.org/doc/html/rfc6891#section-6.1.2
+
+# The OPT record lives in the additional section. Its CLASS field holds the
+# requestor's UDP payload size and its TTL field holds the extended RCODE,
+# the EDNS version and the flags (DO is the top bit).
+
+#             +0 (MSB)                            +1 (LSB)
+#  +---+---+---+---+---+---+---+---+---+---+---+---+---+---+---+---+
+#  |         EXTENDED-RCODE        |            VERSION            |
+#  +---+---+---+---+---+---+---+---+---+---+---+---+---+---+---+---+
+#  | DO|                           Z                               |
+#  +---+---+---+---+---+---+---+---+---+---+---+---+---+---+---+---+
+
+# Client subnet option, https://datatracker.ietf.org/doc/html/rfc7871#section-6
+
+OPTION_CLIENT_SUBNET = 8
+
+# Largest UDP message a client without EDNS takes, RFC 1035 section 4.2.1
+CLASSIC_UDP_SIZE = 512
+
+
+def skip_name(data: bytearray, offset: int) -> int:
+    """Returns the offset right after the domain name starting at offset.
+    A compression pointer ends the name after its two octets.
+    """
+
+    while offset < len(data):
+        label_length = data[offset]
+
+        if label_length == 0:
+            return offset + 1
+
+        if label_length & 0b11000000 == 0b11000000:
+            return offset + 2
+
+        offset += label_length + 1
+
+    raise ValueError("Domain name runs past the end of the message")
+
+
+class EdnsOpt:
+    def __init__(self, udp_payload_size: int, extended_rcode: int, version: int, flags: int, options: 'dict[int, bytes]'):
+        self._udp_payload_size = udp_payload_size
+        self._extended_rcode = extended_rcode
+        self._version = version
+        self._flags = flags
+        self._options = options
+
+    @property
+    def udp_payload_size(self) -> int:
+        # Values below 512 are treated as 512
+        return max(self._udp_payload_size, 512)
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    @property
+    def dnssec_ok(self) -> bool:
+        return bool(self._flags & 0b1000000000000000)
+
+    @property
+    def options(self) -> 'dict[int, bytes]':
+        return self._options
+
+    @property
+    def client_subnet(self) -> 'ipaddress._BaseNetwork':
+        """The network from the client subnet option, or None when absent or malformed
+        """
+
+        option = self._options.get(OPTION_CLIENT_SUBNET)
+
+        if option is None or len(option) < 4:
+            return None
+
+        family = int.from_bytes(option[:2], "big")
+        source_prefix_length = option[2]
+        address = bytes(option[4:])
+
+        try:
+            if family == 1:
+                return ipaddress.IPv4Network(
+                    (address.ljust(4, b"\0"), source_prefix_length), strict=False)
+            if family == 2:
+                return ipaddress.IPv6Network(
+                    (address.ljust(16, b"\0"), source_prefix_length), strict=False)
+        except ValueError:
+            return None
+
+        return None
+
+
+def with_option(response: bytearray, option_code: int, option_data: bytes, udp_payload_size: int = 1232) -> bytearray:
+    """A copy of response carrying one more EDNS option. The option joins
+    the OPT record ending the response, as signed responses and those
+    already given an option have, or a new OPT record is appended.
+    """
+
+    option = option_code.to_bytes(2, "big") + len(option_data).to_bytes(2, "big") + option_data
+
+    opt_offset = _trailing_opt(response)
+
+    if opt_offset is not None:
+        length_offset = opt_offset + 9
+        patched = bytearray(response)
+        patched[length_offset:length_offset+2] = \
+            (int.from_bytes(response[length_offset:length_offset+2], "big") + len(option)).to_bytes(2, "big")
+        patched += option
+
+        return patched
+
+    patched = bytearray(response)
+    patched[10:12] = (int.from_bytes(response[10:12], "big") + 1).to_bytes(2, "big")
+
+    patched += b"\x00" + resource_record.RrType.OPT.value.to_bytes(2, "big") + udp_payload_size.to_bytes(2, "big")
+    patched += b"\x00\x00\x00\x00" + len(option).to_bytes(2, "big") + option
+
+    return patched
+
+
+def _trailing_opt(response: bytearray) -> int:
+    """Offset of the OPT record when it is the last record of response, else None
+    """
+
+    if len(response) < 23 or response[10:12] == b"\x00\x00":
+        return None
+
+    offset = 12
+
+    for _ in range(int.from_bytes(response[4:6], "big")):
+        offset = skip_name(response, offset) + 4
+
+    record_count = sum(int.from_bytes(response[i:i+2], "big") for i in (6, 8, 10))
+    last = None
+
+    for _ in range(record_count):
+        last = offset
+        offset = skip_name(response, offset)
+        offset += 10 + int.from_bytes(response[offset+8:offset+10], "big")
+
+    if offset != len(response) or response[last] != 0 or \
+            response[last+1:last+3] != resource_record.RrType.OPT.value.to_bytes(2, "big"):
+        return None
+
+    return last
+
+
+def fit(response: bytearray, limit: int) -> bytearray:
+    """response in at most limit octets. Records in the additional section
+    are left out first, OPT records excepted, RFC 2181 section 9. Returns
+    None when the answer itself does not fit, the client needs TCP.
+    """
+
+    if len(response) <= limit:
+        return response
+
+    question_count = int.from_bytes(response[4:6], "big")
+    record_count = int.from_bytes(response[6:8], "big") + int.from_bytes(response[8:10], "big")
+    offset = 12
+
+    for _ in range(question_count):
+        offset = skip_name(response, offset) + 4
+
+    for _ in range(record_count):
+        offset = skip_name(response, offset)
+        offset += 10 + int.from_bytes(response[offset+8:offset+10], "big")
+
+    fitted = bytearray(response[:offset])
+    kept = 0
+
+    for _ in range(int.from_bytes(response[10:12], "big")):
+        start = offset
+        offset = skip_name(response, offset)
+        rr_type = int.from_bytes(response[offset:offset+2], "big")
+        offset += 10 + int.from_bytes(response[offset+8:offset+10], "big")
+
+        if rr_type == resource_record.RrType.OPT.value:
+            fitted += response[start:offset]
+            kept += 1
+
+    if len(fitted) > limit:
+        return None
+
+    fitted[10:12] = kept.to_bytes(2, "big")
+
+    return fitted
+
+
+def parse_opt(data: bytearray, offset: int, record_count: int) -> 'EdnsOpt':
+    """Find the OPT record in the additional section.
+
+    Args:
+        data (bytearray): The whole message
+        offset (int): Where the additional section starts
+        record_count (int): ARCOUNT from the header
+
+    Returns:
+        EdnsOpt: The parsed record, None when the query has no OPT record
+    """
+
+    for _ in range(record_count):
+        offset = skip_name(data, offset)
+
+        if offset + 10 > len(data):
+            return None
+
+        rr_type = int.from_bytes(data[offset:offset+2], "big")
+        rr_class = int.from_bytes(data[offset+2:offset+4], "big")
+        ttl = data[offset+4:offset+8]
+        rdata_length = int.from_bytes(data[offset+8:offset+10], "big")
+        offset += 10
+
+        if rr_type != resource_record.RrType.OPT.value:
+            offset += rdata_length
+            continue
+
+        options: 'dict[int, bytes]' = {}
+        rdata_end = min(offset + rdata_length, len(data))
+
+        while offset + 4 <= rdata_end:
+            option_code = int.from_bytes(data[offset:offset+2], "big")
+            option_length = int.from_bytes(data[offset+2:offset+4], "big")
+            options[option_code] = bytes(data[offset+4:offset+4+option_length])
+            offset += 4 + option_length
+
+        return EdnsOpt(
+            rr_class,
+            ttl[0],
+            ttl[1],
+            int.from_bytes(ttl[2:4], "big"),
+            options
+        )
+
+    return None
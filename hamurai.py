@@ -1,21 +1,484 @@
+import gc
+import os
 import socket
 import signal
+import sys
+import time
 import handlers.server_error as server_error
+import analytics
+import batch
+import config
+import control
+import cookies
+import dnssec
+import health
+import journal
+import listeners
+import policy
+import profiler
 import req_handler
-
-DNS_PORT = 53
-
-IP_ADDRESS = "0.0.0.0"
+import rrl
+import tcp_server
+import tls_server
+import update
+import upgrade
+import resource_record
+import response_cache
+import shared_cache
+import util
+import views
 
 # https://datatracker.ietf.org/doc/html/rfc1035
 
 # https://datatracker.ietf.org/doc/html/rfc6891#section-6.1.2
 
 
+# Set by open_listeners, tls_listeners only when DoT or DoH is configured
+
+tcp_listeners: 'tcp_server.TcpServer' = None
+
+tls_listeners: 'tls_server.TlsServer' = None
+
+# Set by setup when batch_parse is on
+batch_handler: 'batch.BatchHandler' = None
+
+
+def open_listeners(server_config: 'config.ServerConfig', inherited: 'dict[tuple[str, str, int], socket.socket]' = None) -> 'listeners.UdpListeners':
+    """Bind every configured listener, or reuse the one a previous server
+    handed over for the same address, see upgrade.py. Handed over sockets
+    no listener asks for are closed.
+    """
+
+    global tcp_listeners, tls_listeners
+
+    inherited = dict(inherited or {})
+
+    def take(kind: str, host: str, port: int) -> 'socket.socket':
+        return inherited.pop(upgrade.endpoint_key(kind, host, port), None)
+
+    udp_listeners = listeners.UdpListeners(server_config.recv_buffer_size)
+
+    for listener in server_config.listen:
+        sock = take("udp", listener.address, listener.port)
+
+        if sock is not None:
+            udp_listeners.add(sock)
+            continue
+
+        udp_listeners.bind(
+            listener.address,
+            listener.port,
+            v6only=listener.v6only,
+            rcvbuf=server_config.socket_rcvbuf or None,
+            sndbuf=server_config.socket_sndbuf or None
+        )
+
+    tcp_listeners = tcp_server.TcpServer(
+        udp_listeners,
+        server_config.transfer_allow,
+        server_config.tcp_max_connections,
+        server_config.tcp_idle_timeout
+    )
+
+    for listener in server_config.listen:
+        if not listener.tcp:
+            continue
+
+        sock = take("tcp", listener.address, listener.port)
+
+        if sock is not None:
+            tcp_listeners.add(sock)
+        else:
+            tcp_listeners.bind(listener.address, listener.port, listener.v6only)
+
+    if server_config.dot_listen or server_config.doh_listen:
+
+        # Contexts made before fork give every worker the same ticket keys
+
+        def context(alpn: str) -> 'ssl.SSLContext':
+            return tls_server.new_context(
+                server_config.tls_certificate,
+                server_config.tls_private_key,
+                [alpn],
+                server_config.tls_session_tickets
+            )
+
+        tls_listeners = tls_server.TlsServer(
+            udp_listeners,
+            context("dot") if server_config.dot_listen else None,
+            context("http/1.1") if server_config.doh_listen else None,
+            server_config.tls_max_connections,
+            server_config.tls_idle_timeout,
+            server_config.doh_path
+        )
+
+        for kind, endpoints, default_port in (("dot", server_config.dot_listen, 853), ("doh", server_config.doh_listen, 443)):
+            for endpoint in endpoints:
+                host, port = listeners.parse_endpoint(endpoint, default_port)
+                sock = take(kind, host, port)
+
+                if sock is not None:
+                    tls_listeners.add(sock, doh=kind == "doh")
+                else:
+                    tls_listeners.bind(host, port, doh=kind == "doh")
+
+    for sock in inherited.values():
+        sock.close()
+
+    return udp_listeners
+
+
+def listening_sockets() -> 'list[tuple[str, socket.socket]]':
+    """(kind, socket) of every listening socket, what an upgrade hands over
+    """
+
+    sockets = [("udp", sock) for sock in udp_listeners.sockets]
+    sockets += [("tcp", sock) for sock in tcp_listeners.sockets]
+
+    if tls_listeners is not None:
+        sockets += [("doh" if tls_listeners.is_doh(sock) else "dot", sock) for sock in tls_listeners.sockets]
+
+    return sockets
+
+
+# Set once the process stops reading its listening sockets, the time it
+# closes whatever connections are still open
+
+drain_deadline: float = None
+
+
+def begin_drain(signum, frame) -> None:
+    """SIGTERM of a serving process: stop reading the listening sockets,
+    which another server may share, and give open connections
+    drain_seconds to finish
+    """
+
+    global drain_deadline
+
+    if drain_deadline is not None:
+        return
+
+    drain_deadline = time.monotonic() + req_handler.server_config.drain_seconds
+
+    # Unregistered, not closed, the packet loop may be holding one right now
+
+    for _, sock in listening_sockets():
+        udp_listeners.unregister(sock)
+
+
+def open_connections() -> int:
+    return tcp_listeners.connection_count + (tls_listeners.connection_count if tls_listeners is not None else 0)
+
+
+def serve() -> None:
+    """Run the packet loop until SIGTERM and the drain that follows it
+    """
+
+    signal.signal(signal.SIGTERM, begin_drain)
+
+    while drain_deadline is None:
+        main_loop()
+
+    while open_connections() and time.monotonic() < drain_deadline:
+        main_loop()
+
+
+def open_journal(server_config: 'config.ServerConfig', view: 'views.View') -> None:
+    """Replace the in memory journal of a view with its file, and replay
+    every entry that follows on from the serials the zone files loaded
+    """
+
+    file_journal = journal.FileJournal(
+        os.path.join(server_config.journal_dir, "{}.journal".format(view.name)),
+        server_config.journal_fsync_interval
+    )
+
+    for apex, delta in file_journal.entries():
+        serial = view.zone_store.serial(apex)
+
+        if serial is None:
+            continue
+
+        # A snapshot stands in for the deltas compaction dropped, see journal.py
+
+        if delta.is_snapshot:
+            if update.serial_greater(delta.new_serial, serial):
+                update.apply_snapshot(view.zone_store, apex, delta)
+
+        elif serial == delta.old_serial:
+            update.apply_delta(view.zone_store, apex, delta)
+
+    if file_journal.needs_compaction:
+        file_journal.compact({
+            apex: update.snapshot(view.zone_store, apex)
+            for apex in file_journal.apexes() if view.zone_store.serial(apex) is not None
+        })
+
+    view.zone_store.journal = file_journal
+
+
+def new_response_cache(server_config: 'config.ServerConfig') -> 'response_cache.ResponseTemplateCache | shared_cache.SharedResponseCache':
+    if server_config.shared_cache_slots:
+        return shared_cache.SharedResponseCache(
+            server_config.shared_cache_slots,
+            server_config.shared_cache_slot_size,
+            server_config.shared_cache_ttl
+        )
+
+    return response_cache.ResponseTemplateCache(server_config.response_cache_entries)
+
+
+def setup(server_config: 'config.ServerConfig') -> 'health.HealthChecker':
+    """Load zones, blocklists and views for the request handler and fill
+    the response caches. Returns the health checker, not started yet, or
+    None when nothing is checked
+    """
+
+    global batch_handler
+
+    req_handler.server_config = server_config
+
+    util.debug_labels = server_config.debug_labels
+
+    default_view = views.View(
+        "default",
+        cache=new_response_cache(server_config)
+    )
+
+    for path in server_config.zone_files:
+        default_view.zone_store.load(path)
+
+    req_handler.default_view = default_view
+
+    if server_config.view:
+        view_table = views.ViewTable(default_view)
+        prefixes = []
+
+        for view_config in server_config.view:
+            view = views.View(
+                view_config.name,
+                cache=new_response_cache(server_config)
+            )
+
+            for path in view_config.zone_files:
+                view.zone_store.load(path)
+
+            view_table.add_view(view)
+            prefixes += [(prefix, view_config.name) for prefix in view_config.prefixes]
+
+        view_table.set_prefixes(prefixes)
+        req_handler.view_table = view_table
+
+    if server_config.journal_dir:
+        all_views = req_handler.view_table.views if req_handler.view_table else [default_view]
+
+        for view in all_views:
+            open_journal(server_config, view)
+
+    if server_config.dnssec_key_dir:
+        all_views = req_handler.view_table.views if req_handler.view_table else [default_view]
+        keys = dnssec.load_keys(server_config.dnssec_key_dir)
+
+        for view in all_views:
+            view.signer = dnssec.Signer(
+                server_config.dnssec_signature_validity,
+                server_config.dnssec_refresh_interval,
+                server_config.response_cache_entries
+            )
+
+            for apex, key in keys.items():
+                view.signer.add_key(apex, key)
+
+            view.signer.publish(view.zone_store)
+            view.signer.presign(view.zone_store, server_config.dnssec_presign_processes or None)
+
+    if server_config.blocklist:
+        engine = policy.PolicyEngine()
+
+        for blocklist in server_config.blocklist:
+            action = policy.PolicyAction[blocklist.action.upper()]
+            answer = blocklist.answer.encode() if blocklist.answer else None
+            open_list = policy.PolicyList.open if blocklist.compiled else policy.PolicyList.load
+            engine.add(open_list(blocklist.path, action, answer))
+
+        req_handler.response_policy = engine
+
+    if server_config.dns_cookies:
+        req_handler.cookie_jar = cookies.CookieJar(
+            bytes.fromhex(server_config.cookie_secret) if server_config.cookie_secret else None,
+            server_config.cookie_rotation
+        )
+
+    if server_config.rrl_responses_per_second:
+        req_handler.rate_limiter = rrl.ResponseRateLimiter(
+            server_config.rrl_responses_per_second,
+            server_config.rrl_window,
+            server_config.rrl_slip,
+            server_config.rrl_table_size,
+            server_config.rrl_ipv4_prefix,
+            server_config.rrl_ipv6_prefix
+        )
+
+    if server_config.batch_parse:
+        batch_handler = batch.BatchHandler(max_index=max(server_config.response_cache_entries, 1))
+
+    all_views = req_handler.view_table.views if req_handler.view_table else [default_view]
+
+    for view in all_views:
+        req_handler.warm_cache(view)
+
+    if not server_config.health_check:
+        return None
+
+    checker = health.HealthChecker(server_config.health_check_interval)
+
+    for check_config in server_config.health_check:
+        check = health.HealthCheck(
+            check_config.kind,
+            check_config.port,
+            check_config.path,
+            timeout=check_config.timeout
+        )
+
+        for view in all_views:
+            record_set = view.zone_store.get(
+                check_config.name, resource_record.RrType[check_config.type.upper()])
+
+            if record_set is not None:
+                checker.watch(record_set, check)
+
+    return checker
+
+
+def memory_usage() -> 'dict[str, int]':
+    """Rss, Pss, Shared and Private memory of this process in KB. Pss
+    splits every shared page between the processes sharing it, so it is
+    the cost of one worker. Empty where /proc is not available
+    """
+
+    usage = {"Rss": 0, "Pss": 0, "Shared": 0, "Private": 0}
+
+    try:
+        with open("/proc/self/smaps_rollup", "r") as smaps:
+            for line in smaps:
+                key, _, value = line.partition(":")
+
+                if key in usage:
+                    usage[key] += int(value.split()[0])
+                elif key.startswith("Shared_"):
+                    usage["Shared"] += int(value.split()[0])
+                elif key.startswith("Private_"):
+                    usage["Private"] += int(value.split()[0])
+    except OSError:
+        return {}
+
+    return usage
+
+
+def report_startup(role: str, started: float) -> None:
+    usage = memory_usage()
+
+    print("{} {} ready in {:.3f}s, rss {} KB, pss {} KB, shared {} KB, private {} KB".format(
+        role,
+        os.getpid(),
+        time.monotonic() - started,
+        usage.get("Rss", "?"),
+        usage.get("Pss", "?"),
+        usage.get("Shared", "?"),
+        usage.get("Private", "?")
+    ))
+
+
+def start_diagnostics(server_config: 'config.ServerConfig', worker: int = None) -> 'control.ControlServer':
+    """Arm the profiler on SIGUSR1, stage tracing, traffic analytics and
+    the control socket in a process about to serve. Returns the control server, if any.
+
+    Args:
+        server_config (config.ServerConfig): Validated configuration
+        worker (int): Number of this worker, None when the server runs alone
+    """
+
+    sampler = profiler.SamplingProfiler(server_config.profile_interval, server_config.profile_dir)
+    sampler.install()
+
+    signal.signal(signal.SIGUSR1, lambda signum, frame: sampler.start(server_config.profile_seconds))
+
+    if server_config.trace_stages:
+        req_handler.tracer = profiler.StageTracer()
+
+    if server_config.analytics_window:
+        req_handler.traffic = analytics.TrafficAnalytics(
+            server_config.analytics_window,
+            server_config.analytics_top,
+            server_config.analytics_sketch_width,
+            sample=server_config.analytics_sample
+        )
+
+    if not server_config.control_socket:
+        return None
+
+    path = server_config.control_socket if worker is None else "{}.{}".format(server_config.control_socket, worker)
+    control_server = control.ControlServer(udp_listeners, path)
+
+    def profile_command(arguments: 'list[str]') -> str:
+        seconds = float(arguments[0]) if arguments else server_config.profile_seconds
+
+        if seconds <= 0:
+            raise ValueError("seconds must be positive")
+
+        path = sampler.start(seconds)
+
+        return "already profiling" if path is None else "profiling {} for {}s to {}".format(os.getpid(), seconds, path)
+
+    def trace_command(arguments: 'list[str]') -> str:
+        action = arguments[0] if arguments else "show"
+
+        if action == "on":
+            req_handler.tracer = profiler.StageTracer()
+            return "tracing on"
+
+        if action == "off":
+            req_handler.tracer = None
+            return "tracing off"
+
+        if action != "show":
+            raise ValueError("trace takes on, off or show")
+
+        if req_handler.tracer is None:
+            return "tracing off"
+
+        return req_handler.tracer.report()
+
+    def top_command(arguments: 'list[str]') -> str:
+        if req_handler.traffic is None:
+            return "analytics off, set analytics_window"
+
+        kind = arguments[0] if arguments else "names"
+        n = int(arguments[1]) if len(arguments) > 1 else 10
+
+        return req_handler.traffic.report(kind, n)
+
+    def tls_command(arguments: 'list[str]') -> str:
+        if tls_listeners is None:
+            return "no DoT or DoH listeners"
+
+        return tls_listeners.session_stats()
+
+    control_server.command("profile", profile_command)
+    control_server.command("tls", tls_command)
+    control_server.command("top", top_command)
+    control_server.command("trace", trace_command)
+
+    return control_server
+
+
 def main_loop():
-    data, addr = sock.recvfrom(512)
     # try:
-    req_handler.request_handler(bytearray(data), addr, sock)
+
+    # The timeout lets serve() notice SIGTERM while no traffic comes in
+
+    udp_listeners.poll(req_handler.request_handler, 1.0, batch_handler)
+    tcp_listeners.sweep()
     # except Exception as e:
     #     print(e)
     #     response = server_error.handler()
@@ -25,13 +488,168 @@ def main_loop():
     #     )
 
 
+def finish_startup(server_config: 'config.ServerConfig', handoff: 'socket.socket') -> None:
+    """Tell the server this one took the sockets from that it is ready,
+    then wait to hand them on to the next one
+    """
+
+    if handoff is not None:
+        upgrade.report_ready(handoff)
+
+    if server_config.upgrade_socket:
+        upgrade.HandoffListener(
+            server_config.upgrade_socket,
+            listening_sockets(),
+            lambda: os.kill(os.getpid(), signal.SIGTERM)
+        ).start()
+
+
+def close_journals() -> None:
+    all_views = req_handler.view_table.views if req_handler.view_table else [req_handler.default_view]
+
+    for view in all_views:
+        if isinstance(view.zone_store.journal, journal.FileJournal):
+            view.zone_store.journal.close()
+
+
+def run_workers(server_config: 'config.ServerConfig', handoff: 'socket.socket' = None) -> None:
+    """Fork one process per worker, all reading from the sockets bound by the parent.
+
+    With prefork_warmup the parent loads everything once and the workers
+    share those pages copy-on-write. gc.freeze moves every object loaded so
+    far out of the collector's reach, otherwise the first collection in a
+    worker would write to, and so copy, every page holding one. A worker
+    that exits is replaced by a fresh fork of the warm parent. SIGTERM
+    drains every worker and waits for them before exiting.
+    """
+
+    checker = None
+
+    if server_config.prefork_warmup:
+        started = time.monotonic()
+        checker = setup(server_config)
+
+        gc.collect()
+        gc.freeze()
+
+        report_startup("parent", started)
+
+    def start_worker(worker: int) -> int:
+        pid = os.fork()
+
+        if pid != 0:
+            return pid
+
+        started = time.monotonic()
+
+        udp_listeners.renew_selector()
+
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+        worker_checker = checker if server_config.prefork_warmup else setup(server_config)
+
+        # Threads do not survive fork, every worker checks its own copy of the RRsets
+
+        if worker_checker is not None:
+            worker_checker.start()
+
+        if tls_listeners is not None:
+            tls_listeners.start()
+
+        start_diagnostics(server_config, worker)
+
+        report_startup("worker", started)
+
+        serve()
+
+        # Exit handlers belong to the parent
+
+        sys.stdout.flush()
+        os._exit(0)
+
+    # pid -> (worker number, fork time), a replacement keeps the number and so the control socket
+
+    children = {start_worker(worker): (worker, time.monotonic()) for worker in range(server_config.workers)}
+
+    finish_startup(server_config, handoff)
+
+    stopping = False
+
+    def stop_workers(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def profile_workers(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGUSR1)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop_workers)
+    signal.signal(signal.SIGTERM, stop_workers)
+    signal.signal(signal.SIGUSR1, profile_workers)
+
+    while children:
+        pid, status = os.wait()
+        child = children.pop(pid, None)
+
+        if child is None or stopping:
+            continue
+
+        worker, forked_at = child
+
+        print("Worker {} exited with status {}, starting a new one".format(pid, status))
+
+        # Do not spin when workers die right after starting
+
+        if time.monotonic() - forked_at < 1:
+            time.sleep(1)
+
+        children[start_worker(worker)] = (worker, time.monotonic())
+
+
 if __name__ == "__main__":
 
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server_config = config.from_args(sys.argv[1:])
+
+    inherited_sockets, handoff = {}, None
+
+    if server_config.upgrade:
+        try:
+            inherited_sockets, handoff = upgrade.take_over(server_config.upgrade_socket)
+        except OSError as error:
+            print("No sockets taken over from {} ({}), binding the sockets".format(server_config.upgrade_socket, error))
 
-    sock.bind((IP_ADDRESS, DNS_PORT))
+    udp_listeners = open_listeners(server_config, inherited_sockets)
 
     signal.signal(signal.SIGINT, signal.SIG_DFL)
 
-    while True:
-        main_loop()
+    if server_config.workers > 1:
+        run_workers(server_config, handoff)
+    else:
+        started = time.monotonic()
+        checker = setup(server_config)
+
+        if checker is not None:
+            checker.start()
+
+        if tls_listeners is not None:
+            tls_listeners.start()
+
+        start_diagnostics(server_config)
+
+        report_startup("server", started)
+
+        finish_startup(server_config, handoff)
+
+        serve()
+
+        close_journals()
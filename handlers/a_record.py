@@ -2,13 +2,27 @@
 import dns_header
 import resource_record
 import rdata
+import rrset
 
 
-def handler(req_head: 'dns_header.DnsHeaderSection', first_question) -> bytearray:
+def record(first_question, address: bytes, ttl: int) -> bytes:
+    """The A record answering first_question, owned by its QNAME
+    """
+
+    return bytes(resource_record.ResourceRecord(
+        first_question,
+        ttl,
+        rdata.Rdata(rdata.RdataType.IPV4, address)
+    ).bytes)
+
+
+def handler(req_head: 'dns_header.DnsHeaderSection', first_question, address: bytes = b"147.182.185.61", ttl: int = 10) -> bytearray:
     response = bytearray([])
 
     res_head = dns_header.DnsHeaderSection([])
 
+    res_head.question_count = 1
+
     res_head.answer_count = 1
 
     res_head.transaction_id = req_head.transaction_id
@@ -27,12 +41,42 @@ def handler(req_head: 'dns_header.DnsHeaderSection', first_question) -> bytearra
 
     response += res_head.bytes
 
-    res_resource_record = resource_record.ResourceRecord(
-        first_question,
-        10,
-        rdata.Rdata(rdata.RdataType.IPV4, b"147.182.185.61")
-    ).bytes
+    response += first_question.bytes
+
+    response += record(first_question, address, ttl)
+
+    return response
+
+
+def rrset_handler(req_head: 'dns_header.DnsHeaderSection', first_question, record_set: 'rrset.RRset', additional: 'tuple[int, bytes]' = (0, b"")) -> bytearray:
+    response = bytearray([])
+
+    answer_count, answer_section = record_set.next_answer()
+
+    res_head = dns_header.DnsHeaderSection([])
+
+    res_head.question_count = 1
+
+    res_head.answer_count = answer_count
+
+    res_head.additional_record_count = additional[0]
+
+    res_head.transaction_id = req_head.transaction_id
+
+    res_head.query_or_response = dns_header.QueryOrResponse.RESPONSE
+
+    res_head.authoritative_answer = True
+
+    res_head.operation_code = dns_header.OperationCode.STANDARD_QUERY
+
+    response += res_head.bytes
+
+    response += first_question.bytes
+
+    # Already encoded when the zone was loaded, rotation order included
+
+    response += answer_section
 
-    response += res_resource_record
+    response += additional[1]
 
     return response
@@ -0,0 +1,37 @@
+import cookies
+import dns_header
+import question
+import resource_record
+
+
+def handler(req_head: 'dns_header.DnsHeaderSection', first_question: 'question.DnsQuestion', cookie: bytes) -> bytearray:
+    response = bytearray([])
+
+    res_head = dns_header.DnsHeaderSection([])
+
+    res_head.question_count = 1
+
+    res_head.additional_record_count = 1
+
+    res_head.transaction_id = req_head.transaction_id
+
+    res_head.query_or_response = dns_header.QueryOrResponse.RESPONSE
+
+    res_head.authoritative_answer = True
+
+    # BADCOOKIE does not fit the header, its low four bits go there and
+    # the rest in the OPT record, https://datatracker.ietf.org/doc/html/rfc6891#section-6.1.3
+
+    res_head.response_code = dns_header.Rcode(cookies.BADCOOKIE & 0x0F)
+
+    response += res_head.bytes
+
+    response += first_question.bytes
+
+    option = cookies.OPTION_COOKIE.to_bytes(2, "big") + len(cookie).to_bytes(2, "big") + cookie
+
+    response += b"\x00" + resource_record.RrType.OPT.value.to_bytes(2, "big") + (1232).to_bytes(2, "big")
+
+    response += bytes([cookies.BADCOOKIE >> 4, 0, 0, 0]) + len(option).to_bytes(2, "big") + option
+
+    return response
@@ -0,0 +1,49 @@
+import dns_header
+import question
+
+
+def handler(req_head: 'dns_header.DnsHeaderSection', question: 'question.DnsQuestion') -> bytearray:
+    response = bytearray([])
+
+    res_head = dns_header.DnsHeaderSection([])
+
+    res_head.question_count = 1
+
+    res_head.transaction_id = req_head.transaction_id
+
+    res_head.query_or_response = dns_header.QueryOrResponse.RESPONSE
+
+    res_head.response_code = dns_header.Rcode.FORMAT_ERROR
+
+    response += res_head.bytes
+
+    response += question.bytes
+
+    return response
+
+
+def raw_handler(data: bytearray, question_end: int = None, rcode: 'dns_header.Rcode' = dns_header.Rcode.FORMAT_ERROR) -> bytearray:
+    """For a query too broken to parse, FORMERR or NOTIMP. The header is
+    echoed, and the question when question_end says where it ends
+    """
+
+    res_head = dns_header.DnsHeaderSection(bytearray(data[:12]))
+
+    res_head.query_or_response = dns_header.QueryOrResponse.RESPONSE
+
+    res_head.response_code = rcode
+
+    res_head.question_count = 1 if question_end is not None else 0
+
+    res_head.answer_count = 0
+
+    res_head.name_server_count = 0
+
+    res_head.additional_record_count = 0
+
+    response = bytearray(res_head.bytes)
+
+    if question_end is not None:
+        response += data[12:question_end]
+
+    return response
@@ -1,34 +1,22 @@
-
 import dns_header
-import question
-
-
-def handler():
-    response = bytearray([])
-
-    res_head = dns_header.DnsHeaderSection([])
-
-    res_head.set_answer_count(0)
 
-    res_head.set_question_count(0)
 
-    res_head.set_transaction_id(1)
+def handler(data: bytearray) -> bytearray:
+    """SERVFAIL for a query answering failed on, the header echoed without any section
+    """
 
-    res_head.set_query_or_response(
-        dns_header.QueryOrResponse.RESPONSE)
+    res_head = dns_header.DnsHeaderSection(bytearray(data[:12]))
 
-    res_head.set_authoritative_answer(True)
+    res_head.query_or_response = dns_header.QueryOrResponse.RESPONSE
 
-    res_head.set_operation_code(
-        op_code=dns_header.OperationCode.STANDARD_QUERY)
-    res_head.set_truncation(False)
+    res_head.response_code = dns_header.Rcode.SERVER_FAILURE
 
-    res_head.set_recursion_desired(False)
+    res_head.question_count = 0
 
-    res_head.set_recursion_available(False)
+    res_head.answer_count = 0
 
-    res_head.set_response_code(dns_header.Rcode.SERVER_FAILURE)
+    res_head.name_server_count = 0
 
-    response += res_head.bytes
+    res_head.additional_record_count = 0
 
-    return response
+    return bytearray(res_head.bytes)
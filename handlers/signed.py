@@ -0,0 +1,70 @@
+import dns_header
+import question
+
+
+def handler(req_head: 'dns_header.DnsHeaderSection', first_question: 'question.DnsQuestion', answer_count: int, answer_section: bytes, rrsig: bytes, opt: bytes) -> bytearray:
+    response = bytearray([])
+
+    res_head = dns_header.DnsHeaderSection([])
+
+    res_head.question_count = 1
+
+    res_head.answer_count = answer_count + 1
+
+    res_head.additional_record_count = 1
+
+    res_head.transaction_id = req_head.transaction_id
+
+    res_head.query_or_response = dns_header.QueryOrResponse.RESPONSE
+
+    res_head.authoritative_answer = True
+
+    res_head.operation_code = dns_header.OperationCode.STANDARD_QUERY
+
+    response += res_head.bytes
+
+    response += first_question.bytes
+
+    # The signature covers the whole RRset whichever rotation is sent
+
+    response += answer_section
+
+    response += rrsig
+
+    response += opt
+
+    return response
+
+
+def denial_handler(req_head: 'dns_header.DnsHeaderSection', first_question: 'question.DnsQuestion', authority: 'list[bytes]', opt: bytes) -> bytearray:
+    response = bytearray([])
+
+    res_head = dns_header.DnsHeaderSection([])
+
+    res_head.question_count = 1
+
+    res_head.name_server_count = len(authority)
+
+    res_head.additional_record_count = 1
+
+    res_head.transaction_id = req_head.transaction_id
+
+    res_head.query_or_response = dns_header.QueryOrResponse.RESPONSE
+
+    res_head.authoritative_answer = True
+
+    # Compact denial answers NOERROR for names that do not exist too, the
+    # NSEC record tells them apart
+
+    res_head.response_code = dns_header.Rcode.NO_ERROR_CONDITION
+
+    response += res_head.bytes
+
+    response += first_question.bytes
+
+    for record in authority:
+        response += record
+
+    response += opt
+
+    return response
@@ -0,0 +1,26 @@
+import dns_header
+import question
+
+
+def handler(req_head: 'dns_header.DnsHeaderSection', first_question: 'question.DnsQuestion') -> bytearray:
+    response = bytearray([])
+
+    res_head = dns_header.DnsHeaderSection([])
+
+    res_head.question_count = 1
+
+    res_head.transaction_id = req_head.transaction_id
+
+    res_head.query_or_response = dns_header.QueryOrResponse.RESPONSE
+
+    res_head.authoritative_answer = True
+
+    # No records, TC sends the client to TCP for the answer
+
+    res_head.truncation = True
+
+    response += res_head.bytes
+
+    response += first_question.bytes
+
+    return response
@@ -0,0 +1,122 @@
+import concurrent.futures
+import http.client
+import socket
+import threading
+import time
+
+import rrset
+
+# Background health checks for RRset backends. Probes run on their own
+# scheduler thread and a small probe pool, and only ever touch the packet
+# loop through RRset.set_healthy, which swaps in a prebuilt answer state.
+
+
+class HealthCheck:
+    def __init__(self, kind: str = "tcp", port: int = 80, path: str = "/", host: str = None, timeout: float = 1.0):
+        """How to probe one backend.
+
+        Args:
+            kind (str): "tcp" for a plain connect, "http" for a GET that must not return 4xx/5xx
+            port (int): Port to probe on the backend address
+            path (str): Request path for http probes
+            host (str): Host header for http probes, defaults to the address
+            timeout (float): Seconds before the probe counts as failed
+        """
+
+        if kind not in ("tcp", "http"):
+            raise ValueError("Unknown health check kind {}".format(kind))
+
+        self.kind = kind
+        self.port = port
+        self.path = path
+        self.host = host
+        self.timeout = timeout
+
+    def probe(self, address: str) -> bool:
+        try:
+            if self.kind == "tcp":
+                with socket.create_connection((address, self.port), timeout=self.timeout):
+                    return True
+
+            connection = http.client.HTTPConnection(address, self.port, timeout=self.timeout)
+
+            try:
+                connection.request("GET", self.path, headers={"Host": self.host or address})
+                return connection.getresponse().status < 400
+            finally:
+                connection.close()
+
+        except (OSError, http.client.HTTPException):
+            return False
+
+
+class HealthChecker:
+    def __init__(self, interval: float = 5.0, rise: int = 2, fall: int = 2, max_probes: int = 16):
+        """Periodically probes every watched backend.
+
+        Args:
+            interval (float): Seconds between probe rounds
+            rise (int): Consecutive passing probes before a backend is put back
+            fall (int): Consecutive failing probes before a backend is removed
+            max_probes (int): Probes allowed to run at the same time
+        """
+
+        self._interval = interval
+        self._rise = rise
+        self._fall = fall
+        self._max_probes = max_probes
+
+        # [rrset, index, address, check, consecutive passes, consecutive failures]
+        self._targets: 'list[list]' = []
+
+        self._stopped = threading.Event()
+        self._pool: 'concurrent.futures.ThreadPoolExecutor' = None
+        self._thread: 'threading.Thread' = None
+
+    def watch(self, record_set: 'rrset.RRset', check: 'HealthCheck') -> None:
+        for index, value in enumerate(record_set.values):
+            self._targets.append([record_set, index, value.decode(), check, 0, 0])
+
+    def run_once(self) -> None:
+        targets = list(self._targets)
+
+        results = self._pool.map(lambda target: target[3].probe(target[2]), targets)
+
+        for target, passed in zip(targets, results):
+            record_set, index = target[0], target[1]
+
+            if passed:
+                target[4] += 1
+                target[5] = 0
+                if target[4] >= self._rise:
+                    record_set.set_healthy(index, True)
+            else:
+                target[4] = 0
+                target[5] += 1
+                if target[5] >= self._fall:
+                    record_set.set_healthy(index, False)
+
+    def _run(self) -> None:
+
+        # Sleeping on the stop event lets stop() interrupt the wait between rounds
+
+        while not self._stopped.is_set():
+            started = time.monotonic()
+            self.run_once()
+            self._stopped.wait(max(0.0, self._interval - (time.monotonic() - started)))
+
+    def start(self) -> None:
+        self._pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self._max_probes, thread_name_prefix="health-probe")
+
+        self._thread = threading.Thread(target=self._run, name="health-checker", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+        if self._thread is not None:
+            self._thread.join()
+
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
@@ -0,0 +1,314 @@
+import os
+import tempfile
+import threading
+import zlib
+
+import util
+
+# Zone change journal. Every change to a zone is kept as the RFC 1995 style
+# difference between two SOA serials, the records removed and the records
+# added, all in their encoded ResourceRecord form. A secondary that asks
+# for IXFR from a serial in here gets the chain of deltas, anything older
+# than the journal falls back to a full AXFR.
+
+# https://datatracker.ietf.org/doc/html/rfc1995
+
+# FileJournal also appends every delta to a file so dynamic updates
+# survive a restart. Entries are written straight to the file when they
+# are appended and a background thread fsyncs at most once per interval,
+# so a burst of updates costs one fsync instead of one each. An update is
+# answered before its fsync, after a power loss the last interval worth of
+# updates can be missing from the file, a crash of the process loses
+# nothing. Each entry is framed as
+#
+# +--------+--------+---------------------------------------------+
+# | LENGTH | CRC32  | APEX, OLD SOA, NEW SOA, DELETED, ADDED      |
+# +--------+--------+---------------------------------------------+
+#
+# and reading stops at the first torn or corrupt entry.
+
+# Past max_deltas entries of a zone the file is compacted when it is
+# opened: the newest deltas are kept, followed by a snapshot of the whole
+# zone as it stands after them. A snapshot is an entry without OLD SOA,
+# its ADDED records are every record of the zone. Replay restores it when
+# the zone files are older, so no update is lost with the deltas dropped.
+
+
+def soa_serial(rdata: bytes) -> int:
+    """SERIAL from SOA RDATA, it follows the MNAME and RNAME
+    """
+
+    offset = util.label_length(rdata)
+    offset += util.label_length(rdata, offset)
+
+    return int.from_bytes(rdata[offset:offset+4], "big")
+
+
+def record_rdata(record: bytes) -> bytes:
+    """RDATA of an encoded record, after the owner, TYPE, CLASS, TTL and RDLENGTH
+    """
+
+    return record[util.label_length(record) + 10:]
+
+
+class Delta:
+    def __init__(self, old_soa: bytes, new_soa: bytes, deleted: 'list[bytes]', added: 'list[bytes]'):
+        """One change to a zone.
+
+        Args:
+            old_soa (bytes): The encoded SOA record before the change
+            new_soa (bytes): The encoded SOA record after the change
+            deleted (list[bytes]): Encoded records removed by the change
+            added (list[bytes]): Encoded records added by the change
+        """
+
+        self.old_soa = old_soa
+        self.new_soa = new_soa
+        self.deleted = deleted
+        self.added = added
+
+    @property
+    def is_snapshot(self) -> bool:
+        """Every record of the zone at new_soa rather than a change
+        """
+        return not self.old_soa
+
+    @property
+    def old_serial(self) -> int:
+        return soa_serial(record_rdata(self.old_soa))
+
+    @property
+    def new_serial(self) -> int:
+        return soa_serial(record_rdata(self.new_soa))
+
+
+class Journal:
+    def __init__(self, max_deltas: int = 1000):
+        """In memory journal, the oldest deltas of a zone are dropped past max_deltas
+        """
+
+        self._max_deltas = max_deltas
+        self._deltas: 'dict[str, list[Delta]]' = {}
+
+    def append(self, apex: str, delta: 'Delta') -> None:
+        deltas = self._deltas.setdefault(apex, [])
+        deltas.append(delta)
+
+        if len(deltas) > self._max_deltas:
+            del deltas[:len(deltas) - self._max_deltas]
+
+    def deltas(self, apex: str) -> 'list[Delta]':
+        return self._deltas.get(apex, [])
+
+    def deltas_since(self, apex: str, serial: int) -> 'list[Delta]':
+        """The chain of deltas from serial to the newest one,
+        None when the journal does not reach back to serial
+        """
+
+        deltas = self._deltas.get(apex, [])
+
+        for start, delta in enumerate(deltas):
+            if delta.old_serial == serial:
+                chain = deltas[start:]
+                break
+        else:
+            return None
+
+        for previous, delta in zip(chain, chain[1:]):
+            if previous.new_serial != delta.old_serial:
+                return None
+
+        return chain
+
+
+def _encode_entry(apex: str, delta: 'Delta') -> bytes:
+    apex_bytes = apex.encode()
+    payload = bytearray(len(apex_bytes).to_bytes(1, "big") + apex_bytes)
+
+    for record in (delta.old_soa, delta.new_soa):
+        payload += len(record).to_bytes(2, "big") + record
+
+    for records in (delta.deleted, delta.added):
+        payload += len(records).to_bytes(4, "big")
+
+        for record in records:
+            payload += len(record).to_bytes(2, "big") + record
+
+    return len(payload).to_bytes(4, "big") + zlib.crc32(payload).to_bytes(4, "big") + payload
+
+
+def _decode_entry(payload: bytes) -> 'tuple[str, Delta]':
+    apex_length = payload[0]
+    apex = payload[1:1+apex_length].decode()
+    offset = 1 + apex_length
+
+    def read_record():
+        nonlocal offset
+        length = int.from_bytes(payload[offset:offset+2], "big")
+        record = bytes(payload[offset+2:offset+2+length])
+        offset += 2 + length
+        return record
+
+    def read_records():
+        nonlocal offset
+        count = int.from_bytes(payload[offset:offset+4], "big")
+        offset += 4
+        return [read_record() for _ in range(count)]
+
+    old_soa = read_record()
+    new_soa = read_record()
+    deleted = read_records()
+    added = read_records()
+
+    return apex, Delta(old_soa, new_soa, deleted, added)
+
+
+def read_entries(path: str) -> 'tuple[list[tuple[str, Delta]], int]':
+    """Every intact entry of a journal file and the length of the file they fill
+    """
+
+    entries = []
+
+    try:
+        with open(path, "rb") as journal_file:
+            data = journal_file.read()
+    except FileNotFoundError:
+        return entries, 0
+
+    offset = 0
+
+    while offset + 8 <= len(data):
+        length = int.from_bytes(data[offset:offset+4], "big")
+        checksum = int.from_bytes(data[offset+4:offset+8], "big")
+        payload = data[offset+8:offset+8+length]
+
+        if len(payload) != length or zlib.crc32(payload) != checksum:
+            break
+
+        entries.append(_decode_entry(payload))
+        offset += 8 + length
+
+    return entries, offset
+
+
+class FileJournal(Journal):
+    def __init__(self, path: str, fsync_interval: float = 0.05, max_deltas: int = 1000):
+        """Journal that is also appended to a file.
+
+        Args:
+            path (str): Journal file, created when missing
+            fsync_interval (float): Most seconds an appended entry waits for its fsync
+            max_deltas (int): Deltas kept per zone, in memory and when the file is compacted
+        """
+
+        super().__init__(max_deltas)
+
+        self._path = path
+        self._fsync_interval = fsync_interval
+
+        entries, valid_length = read_entries(path)
+        changes = [(apex, delta) for apex, delta in entries if not delta.is_snapshot]
+
+        for apex, delta in changes:
+            super().append(apex, delta)
+
+        self._entries = entries
+
+        # Snapshots are only written by compact, there are deltas to drop
+        # once more are read than are kept
+
+        self.needs_compaction = sum(len(deltas) for deltas in self._deltas.values()) < len(changes)
+
+        if valid_length != self._file_size():
+
+            # Drop a torn entry left by a crash in the middle of a write
+
+            os.truncate(path, valid_length)
+
+        # Unbuffered, every entry reaches the kernel in a single write
+
+        self._file = open(path, "ab", buffering=0)
+
+        self._dirty = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._flush_loop, name="journal-fsync", daemon=True)
+        self._thread.start()
+
+    def _file_size(self) -> int:
+        try:
+            return os.path.getsize(self._path)
+        except FileNotFoundError:
+            return 0
+
+    def apexes(self) -> 'set[str]':
+        """Every zone the file holds entries of
+        """
+
+        return {apex for apex, _ in self._entries}
+
+    def compact(self, snapshots: 'dict[str, Delta]') -> None:
+        """Rewrite the file with the deltas kept in memory, each zone's
+        followed by its snapshot, see the top of the module. Called once
+        the entries read have been replayed, before any is appended.
+
+        Args:
+            snapshots (dict[str, Delta]): Snapshot of every zone by apex, zones
+                without one keep their deltas alone
+        """
+
+        # A name of its own, a fixed one would be shared by any other process
+        # compacting the same journal
+
+        descriptor, temporary_path = tempfile.mkstemp(
+            prefix=os.path.basename(self._path) + ".", suffix=".tmp", dir=os.path.dirname(self._path) or "."
+        )
+
+        try:
+            with open(descriptor, "wb") as journal_file:
+                for apex in self._deltas.keys() | snapshots.keys():
+                    for delta in self._deltas.get(apex, []):
+                        journal_file.write(_encode_entry(apex, delta))
+
+                    if apex in snapshots:
+                        journal_file.write(_encode_entry(apex, snapshots[apex]))
+
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+
+            os.replace(temporary_path, self._path)
+        except OSError:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+
+        self._file.close()
+        self._file = open(self._path, "ab", buffering=0)
+        self.needs_compaction = False
+
+    def entries(self) -> 'list[tuple[str, Delta]]':
+        """Entries read from the file when it was opened, oldest first
+        """
+
+        return self._entries
+
+    def append(self, apex: str, delta: 'Delta') -> None:
+        self._file.write(_encode_entry(apex, delta))
+        super().append(apex, delta)
+        self._dirty.set()
+
+    def _flush_loop(self) -> None:
+        while not self._stop.is_set():
+            self._dirty.wait()
+            self._dirty.clear()
+            os.fsync(self._file.fileno())
+
+            # Entries appended while waiting share the next fsync
+
+            self._stop.wait(self._fsync_interval)
+
+    def close(self) -> None:
+        self._stop.set()
+        self._dirty.set()
+        self._thread.join()
+        os.fsync(self._file.fileno())
+        self._file.close()
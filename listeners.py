@@ -0,0 +1,218 @@
+import selectors
+import socket
+
+# UDP listening sockets for every configured address, served from a single
+# thread. All sockets are non blocking and registered with one selector
+# (epoll on Linux), and every readiness event drains the socket so a burst
+# is served without going back to the selector between packets.
+
+# IPV6_V6ONLY is always set explicitly instead of trusting the
+# net.ipv6.bindv6only sysctl. With it on, "[::]:53" and "0.0.0.0:53" can be
+# bound side by side; with it off "[::]:53" alone accepts both families and
+# IPv4 clients show up as ::ffff:a.b.c.d.
+
+# Packets read from one socket before checking the others again
+MAX_DRAIN = 64
+
+
+def parse_endpoint(endpoint: str, default_port: int = 53) -> 'tuple[str, int]':
+    """Split "host:port" into its parts. Ex: "0.0.0.0:53", "[::]:5353", "::1", "127.0.0.1"
+    """
+
+    if endpoint.startswith("["):
+        host, _, rest = endpoint[1:].partition("]")
+        port = rest[1:] if rest.startswith(":") else ""
+    elif endpoint.count(":") == 1:
+        host, _, port = endpoint.partition(":")
+    else:
+        host, port = endpoint, ""
+
+    return host, int(port) if port else default_port
+
+
+def open_udp_socket(host: str, port: int, v6only: bool = True, rcvbuf: int = None, sndbuf: int = None, reuse_port: bool = False) -> 'socket.socket':
+    """Bind a non blocking UDP socket.
+
+    Args:
+        host (str): Address to bind, IPv4 or IPv6. Ex: '0.0.0.0', '::'
+        port (int): Port to bind
+        v6only (bool): For IPv6 sockets, refuse IPv4 mapped traffic
+        rcvbuf (int): SO_RCVBUF in bytes, kernel default when None
+        sndbuf (int): SO_SNDBUF in bytes, kernel default when None
+        reuse_port (bool): Set SO_REUSEPORT so several processes can bind the same address
+    """
+
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+
+    try:
+        if family == socket.AF_INET6:
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1 if v6only else 0)
+
+        # Linux doubles the value and caps it at net.core.rmem_max / wmem_max
+
+        if rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+
+        if sndbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        sock.bind((host, port))
+        sock.setblocking(False)
+    except OSError:
+        sock.close()
+        raise
+
+    return sock
+
+
+def open_tcp_socket(host: str, port: int, v6only: bool = True, backlog: int = 128) -> 'socket.socket':
+    """Bind and listen on a non blocking TCP socket, see open_udp_socket
+    """
+
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+
+    sock = socket.socket(family, socket.SOCK_STREAM)
+
+    try:
+        if family == socket.AF_INET6:
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1 if v6only else 0)
+
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        sock.listen(backlog)
+        sock.setblocking(False)
+    except OSError:
+        sock.close()
+        raise
+
+    return sock
+
+
+class UdpListeners:
+    def __init__(self, buffer_size: int = 65535):
+        """Every UDP socket the server answers on. Other sockets, like TCP
+        listeners and connections, can share the selector through register().
+
+        Args:
+            buffer_size (int): Largest datagram read from a socket
+        """
+
+        self._buffer_size = buffer_size
+        self._selector = selectors.DefaultSelector()
+        self._sockets: 'list[socket.socket]' = []
+
+    @property
+    def sockets(self) -> 'list[socket.socket]':
+        return self._sockets
+
+    def add(self, sock: 'socket.socket') -> None:
+        sock.setblocking(False)
+        self._sockets.append(sock)
+        self._selector.register(sock, selectors.EVENT_READ)
+
+    def register(self, fileobj, callback, events: int = selectors.EVENT_READ) -> None:
+        """Call callback(fileobj) from poll() whenever fileobj is ready for events
+        """
+
+        self._selector.register(fileobj, events, callback)
+
+    def modify(self, fileobj, callback, events: int) -> None:
+        self._selector.modify(fileobj, events, callback)
+
+    def unregister(self, fileobj) -> None:
+        self._selector.unregister(fileobj)
+
+    def renew_selector(self) -> None:
+        """Move every registration to a new selector, in a forked worker.
+        An epoll instance made before fork is one kernel object shared with
+        every child, sockets a worker registered would wake the others.
+        """
+
+        old_selector = self._selector
+        self._selector = selectors.DefaultSelector()
+
+        for key in old_selector.get_map().values():
+            self._selector.register(key.fileobj, key.events, key.data)
+
+        old_selector.close()
+
+    def bind(self, host: str, port: int, **socket_options) -> 'socket.socket':
+        sock = open_udp_socket(host, port, **socket_options)
+        self.add(sock)
+        return sock
+
+    def poll(self, handler, timeout: float = None, batch_handler=None) -> int:
+        """Wait for traffic and hand every waiting datagram to handler(data, addr, sock).
+        With batch_handler, the datagrams drained from a socket go to
+        batch_handler(batch, sock) at once instead, as (data, addr) pairs.
+        Returns how many datagrams were handled.
+        """
+
+        handled = 0
+
+        for key, _ in self._selector.select(timeout):
+            sock = key.fileobj
+
+            if key.data is not None:
+
+                # Streams and the control socket, one failing must not stop the loop either
+
+                try:
+                    key.data(sock)
+                except Exception as error:
+                    print("Failed to handle {!r}: {!r}".format(sock, error))
+
+                continue
+
+            batch = []
+
+            for _ in range(MAX_DRAIN):
+                try:
+                    data, addr = sock.recvfrom(self._buffer_size)
+                except (BlockingIOError, InterruptedError):
+                    break
+                except ConnectionRefusedError:
+
+                    # An ICMP port unreachable from an earlier reply, nothing to read
+
+                    continue
+
+                handled += 1
+
+                if batch_handler is not None:
+                    batch.append((bytearray(data), addr))
+                    continue
+
+                try:
+                    handler(bytearray(data), addr, sock)
+                except BlockingIOError:
+
+                    # Send buffer full, the reply is dropped like the kernel would drop it
+
+                    pass
+                except Exception as error:
+
+                    # One bad datagram must not stop the loop serving every other socket
+
+                    print("Failed to handle a datagram from {}: {!r}".format(addr, error))
+
+            if batch:
+                try:
+                    batch_handler(batch, sock)
+                except Exception as error:
+                    print("Failed to handle a batch of {} datagrams: {!r}".format(len(batch), error))
+
+        return handled
+
+    def close(self) -> None:
+        for sock in self._sockets:
+            self._selector.unregister(sock)
+            sock.close()
+
+        self._sockets = []
+        self._selector.close()
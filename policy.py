@@ -0,0 +1,308 @@
+import array
+import bisect
+import hashlib
+import mmap
+import os
+import sys
+import time
+from enum import Enum
+
+# Response policy (RPZ-like) blocklists.
+
+# https://datatracker.ietf.org/doc/html/draft-vixie-dnsop-dns-rpz-00
+
+# Lists with millions of names are too big to keep as a set of python
+# strings (roughly 80-100 bytes per entry). Instead every name is reduced
+# to a 64 bit BLAKE2 digest and the digests are kept in a sorted packed
+# array, 8 bytes per entry. Membership is a binary search with bisect.
+
+# A compiled list can be written to disk and mmap'd back in, so loading
+# is instant and the pages are shared between every process that maps it.
+# Compile a text list, then point a blocklist with compiled = true at it:
+
+# python policy.py compile blocklist.txt blocklist.hpol
+
+# The compiled file replaces OUT in one rename, so servers that still map
+# the old file keep reading it until they reload.
+
+# +--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+
+# |              MAGIC "HPOL" (4 bytes)           |
+# +--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+
+# |         EXACT COUNT (8 bytes, native)         |
+# +--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+
+# |        WILDCARD COUNT (8 bytes, native)       |
+# +--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+
+# /    EXACT DIGESTS (8 bytes each, sorted)       /
+# +--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+
+# /   WILDCARD DIGESTS (8 bytes each, sorted)     /
+# +--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+
+
+POLICY_FILE_MAGIC = b"HPOL"
+
+POLICY_FILE_HEADER_SIZE = 4 + 8 + 8
+
+
+class PolicyAction(Enum):
+    NXDOMAIN = 0  # Answer with a name error
+    NODATA = 1  # Answer with no error and no records
+    FIXED_ANSWER = 2  # Answer A queries with a fixed address
+
+
+def name_digest(domain: str) -> int:
+    """64 bit digest of a domain name. Case and the trailing dot are ignored.
+    """
+    return int.from_bytes(
+        hashlib.blake2b(
+            domain.lower().rstrip(".").encode(), digest_size=8
+        ).digest(),
+        "big"
+    )
+
+
+def _sorted_digests(digests) -> 'array.array':
+    return array.array("Q", sorted(set(digests)))
+
+
+def _contains(digests, digest: int) -> bool:
+    index = bisect.bisect_left(digests, digest)
+    return index < len(digests) and digests[index] == digest
+
+
+class PolicyList:
+    def __init__(self, action: 'PolicyAction', exact, wildcard, answer: bytes = None):
+        """A single blocklist. Every name in the list triggers the same action.
+
+        Args:
+            action (PolicyAction): What to answer when a name matches
+            exact: Sorted sequence of 64 bit digests for exact names
+            wildcard: Sorted sequence of 64 bit digests for "*.domain" entries,
+                the digest is of "domain" and matches any name below it
+            answer (bytes): The address for FIXED_ANSWER. Ex: b'127.0.0.1'
+        """
+
+        if action == PolicyAction.FIXED_ANSWER and answer is None:
+            raise ValueError("FIXED_ANSWER policies need an answer")
+
+        self._action = action
+        self._exact = exact
+        self._wildcard = wildcard
+        self._answer = answer
+        self._mmap = None
+
+    @classmethod
+    def from_names(cls, names, action: 'PolicyAction', answer: bytes = None) -> 'PolicyList':
+        exact = []
+        wildcard = []
+
+        for name in names:
+            name = name.strip()
+
+            if not name or name.startswith("#"):
+                continue
+
+            if name.startswith("*."):
+                wildcard.append(name_digest(name[2:]))
+            else:
+                exact.append(name_digest(name))
+
+        return cls(action, _sorted_digests(exact), _sorted_digests(wildcard), answer)
+
+    @classmethod
+    def load(cls, path: str, action: 'PolicyAction', answer: bytes = None) -> 'PolicyList':
+        """Load a text blocklist with one domain or "*.domain" per line.
+        Lines starting with # are ignored.
+        """
+
+        with open(path, "r") as list_file:
+            return cls.from_names(list_file, action, answer)
+
+    @classmethod
+    def open(cls, path: str, action: 'PolicyAction', answer: bytes = None) -> 'PolicyList':
+        """Map a list compiled with save() without copying it into memory.
+        """
+
+        with open(path, "rb") as list_file:
+            mapped = mmap.mmap(list_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if mapped[:4] != POLICY_FILE_MAGIC:
+            mapped.close()
+            raise ValueError("{} is not a compiled policy list".format(path))
+
+        header = memoryview(mapped)[4:POLICY_FILE_HEADER_SIZE].cast("Q")
+        exact_count, wildcard_count = header[0], header[1]
+        header.release()
+
+        digests = memoryview(mapped)[POLICY_FILE_HEADER_SIZE:].cast("Q")
+
+        policy_list = cls(
+            action,
+            digests[:exact_count],
+            digests[exact_count:exact_count + wildcard_count],
+            answer
+        )
+
+        policy_list._mmap = mapped
+
+        return policy_list
+
+    def save(self, path: str) -> None:
+        with open(path, "wb") as list_file:
+            list_file.write(POLICY_FILE_MAGIC)
+            array.array("Q", [len(self._exact), len(self._wildcard)]).tofile(list_file)
+            list_file.write(memoryview(self._exact).cast("B"))
+            list_file.write(memoryview(self._wildcard).cast("B"))
+
+    def compile(self, path: str) -> None:
+        """save() to a temporary file renamed over path, for files in use
+        """
+
+        temporary_path = "{}.{}.tmp".format(path, os.getpid())
+
+        try:
+            self.save(temporary_path)
+            os.replace(temporary_path, path)
+        except OSError:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+
+    @property
+    def action(self) -> 'PolicyAction':
+        return self._action
+
+    @property
+    def answer(self) -> bytes:
+        return self._answer
+
+    @property
+    def nbytes(self) -> int:
+        return 8 * (len(self._exact) + len(self._wildcard))
+
+    def __len__(self) -> int:
+        return len(self._exact) + len(self._wildcard)
+
+    def matches(self, digests: 'list[int]') -> bool:
+        """Check a name against the list.
+
+        Args:
+            digests (list[int]): Digests of the name followed by each of its
+                parent domains, as returned by PolicyEngine.name_digests
+        """
+
+        if _contains(self._exact, digests[0]):
+            return True
+
+        # Most specific wildcard first. A wildcard never matches its own apex.
+
+        for digest in digests[1:]:
+            if _contains(self._wildcard, digest):
+                return True
+
+        return False
+
+
+class PolicyEngine:
+    def __init__(self, policy_lists: 'list[PolicyList]' = None):
+        """Ordered collection of policy lists. The first list that matches
+        decides the action, like RPZ zone precedence.
+        """
+
+        self._lists: 'list[PolicyList]' = list(policy_lists or [])
+
+    def add(self, policy_list: 'PolicyList') -> None:
+        self._lists.append(policy_list)
+
+    @property
+    def lists(self) -> 'list[PolicyList]':
+        return self._lists
+
+    @staticmethod
+    def name_digests(domain: str) -> 'list[int]':
+        labels = domain.lower().rstrip(".").split(".")
+
+        return [name_digest(".".join(labels[i:])) for i in range(len(labels))]
+
+    def lookup(self, domain: str) -> 'PolicyList':
+        """Returns the first list that matches the domain, or None
+        """
+
+        if not self._lists:
+            return None
+
+        digests = self.name_digests(domain)
+
+        for policy_list in self._lists:
+            if policy_list.matches(digests):
+                return policy_list
+
+        return None
+
+
+def _compile_command(source: str, destination: str) -> None:
+    start = time.perf_counter()
+
+    # The action is not stored in compiled files, the configuration gives it
+
+    policy_list = PolicyList.load(source, PolicyAction.NXDOMAIN)
+    policy_list.compile(destination)
+
+    print("compiled {} names into {} ({:.1f} MB) in {:.3f} s".format(
+        len(policy_list), destination, policy_list.nbytes / 1e6, time.perf_counter() - start))
+
+
+if __name__ == "__main__" and sys.argv[1:2] == ["compile"]:
+
+    # Usage: python policy.py compile IN OUT
+
+    if len(sys.argv) != 4:
+        sys.exit("Usage: python policy.py compile IN OUT")
+
+    _compile_command(sys.argv[2], sys.argv[3])
+
+elif __name__ == "__main__":
+
+    # Load and lookup benchmark. Usage: python policy.py [NAME_COUNT]
+
+    import tempfile
+
+    name_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+
+    names = [
+        "host{}.zone{}.example".format(i, i % 5000) if i % 10 else "*.wild{}.example".format(i)
+        for i in range(name_count)
+    ]
+
+    start = time.perf_counter()
+    blocklist = PolicyList.from_names(names, PolicyAction.NXDOMAIN)
+    build_seconds = time.perf_counter() - start
+
+    set_bytes = sys.getsizeof(set(names)) + sum(sys.getsizeof(name) for name in names)
+
+    compiled_path = os.path.join(tempfile.mkdtemp(), "blocklist.hpol")
+    blocklist.save(compiled_path)
+
+    start = time.perf_counter()
+    mapped_list = PolicyList.open(compiled_path, PolicyAction.NXDOMAIN)
+    open_seconds = time.perf_counter() - start
+
+    engine = PolicyEngine([mapped_list])
+
+    lookups = 200000
+    queries = [
+        "host{}.zone{}.example".format(i, i % 5000) if i % 2 else "miss{}.example".format(i)
+        for i in range(1, lookups + 1)
+    ]
+
+    start = time.perf_counter()
+    hits = sum(1 for query in queries if engine.lookup(query) is not None)
+    lookup_seconds = time.perf_counter() - start
+
+    print("names:            {}".format(name_count))
+    print("build from text:  {:.3f} s".format(build_seconds))
+    print("mmap open:        {:.6f} s".format(open_seconds))
+    print("packed size:      {:.1f} MB".format(blocklist.nbytes / 1e6))
+    print("set of str size:  {:.1f} MB".format(set_bytes / 1e6))
+    print("lookups:          {} ({} hits)".format(lookups, hits))
+    print("lookup cost:      {:.2f} us".format(lookup_seconds / lookups * 1e6))
+
+    os.remove(compiled_path)
@@ -0,0 +1,158 @@
+import collections
+import os
+import signal
+import tempfile
+import threading
+import time
+
+# On demand profiling of a running worker.
+
+# SamplingProfiler interrupts the process with SIGPROF every interval of
+# CPU time and counts the stack it interrupted. The packet loop runs in the
+# main thread, which is where Python delivers signals, so every sample is
+# a stack of main_loop, request_handler and whatever they were running.
+# Time spent waiting in select costs no CPU and is not sampled. Stacks are
+# written in the collapsed format flamegraph.pl and speedscope read:
+
+# hamurai.py:<module>;hamurai.py:main_loop;listeners.py:poll;req_handler.py:request_handler 42
+
+# https://github.com/brendangregg/FlameGraph
+
+# StageTracer adds up the time every query spends in each stage of the
+# query path. The hooks in req_handler test one module global for None,
+# so they cost next to nothing while tracing is off and can stay in.
+
+# parse     header, question and OPT record
+# dispatch  view selection and cache key
+# handler   failed cache lookup and build_response, misses only
+# encode    response copied from its cache template, or stored as one
+# send      sendto, UDP only
+
+PARSE = 0
+DISPATCH = 1
+HANDLER = 2
+ENCODE = 3
+SEND = 4
+
+STAGES = ("parse", "dispatch", "handler", "encode", "send")
+
+
+def _frame_label(frame) -> str:
+    return "{}:{}".format(os.path.basename(frame.f_code.co_filename), frame.f_code.co_name)
+
+
+class SamplingProfiler:
+    def __init__(self, interval: float = 0.005, output_dir: str = ""):
+        """Args:
+            interval (float): Seconds of CPU time between samples
+            output_dir (str): Where profiles are written, the temporary directory when empty
+        """
+
+        self._interval = interval
+        self._output_dir = output_dir or tempfile.gettempdir()
+        self._counts: 'collections.Counter[str]' = collections.Counter()
+        self._timer: 'threading.Timer' = None
+        self._path: str = None
+
+    @property
+    def running(self) -> bool:
+        return self._timer is not None
+
+    def install(self) -> None:
+        """Install the SIGPROF handler, from the main thread
+        """
+
+        signal.signal(signal.SIGPROF, self._sample)
+
+    def _sample(self, signum, frame) -> None:
+        stack = []
+
+        while frame is not None:
+            stack.append(_frame_label(frame))
+            frame = frame.f_back
+
+        stack.reverse()
+        self._counts[";".join(stack)] += 1
+
+    def start(self, seconds: float) -> str:
+        """Sample for seconds, then write the profile. Returns the path it is
+        written to, or None when a profile is already running
+        """
+
+        if self._timer is not None:
+            return None
+
+        self._counts = collections.Counter()
+        self._path = os.path.join(
+            self._output_dir,
+            "hamurai-{}-{}.folded".format(os.getpid(), time.strftime("%Y%m%d-%H%M%S"))
+        )
+
+        self._timer = threading.Timer(seconds, self.stop)
+        self._timer.daemon = True
+        self._timer.start()
+
+        signal.setitimer(signal.ITIMER_PROF, self._interval, self._interval)
+
+        return self._path
+
+    def stop(self) -> str:
+        """Stop sampling and write the collapsed stacks. Returns the path written
+        """
+
+        signal.setitimer(signal.ITIMER_PROF, 0)
+
+        if self._timer is None:
+            return None
+
+        self._timer.cancel()
+        self._timer = None
+
+        # The handler may still run once more in the main thread, work on a copy
+
+        counts = dict(self._counts)
+
+        with open(self._path, "w") as profile:
+            for stack, count in sorted(counts.items()):
+                profile.write("{} {}\n".format(stack, count))
+
+        print("Profile of {} samples written to {}".format(sum(counts.values()), self._path))
+
+        return self._path
+
+
+class StageTracer:
+    def __init__(self):
+        self._totals = [0] * len(STAGES)
+        self._counts = [0] * len(STAGES)
+        self._maximums = [0] * len(STAGES)
+        self._last = 0
+
+    def begin(self) -> None:
+        self._last = time.perf_counter_ns()
+
+    def mark(self, stage: int) -> None:
+        """Charge the time since the previous mark to stage
+        """
+
+        now = time.perf_counter_ns()
+        elapsed = now - self._last
+        self._last = now
+
+        self._totals[stage] += elapsed
+        self._counts[stage] += 1
+
+        if elapsed > self._maximums[stage]:
+            self._maximums[stage] = elapsed
+
+    def report(self) -> str:
+        lines = ["{:<9} {:>10} {:>10} {:>10}".format("stage", "count", "mean us", "max us")]
+
+        for stage, name in enumerate(STAGES):
+            count = self._counts[stage]
+            mean = self._totals[stage] / count / 1000 if count else 0
+
+            lines.append("{:<9} {:>10} {:>10.2f} {:>10.2f}".format(
+                name, count, mean, self._maximums[stage] / 1000))
+
+        return "\n".join(lines)
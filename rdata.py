@@ -1,4 +1,5 @@
 from enum import Enum
+import socket
 import util
 
 
@@ -6,6 +7,7 @@ class RdataType(Enum):
     RAW = 0
     IPV4 = 1
     DOMAIN = 2
+    IPV6 = 3
 
 
 class Rdata:
@@ -20,7 +22,7 @@ class Rdata:
 
         Args:
             rdata_type (RdataType):  Is the value an ip address or domain?
-            value (bytes): The value as bytes which represents a domain or ipv4 address. Ex: b'127.0.0.1', b'website.com'
+            value (bytes): The value as bytes which represents a domain or ipv4 address. Ex: b'127.0.0.1', b'::1', b'website.com'
         """
 
         self._type = rdata_type
@@ -43,6 +45,8 @@ class Rdata:
             for octet_str in self._value.decode("utf-8").split("."):
                 ip_bytes.append(int(octet_str))
             return util.create_ipv4_address_rdata(ip_bytes)
+        elif self._type.name == "IPV6":
+            return bytearray(socket.inet_pton(socket.AF_INET6, self._value.decode("utf-8")))
         elif self._type.name == "RAW":
             return self._value
 
@@ -0,0 +1,478 @@
+import argparse
+import json
+import socket
+import struct
+import threading
+import time
+
+import dns_header
+import resource_record
+import util
+
+# Replays real query traffic against the request handler, in process or
+# over UDP against a running hamurai.py, and reports throughput, latency
+# percentiles, loss and answers whose RCODE differs from the expected one.
+
+# Inputs are pcap or pcapng captures (Ethernet, Linux cooked, loopback or
+# raw IP link types, IPv4 or IPv6, UDP) or a JSON lines query log:
+
+# {"ts": 1697250000.125, "name": "www.ricklantis.com", "type": "A", "rcode": "NOERROR"}
+
+# "ts" and "rcode" are optional. In captures the expected RCODE is taken
+# from the server's reply to the same client port and transaction ID.
+
+# python replay.py traffic.pcap --target 127.0.0.1:5353 --speed 2
+# python replay.py queries.jsonl --in-process -c hamurai.toml --speed 0
+
+RCODE_NAMES = {
+    "NOERROR": 0,
+    "FORMERR": 1,
+    "SERVFAIL": 2,
+    "NXDOMAIN": 3,
+    "NOTIMP": 4,
+    "REFUSED": 5,
+}
+
+ETHERNET_TYPES = {0x0800: 4, 0x86DD: 6}
+
+
+class ReplayQuery:
+    def __init__(self, timestamp: float, packet: bytes, expected_rcode: int = None):
+        self.timestamp = timestamp
+        self.packet = packet
+        self.expected_rcode = expected_rcode
+
+
+def build_query(name: str, rr_type: 'resource_record.RrType', transaction_id: int = 0) -> bytes:
+    head = dns_header.DnsHeaderSection(bytearray(12))
+    head.transaction_id = transaction_id
+    head.question_count = 1
+    head.recursion_desired = True
+
+    return bytes(head.bytes) + bytes(util.domain_to_label(name)) + \
+        rr_type.value.to_bytes(2, "big") + resource_record.RrClass.IN.value.to_bytes(2, "big")
+
+
+def read_query_log(path: str) -> 'list[ReplayQuery]':
+    """Queries of a JSON lines log. Lines that are not JSON, or name an
+    unknown type or RCODE, are skipped like frames a capture can not parse,
+    and counted in a warning
+    """
+
+    queries = []
+    skipped = []
+
+    with open(path, "r") as log_file:
+        for index, line in enumerate(log_file):
+            line = line.strip()
+
+            if not line:
+                continue
+
+            try:
+                entry = json.loads(line)
+                rcode = entry.get("rcode")
+
+                if isinstance(rcode, str):
+                    rcode = RCODE_NAMES[rcode.upper()]
+
+                queries.append(ReplayQuery(
+                    float(entry.get("ts", index)),
+                    build_query(entry["name"], resource_record.RrType[entry.get("type", "A").upper()]),
+                    rcode
+                ))
+            except (ValueError, KeyError, AttributeError, TypeError):
+                skipped.append(index + 1)
+
+    if skipped:
+        print("Skipped {} unreadable lines of {}, the first is line {}".format(len(skipped), path, skipped[0]))
+
+    return queries
+
+
+def _ip_payload(link_type: int, frame: bytes) -> 'tuple[int, bytes]':
+    """Returns the IP version and the IP packet inside a captured frame
+    """
+
+    if link_type == 1:  # Ethernet
+        offset, ether_type = 12, int.from_bytes(frame[12:14], "big")
+
+        while ether_type in (0x8100, 0x88A8):  # VLAN tags
+            offset += 4
+            ether_type = int.from_bytes(frame[offset:offset+2], "big")
+
+        return ETHERNET_TYPES.get(ether_type, 0), frame[offset+2:]
+
+    if link_type == 113:  # Linux cooked capture
+        return ETHERNET_TYPES.get(int.from_bytes(frame[14:16], "big"), 0), frame[16:]
+
+    if link_type in (0, 108):  # BSD loopback, address family in host order
+        return (frame[4] >> 4), frame[4:]
+
+    if link_type in (101, 12, 14):  # Raw IP
+        return (frame[0] >> 4), frame
+
+    return 0, b""
+
+
+def _udp_datagram(link_type: int, frame: bytes):
+    """Returns (source, destination, source port, destination port, payload) for UDP frames, or None
+    """
+
+    version, packet = _ip_payload(link_type, frame)
+
+    if version == 4 and len(packet) >= 20 and packet[9] == 17:
+        header_length = (packet[0] & 0x0F) * 4
+        source = socket.inet_ntop(socket.AF_INET, packet[12:16])
+        destination = socket.inet_ntop(socket.AF_INET, packet[16:20])
+        udp = packet[header_length:]
+
+    elif version == 6 and len(packet) >= 40 and packet[6] == 17:
+        source = socket.inet_ntop(socket.AF_INET6, packet[8:24])
+        destination = socket.inet_ntop(socket.AF_INET6, packet[24:40])
+        udp = packet[40:]
+
+    else:
+        return None
+
+    if len(udp) < 8:
+        return None
+
+    source_port, destination_port = struct.unpack("!HH", udp[:4])
+
+    return source, destination, source_port, destination_port, udp[8:]
+
+
+def _pcap_frames(capture: bytes):
+    """Yield (timestamp, link type, frame) from a pcap or pcapng file
+    """
+
+    magic = capture[:4]
+
+    if magic in (b"\xd4\xc3\xb2\xa1", b"\x4d\x3c\xb2\xa1", b"\xa1\xb2\xc3\xd4", b"\xa1\xb2\x3c\x4d"):
+        endian = "<" if magic[0] in (0xD4, 0x4D) else ">"
+        divisor = 1e9 if magic in (b"\x4d\x3c\xb2\xa1", b"\xa1\xb2\x3c\x4d") else 1e6
+        link_type = struct.unpack(endian + "I", capture[20:24])[0]
+        offset = 24
+
+        while offset + 16 <= len(capture):
+            seconds, fraction, captured_length, _ = struct.unpack(endian + "IIII", capture[offset:offset+16])
+            offset += 16
+            yield seconds + fraction / divisor, link_type, capture[offset:offset+captured_length]
+            offset += captured_length
+
+        return
+
+    if magic != b"\x0a\x0d\x0d\x0a":
+        raise ValueError("Not a pcap or pcapng capture")
+
+    endian = "<"
+    interfaces: 'list[tuple[int, float]]' = []
+    offset = 0
+
+    while offset + 12 <= len(capture):
+        block_type = struct.unpack(endian + "I", capture[offset:offset+4])[0]
+
+        if block_type == 0x0A0D0D0A:  # Section header, sets the byte order
+            endian = "<" if capture[offset+8:offset+12] == b"\x4d\x3c\x2b\x1a" else ">"
+            interfaces = []
+
+        block_length = struct.unpack(endian + "I", capture[offset+4:offset+8])[0]
+        body = capture[offset+8:offset+block_length-4]
+
+        if block_type == 1:  # Interface description
+            link_type = struct.unpack(endian + "H", body[:2])[0]
+            divisor = 1e6
+
+            # if_tsresol option
+            option_offset = 8
+            while option_offset + 4 <= len(body):
+                code, length = struct.unpack(endian + "HH", body[option_offset:option_offset+4])
+                if code == 0:
+                    break
+                if code == 9 and length >= 1:
+                    resolution = body[option_offset+4]
+                    divisor = float(2 ** (resolution & 0x7F) if resolution & 0x80 else 10 ** resolution)
+                option_offset += 4 + (length + 3) // 4 * 4
+
+            interfaces.append((link_type, divisor))
+
+        elif block_type == 6:  # Enhanced packet
+            interface, high, low, captured_length = struct.unpack(endian + "IIII", body[:16])
+            link_type, divisor = interfaces[interface]
+            yield ((high << 32) | low) / divisor, link_type, body[20:20+captured_length]
+
+        elif block_type == 3 and interfaces:  # Simple packet, no timestamp
+            link_type, _ = interfaces[0]
+            yield 0.0, link_type, body[4:]
+
+        offset += block_length
+
+
+def read_capture(path: str, port: int = 53) -> 'list[ReplayQuery]':
+    with open(path, "rb") as capture_file:
+        capture = capture_file.read()
+
+    queries: 'list[ReplayQuery]' = []
+    pending: 'dict[tuple[str, int, int], ReplayQuery]' = {}
+
+    for timestamp, link_type, frame in _pcap_frames(capture):
+        datagram = _udp_datagram(link_type, frame)
+
+        if datagram is None:
+            continue
+
+        source, destination, source_port, destination_port, payload = datagram
+
+        if len(payload) < 12:
+            continue
+
+        transaction_id = int.from_bytes(payload[:2], "big")
+        is_response = payload[2] & 0b10000000
+
+        if destination_port == port and not is_response:
+            query = ReplayQuery(timestamp, payload)
+            queries.append(query)
+            pending[(source, source_port, transaction_id)] = query
+
+        elif source_port == port and is_response:
+            query = pending.pop((destination, destination_port, transaction_id), None)
+
+            if query is not None:
+                query.expected_rcode = payload[3] & 0x0F
+
+    return queries
+
+
+def read_queries(path: str, port: int = 53) -> 'list[ReplayQuery]':
+    if path.endswith((".jsonl", ".json")):
+        return read_query_log(path)
+
+    return read_capture(path, port)
+
+
+class ReplayReport:
+    def __init__(self):
+        self.sent = 0
+        self.answered = 0
+        self.rcode_mismatches = 0
+
+        # Queries the handler raised on, in process only, and the first exception
+        self.errors = 0
+        self.first_error: str = None
+
+        self.latencies: 'list[float]' = []
+        self.elapsed = 0.0
+
+    @property
+    def lost(self) -> int:
+        return self.sent - self.answered
+
+    def percentile(self, fraction: float) -> float:
+        if not self.latencies:
+            return 0.0
+
+        ordered = sorted(self.latencies)
+
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    def __str__(self) -> str:
+        return "\n".join([
+            "sent:             {}".format(self.sent),
+            "answered:         {}".format(self.answered),
+            "lost:             {} ({:.2%})".format(self.lost, self.lost / self.sent if self.sent else 0),
+            "rcode mismatches: {}".format(self.rcode_mismatches),
+            "errors:           {}{}".format(self.errors, " (first: {})".format(self.first_error) if self.errors else ""),
+            "elapsed:          {:.3f} s".format(self.elapsed),
+            "qps:              {:.0f}".format(self.answered / self.elapsed if self.elapsed else 0),
+            "latency p50:      {:.1f} us".format(self.percentile(0.50) * 1e6),
+            "latency p90:      {:.1f} us".format(self.percentile(0.90) * 1e6),
+            "latency p99:      {:.1f} us".format(self.percentile(0.99) * 1e6),
+            "latency p99.9:    {:.1f} us".format(self.percentile(0.999) * 1e6),
+            "latency max:      {:.1f} us".format(max(self.latencies, default=0) * 1e6),
+        ])
+
+
+def _schedule(queries: 'list[ReplayQuery]', speed: float):
+    """Yield queries at their original spacing divided by speed, 0 means no waiting
+    """
+
+    if not queries:
+        return
+
+    first = queries[0].timestamp
+    started = time.perf_counter()
+
+    for query in queries:
+        if speed > 0:
+            delay = (query.timestamp - first) / speed - (time.perf_counter() - started)
+            if delay > 0:
+                time.sleep(delay)
+
+        yield query
+
+
+class _CaptureSocket:
+    def __init__(self):
+        self.response = None
+
+    def sendto(self, data, addr) -> None:
+        self.response = data
+
+
+def replay_in_process(queries: 'list[ReplayQuery]', speed: float = 0) -> 'ReplayReport':
+    import req_handler
+
+    report = ReplayReport()
+    capture_socket = _CaptureSocket()
+    client = ("127.0.0.1", 40000)
+    started = time.perf_counter()
+
+    for query in _schedule(queries, speed):
+        capture_socket.response = None
+        report.sent += 1
+
+        query_started = time.perf_counter()
+
+        # One packet the handler raises on is counted, the rest still replay
+
+        try:
+            req_handler.request_handler(bytearray(query.packet), client, capture_socket)
+        except Exception as error:
+            report.errors += 1
+
+            if report.first_error is None:
+                report.first_error = repr(error)
+
+        report.latencies.append(time.perf_counter() - query_started)
+
+        if capture_socket.response is None:
+            continue
+
+        report.answered += 1
+
+        if query.expected_rcode is not None and capture_socket.response[3] & 0x0F != query.expected_rcode:
+            report.rcode_mismatches += 1
+
+    report.elapsed = time.perf_counter() - started
+
+    return report
+
+
+def replay_udp(queries: 'list[ReplayQuery]', host: str, port: int, speed: float = 0, timeout: float = 2.0) -> 'ReplayReport':
+    """Send every query from one socket and match replies by transaction ID.
+    Queries are renumbered so IDs are unique within any 65536 query window.
+    """
+
+    report = ReplayReport()
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1024 * 1024)
+    sock.connect((host, port))
+    sock.settimeout(0.1)
+
+    # transaction id -> (send time, expected rcode)
+    in_flight: 'dict[int, tuple[float, int]]' = {}
+    lock = threading.Lock()
+    sending_done = threading.Event()
+
+    def receive() -> None:
+        deadline = None
+
+        while True:
+            if sending_done.is_set():
+                if deadline is None:
+                    deadline = time.perf_counter() + timeout
+                with lock:
+                    if not in_flight or time.perf_counter() > deadline:
+                        return
+
+            try:
+                reply = sock.recv(65535)
+            except socket.timeout:
+                continue
+            except ConnectionRefusedError:
+                continue
+
+            received = time.perf_counter()
+
+            with lock:
+                entry = in_flight.pop(int.from_bytes(reply[:2], "big"), None)
+
+            if entry is None:
+                continue
+
+            report.answered += 1
+            report.latencies.append(received - entry[0])
+
+            if entry[1] is not None and len(reply) > 3 and reply[3] & 0x0F != entry[1]:
+                report.rcode_mismatches += 1
+
+    receiver = threading.Thread(target=receive, name="replay-receiver")
+    receiver.start()
+
+    started = time.perf_counter()
+
+    for index, query in enumerate(_schedule(queries, speed)):
+        transaction_id = index & 0xFFFF
+        packet = transaction_id.to_bytes(2, "big") + query.packet[2:]
+
+        with lock:
+            in_flight[transaction_id] = (time.perf_counter(), query.expected_rcode)
+
+        try:
+            sock.send(packet)
+        except OSError:
+            pass
+
+        report.sent += 1
+
+    sending_done.set()
+    receiver.join()
+
+    report.elapsed = time.perf_counter() - started
+    sock.close()
+
+    return report
+
+
+if __name__ == "__main__":
+
+    import listeners
+
+    parser = argparse.ArgumentParser(description="Replay DNS queries and report throughput and latency")
+    parser.add_argument("input", help="pcap, pcapng or JSON lines query log")
+    parser.add_argument("--target", default="127.0.0.1:53", help="Server to query over UDP. Ex: [::1]:5353")
+    parser.add_argument("--in-process", action="store_true", help="Call the request handler directly")
+    parser.add_argument("-c", "--config", help="Server configuration for --in-process")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="Multiple of the original query rate, 0 sends as fast as possible")
+    parser.add_argument("--port", type=int, default=53, help="DNS port to look for in captures")
+    parser.add_argument("--loops", type=int, default=1, help="Replay the input this many times")
+    arguments = parser.parse_args()
+
+    util.debug_labels = False
+
+    queries = read_queries(arguments.input, arguments.port)
+
+    if arguments.loops > 1:
+        span = queries[-1].timestamp - queries[0].timestamp + 1 if queries else 0
+        queries = [
+            ReplayQuery(query.timestamp + loop * span, query.packet, query.expected_rcode)
+            for loop in range(arguments.loops)
+            for query in queries
+        ]
+
+    print("queries:          {}".format(len(queries)))
+
+    if arguments.in_process:
+        import config
+        import hamurai
+
+        hamurai.setup(config.from_args(["--log-every", "0"] + (["-c", arguments.config] if arguments.config else [])))
+        util.debug_labels = False
+
+        print(replay_in_process(queries, arguments.speed))
+    else:
+        host, port = listeners.parse_endpoint(arguments.target)
+        print(replay_udp(queries, host, port, arguments.speed))
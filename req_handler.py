@@ -5,38 +5,493 @@ import handlers.name_error as name_error
 import handlers.a_record as a_record
 import handlers.opt_record as opt_record
 import handlers.not_implemented as not_implemented
+import handlers.no_data as no_data
+import handlers.signed as signed
+import handlers.truncated as truncated
+import handlers.bad_cookie as bad_cookie
+import handlers.format_error as format_error
+import handlers.server_error as server_error
+import analytics
+import cookies
+import policy
+import profiler
+import rrl
+import dnssec
+import edns
+import views
+import update
+import question
+import rrset
+import zone
+import config
+import itertools
 import socket
 
+# Replaced with the validated configuration at startup
 
-def request_handler(data: bytearray, addr, sock: 'socket.socket'):
+server_config = config.ServerConfig()
+
+_query_counter = itertools.count()
+
+# Optional policy.PolicyEngine consulted before any handler runs
+
+response_policy: 'policy.PolicyEngine' = None
+
+# Views pick the zone store and response cache for each client. Without a
+# views.ViewTable every client is answered from default_view.
+
+default_view = views.View("default")
+
+view_table: 'views.ViewTable' = None
+
+# Set to a profiler.StageTracer to time every stage of the query path,
+# None leaves each hook a single comparison
+
+tracer: 'profiler.StageTracer' = None
+
+# Set to an analytics.TrafficAnalytics to count heavy hitters
+
+traffic: 'analytics.TrafficAnalytics' = None
+
+# DNS Cookies are answered with a cookies.CookieJar, and every UDP response
+# is charged to an rrl.ResponseRateLimiter, both off when None
+
+cookie_jar: 'cookies.CookieJar' = None
+
+rate_limiter: 'rrl.ResponseRateLimiter' = None
+
+# CPU "RFC8482" and an empty OS, RFC 8482 section 4.2
+
+ANY_HINFO = b"\x07RFC8482\x00"
+
+
+def policy_handler(req_head: 'dns_header.DnsHeaderSection', first_question, policy_list: 'policy.PolicyList') -> bytearray:
+
+    if policy_list.action == policy.PolicyAction.NXDOMAIN:
+        return name_error.handler(req_head, first_question)
+
+    if policy_list.action == policy.PolicyAction.FIXED_ANSWER and \
+            first_question.qtype.value == resource_record.RrType.A.value:
+        return a_record.handler(req_head, first_question, policy_list.answer)
+
+    return no_data.handler(req_head, first_question)
+
+
+# Values every OPCODE, QTYPE and QCLASS the parsers accept
+
+KNOWN_OPERATION_CODES = {operation_code.value for operation_code in dns_header.OperationCode}
+
+KNOWN_TYPES = {rr_type.value for rr_type in resource_record.RrType}
+
+KNOWN_CLASSES = {rr_class.value for rr_class in resource_record.RrClass}
+
+
+def unparsed_handler(data: bytearray) -> bytearray:
+    """The response to a query whose header or question did not parse.
+    NOTIMP for an OPCODE, QTYPE or QCLASS this server does not know,
+    FORMERR for anything else, RFC 1035 section 4.1.1. None for datagrams
+    too short to answer and for responses, which are never answered
+    """
+
+    if len(data) < 12 or data[2] & 0x80:
+        return None
+
+    question_end = None
+
+    if int.from_bytes(data[4:6], "big") == 1:
+        try:
+            question_end = edns.skip_name(data, 12) + 4
+        except ValueError:
+            pass
+
+        if question_end is not None and question_end > len(data):
+            question_end = None
+
+    rcode = dns_header.Rcode.FORMAT_ERROR
+
+    if data[2] >> 3 & 0xF not in KNOWN_OPERATION_CODES:
+        rcode = dns_header.Rcode.NOT_IMPLEMENTED
+
+    elif question_end is not None and (
+            int.from_bytes(data[question_end-4:question_end-2], "big") not in KNOWN_TYPES or
+            int.from_bytes(data[question_end-2:question_end], "big") not in KNOWN_CLASSES):
+        rcode = dns_header.Rcode.NOT_IMPLEMENTED
+
+    return format_error.raw_handler(data, question_end, rcode)
+
+
+def query_opt(data: bytearray, req_head: 'dns_header.DnsHeaderSection', req_questions: 'question_section.DnsQuestionsSection') -> 'edns.EdnsOpt':
+    """The OPT record of a query, only looked for when views, signing or cookies need it
+    """
+
+    if req_head.additional_record_count == 0 or \
+            (view_table is None and default_view.signer is None and cookie_jar is None):
+        return None
 
-    req_head = dns_header.DnsHeaderSection(data[:12])
+    # The additional section starts after QTYPE and QCLASS of the only question
 
-    req_questions = question_section.DnsQuestionsSection(
-        data[12:], req_head.question_count
+    return edns.parse_opt(
+        data,
+        12 + req_questions.end_of_first_question_offset + 4,
+        req_head.additional_record_count
     )
 
-    first_question = req_questions.first_question
 
-    print(req_head)
+def udp_limit(data: bytearray, req_head: 'dns_header.DnsHeaderSection', req_questions: 'question_section.DnsQuestionsSection', opt: 'edns.EdnsOpt') -> int:
+    """Largest UDP response the client takes, RFC 6891 section 6.2.5. The
+    OPT record is looked for here when query_opt did not need it
+    """
 
-    print(req_questions)
+    if opt is None and req_head.additional_record_count:
+        opt = edns.parse_opt(
+            data,
+            12 + req_questions.end_of_first_question_offset + 4,
+            req_head.additional_record_count
+        )
+
+    if opt is None:
+        return edns.CLASSIC_UDP_SIZE
+
+    return min(opt.udp_payload_size, server_config.edns_udp_size)
+
+
+def any_handler(req_head: 'dns_header.DnsHeaderSection', first_question) -> bytearray:
+    """ANY at a name only the default answer covers, the synthesized HINFO
+    of RFC 8482 section 4.2
+    """
+
+    record_set = rrset.RRset(first_question.domain, resource_record.RrType.HINFO, server_config.default_ttl, [ANY_HINFO])
+
+    return a_record.rrset_handler(req_head, first_question, record_set)
+
+
+def select_view(addr, opt: 'edns.EdnsOpt') -> 'views.View':
+
+    if view_table is None:
+        return default_view
+
+    client_subnet = opt.client_subnet if opt is not None else None
+
+    return view_table.select(addr[0], client_subnet)
+
+
+def client_subnet_reply(opt: 'edns.EdnsOpt') -> bytes:
+    """The client subnet option to echo when it picked the view, with
+    the SCOPE PREFIX-LENGTH the answer holds for, so resolvers cache it
+    for that block only. RFC 7871 section 7.2.1. None without one
+    """
+
+    if view_table is None or opt is None:
+        return None
+
+    client_subnet = opt.client_subnet
+
+    if client_subnet is None:
+        return None
+
+    option = opt.options[edns.OPTION_CLIENT_SUBNET]
+
+    return option[:3] + bytes([view_table.scope(client_subnet)]) + option[4:]
+
+
+def build_response(req_head: 'dns_header.DnsHeaderSection', first_question, view: 'views.View', dnssec_ok: bool = False) -> 'tuple[bytearray, bool]':
+    """Run the handler for the question. Returns the response and
+    whether the same question may be answered from the response cache
+    """
 
     response = bytearray([])
 
-    if not first_question.domain.startswith("ricklantis.com"):
+    policy_match = None
+
+    if response_policy is not None:
+        policy_match = response_policy.lookup(first_question.domain)
+
+    record_set = view.zone_store.get(first_question.domain, first_question.qtype)
+
+    # ANY is answered with one RRset of the name rather than all of them,
+    # so it is no better for amplification than any other query, RFC 8482
+
+    any_query = first_question.qtype.value == resource_record.RrType.ANY.value
+
+    if any_query:
+        record_set = view.zone_store.any_answer(first_question.domain)
+
+    # Zone of the name when the client asked for signatures and the zone is signed
+
+    signed_apex = None
+
+    if dnssec_ok and view.signer is not None:
+        signed_apex = view.zone_store.apex_of(first_question.domain)
+
+        if signed_apex is not None and view.signer.key(signed_apex) is None:
+            signed_apex = None
+
+    default_address = first_question.qtype.value == resource_record.RrType.A.value and \
+        first_question.domain.startswith(server_config.zone_suffix)
+
+    if policy_match is not None:
+        response = policy_handler(req_head, first_question, policy_match)
+
+    elif record_set is not None and signed_apex is not None:
+        answer_count, answer_section = record_set.next_answer()
+
+        response = signed.handler(
+            req_head,
+            first_question,
+            answer_count,
+            answer_section,
+            view.signer.signed_rrset(signed_apex, record_set),
+            dnssec.opt_record()
+        )
+
+        return response, len(record_set) == 1
+
+    elif signed_apex is not None and default_address:
+        address = server_config.default_answer.encode()
+        answer = a_record.record(first_question, address, server_config.default_ttl)
+
+        # Signed over the lowercased name, validators compare names in canonical form
+
+        record = a_record.record(
+            question.DnsQuestion(zone.normalize(first_question.domain), resource_record.RrType.A, resource_record.RrClass.IN),
+            address,
+            server_config.default_ttl
+        )
+
+        response = signed.handler(
+            req_head,
+            first_question,
+            1,
+            answer,
+            view.signer.rrsig(signed_apex, zone.normalize(first_question.domain), resource_record.RrType.A.value, server_config.default_ttl, (record,)),
+            dnssec.opt_record()
+        )
+
+    elif signed_apex is not None:
+        response = signed.denial_handler(
+            req_head,
+            first_question,
+            view.signer.denial(view.zone_store, signed_apex, first_question.domain),
+            dnssec.opt_record()
+        )
+
+    elif record_set is not None:
+
+        # Addresses of the hosts an NS, MX or SRV answer names, signed
+        # answers leave them out as they would need signatures of their own
+
+        additional = (0, b"") if server_config.minimal_responses else view.zone_store.additional(record_set)
+
+        response = a_record.rrset_handler(req_head, first_question, record_set, additional)
+
+        # Rotating answers would freeze on whichever order was cached
+
+        return response, len(record_set) == 1
+
+    elif view.zone_store.has_name(first_question.domain):
+
+        # The name exists without the type asked for, NODATA rather than
+        # NXDOMAIN, RFC 2308 section 2.2
+
+        response = no_data.handler(req_head, first_question)
+
+    elif not first_question.domain.startswith(server_config.zone_suffix):
         response = name_error.handler(
             req_head, first_question)
 
+    elif any_query:
+        response = any_handler(req_head, first_question)
+
     elif first_question.qtype.value == resource_record.RrType.A.value:
         response = a_record.handler(
-            req_head, first_question)
+            req_head,
+            first_question,
+            server_config.default_answer.encode(),
+            server_config.default_ttl
+        )
 
     elif first_question.qtype.value == resource_record.RrType.OPT.value:
         response = opt_record.handler(req_head, first_question)
     else:
         response = not_implemented.handler(req_head, first_question)
 
-    print("RAW RESPONSE: {}".format(response.hex()))
+    return response, True
+
+
+def warm_cache(view: 'views.View') -> int:
+    """Store the response to every cacheable question the zones of a view
+    answer, ahead of the first query. Returns how many were stored
+    """
+
+    req_head = dns_header.DnsHeaderSection(bytearray(12))
+    stored = 0
+
+    for record_set in view.zone_store:
+        first_question = question.DnsQuestion(record_set.name, record_set.rr_type, resource_record.RrClass.IN)
+
+        for dnssec_ok in ((False, True) if view.signer is not None else (False,)):
+            if stored >= server_config.response_cache_entries:
+                return stored
+
+            response, cacheable = build_response(req_head, first_question, view, dnssec_ok)
+
+            if cacheable:
+                epoch = view.signer.epoch() if dnssec_ok else 0
+                view.response_cache.put((record_set.name, record_set.rr_type.value, epoch), response)
+                stored += 1
+
+    return stored
+
+
+def handle_query(data: bytearray, addr, udp: bool = False) -> bytearray:
+    """Build the response to one query, whatever transport it came from.
+    Returns None when rate limiting drops a UDP response
+    """
+
+    if tracer is not None:
+        tracer.begin()
+
+    # Truncated names, unknown OPCODEs and types all surface as parse errors
+
+    try:
+        req_head = dns_header.DnsHeaderSection(data[:12])
+
+        req_questions = question_section.DnsQuestionsSection(
+            data[12:], req_head.question_count
+        )
+
+        first_question = req_questions.first_question
+        operation_code = req_head.operation_code
+    except (IndexError, ValueError, UnicodeDecodeError):
+        return unparsed_handler(data)
+
+    log_query = server_config.log_every and next(_query_counter) % server_config.log_every == 0
+
+    if log_query:
+        print(req_head)
+
+        print(req_questions)
+
+    if operation_code == dns_header.OperationCode.UPDATE:
+
+        # Updates carry records where select_view looks for an OPT record
+
+        view = view_table.select(addr[0]) if view_table is not None else default_view
+
+        return update.handle(data, addr, view, server_config.update_allow)
+
+    try:
+        opt = query_opt(data, req_head, req_questions)
+    except (IndexError, ValueError):
+        return format_error.handler(req_head, first_question)
+
+    cookie = None
+    cookie_valid = False
+
+    if cookie_jar is not None and opt is not None and cookies.OPTION_COOKIE in opt.options:
+        cookie_state, cookie = cookie_jar.check(opt.options[cookies.OPTION_COOKIE], addr[0])
+
+        if cookie_state == cookies.MALFORMED:
+            return format_error.handler(req_head, first_question)
+
+        cookie_valid = cookie_state == cookies.VALID
+
+    if tracer is not None:
+        tracer.mark(profiler.PARSE)
+
+    view = select_view(addr, opt)
+
+    # (option code, data) added to the response's OPT record
+
+    reply_options = []
+
+    client_subnet = client_subnet_reply(opt)
+
+    if client_subnet is not None:
+        reply_options.append((edns.OPTION_CLIENT_SUBNET, client_subnet))
+
+    if cookie is not None:
+        reply_options.append((cookies.OPTION_COOKIE, cookie))
+
+    dnssec_ok = opt is not None and opt.dnssec_ok and view.signer is not None
+
+    # Signed responses are cached apart from unsigned ones, and apart for
+    # every signature refresh interval so no stale signature is replayed
+
+    cache_key = (first_question.domain, first_question.qtype.value, view.signer.epoch() if dnssec_ok else 0)
+
+    if tracer is not None:
+        tracer.mark(profiler.DISPATCH)
+
+    response = view.response_cache.get(req_head.transaction_id, cache_key)
+
+    if response is None:
+        response, cacheable = build_response(req_head, first_question, view, dnssec_ok)
+
+        if tracer is not None:
+            tracer.mark(profiler.HANDLER)
+
+        if cacheable:
+            view.response_cache.put(cache_key, response)
+
+    if tracer is not None:
+        tracer.mark(profiler.ENCODE)
+
+    if traffic is not None:
+        traffic.record(first_question.domain, addr[0], first_question.qtype.value, analytics.response_rcode(response))
+
+    # TCP and a valid cookie both prove the source address is real
+
+    if udp and rate_limiter is not None and not (cookie_valid and server_config.rrl_exempt_cookies):
+        rcode = response[3] & 0x0F
+        decision = rate_limiter.check(
+            addr[0],
+            (first_question.domain.lower(), first_question.qtype.value) if rcode == 0 else (rcode,)
+        )
+
+        if decision == rrl.DROP:
+            return None
+
+        # A client that sent a cookie learns the server cookie that lifts the limit
+
+        if decision == rrl.SLIP and cookie is not None:
+            return bad_cookie.handler(req_head, first_question, cookie)
+
+        if decision == rrl.SLIP:
+            response = truncated.handler(req_head, first_question)
+
+    # Responses past what the client takes over UDP lose their additional
+    # records, then are sent truncated so the client asks over TCP. Room
+    # is kept for an OPT record and the options added to it
+
+    reserved = 11 + sum(4 + len(option_data) for _, option_data in reply_options) if reply_options else 0
+
+    if udp and len(response) + reserved > edns.CLASSIC_UDP_SIZE:
+        fitted = edns.fit(response, udp_limit(data, req_head, req_questions, opt) - reserved)
+        response = fitted if fitted is not None else truncated.handler(req_head, first_question)
+
+    for option_code, option_data in reply_options:
+        response = edns.with_option(response, option_code, option_data)
+
+    if log_query:
+        print("RAW RESPONSE: {}".format(response.hex()))
+
+    return response
+
+
+def request_handler(data: bytearray, addr, sock: 'socket.socket'):
+
+    try:
+        response = handle_query(data, addr, True)
+    except Exception as error:
+
+        # A bug answering one query must not take the worker down with it
+
+        print("Failed to answer {}: {!r}".format(addr, error))
+        response = server_error.handler(data)
+
+    if response is not None:
+        sock.sendto(response, addr)
 
-    sock.sendto(response, addr)
+    if tracer is not None:
+        tracer.mark(profiler.SEND)
@@ -17,6 +17,11 @@ class RrClass(Enum):
     # Hesiod [Dyer 87]
     HS = 4
 
+    # Dynamic update classes, RFC 2136 section 2.4 and 2.5
+    NONE = 254
+
+    ANY = 255
+
 
 class RrType(Enum):
     """A list of resource types defined by the DNS RFC 
@@ -56,6 +61,24 @@ class RrType(Enum):
 
     AAAA = 28  # An IPv6 A record
 
+    SRV = 33  # service location
+
+    DS = 43  # delegation signer, RFC 4034
+
+    RRSIG = 46  # signature over an RRset, RFC 4034
+
+    NSEC = 47  # next secure record, RFC 4034
+
+    DNSKEY = 48  # zone signing public key, RFC 4034
+
+    NXNAME = 128  # compact denial marker for a name that does not exist, RFC 9824
+
+    IXFR = 251  # incremental zone transfer
+
+    AXFR = 252  # full zone transfer
+
+    ANY = 255  # a request for all records
+
     HTTPS = 65
 
     OPT = 41
@@ -0,0 +1,74 @@
+# Cache of fully encoded responses. A hit copies the stored template and
+# writes the query's transaction ID over the first two octets, so the
+# handlers and the encoders do not run at all.
+
+# Keys are (QNAME as sent, QTYPE value, signing interval), the last is 0
+# for unsigned responses, see dnssec.Signer.epoch. The QNAME keeps its case because
+# the question is echoed back in some responses. A second index by the
+# lowercased name lets a single name be invalidated without a full clear.
+
+
+class ResponseTemplateCache:
+    def __init__(self, max_entries: int = 100000):
+        self._max_entries = max_entries
+        self._templates: 'dict[tuple[str, int, int], bytes]' = {}
+        self._keys_by_name: 'dict[str, set[tuple[str, int, int]]]' = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, transaction_id: int, key: 'tuple[str, int, int]') -> bytearray:
+        template = self._templates.get(key)
+
+        if template is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+
+        response = bytearray(template)
+        response[:2] = transaction_id.to_bytes(2, "big")
+
+        return response
+
+    def put(self, key: 'tuple[str, int, int]', response: bytearray) -> None:
+        if key in self._templates:
+            self._templates[key] = bytes(response)
+            return
+
+        if len(self._templates) >= self._max_entries:
+
+            # Dicts keep insertion order, so the first key is the oldest entry
+
+            self._discard(next(iter(self._templates)))
+
+        self._templates[key] = bytes(response)
+        self._keys_by_name.setdefault(key[0].lower().rstrip("."), set()).add(key)
+
+    def _discard(self, key: 'tuple[str, int, int]') -> None:
+        del self._templates[key]
+
+        name = key[0].lower().rstrip(".")
+        keys = self._keys_by_name.get(name)
+
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_name[name]
+
+    def invalidate(self, domain: str) -> int:
+        """Drop every cached response for a name, returns how many were dropped
+        """
+
+        keys = self._keys_by_name.pop(domain.lower().rstrip("."), set())
+
+        for key in keys:
+            self._templates.pop(key, None)
+
+        return len(keys)
+
+    def clear(self) -> None:
+        self._templates.clear()
+        self._keys_by_name.clear()
+
+    def __len__(self) -> int:
+        return len(self._templates)
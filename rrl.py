@@ -0,0 +1,120 @@
+import array
+import socket
+import sys
+import time
+
+# Response Rate Limiting for UDP.
+
+# https://kb.isc.org/docs/aa-00994
+
+# Spoofed queries turn a name server into an amplifier aimed at the
+# forged source. Every response is charged to a token bucket for its
+# client network and what it answers, the question for positive answers
+# and the RCODE for errors and NXDOMAIN, which have no name worth telling
+# apart. A bucket refills at responses_per_second up to window seconds
+# worth. Past that, responses are dropped, except every slip-th one,
+# which is sent truncated so a real client behind the address retries
+# over TCP, where addresses can not be forged.
+
+# Buckets live in a fixed table indexed by the hash of their key, so
+# memory does not grow with the number of attackers or names. Keys that
+# share a slot share a budget, which only limits sooner.
+
+# Every worker keeps its own table, and the kernel spreads one client's
+# queries over the workers, so the effective rate is up to workers times
+# responses_per_second.
+
+SEND = 0
+DROP = 1
+SLIP = 2
+
+
+class ResponseRateLimiter:
+    def __init__(self, responses_per_second: float = 5, window: float = 15, slip: int = 2, table_size: int = 65536,
+                 ipv4_prefix: int = 24, ipv6_prefix: int = 56):
+        """Args:
+            responses_per_second (float): Identical responses a client network gets per second
+            window (float): Seconds of responses a bucket holds, the burst allowed
+            slip (int): Send every slip-th limited response truncated, 0 drops them all
+            table_size (int): Buckets in the table
+            ipv4_prefix (int): Prefix length grouping IPv4 clients
+            ipv6_prefix (int): Prefix length grouping IPv6 clients
+        """
+
+        self._rate = responses_per_second
+        self._burst = responses_per_second * window
+        self._slip = slip
+        self._table_size = table_size
+        self._ipv4_shift = 32 - ipv4_prefix
+        self._ipv6_shift = 128 - ipv6_prefix
+
+        self._credits = array.array("d", bytes(8 * table_size))
+        self._stamps = array.array("d", bytes(8 * table_size))
+
+        self._limited = 0
+
+        self.dropped = 0
+        self.slipped = 0
+
+    def _network(self, client: str) -> int:
+        if ":" in client:
+            packed = socket.inet_pton(socket.AF_INET6, client.partition("%")[0])
+            return int.from_bytes(packed, "big") >> self._ipv6_shift << 1 | 1
+
+        return int.from_bytes(socket.inet_pton(socket.AF_INET, client), "big") >> self._ipv4_shift << 1
+
+    def check(self, client: str, key) -> int:
+        """Charge one response to the bucket of client and key.
+
+        Args:
+            client (str): Source address of the query
+            key: What the response answers. Ex: ('www.ricklantis.com', 1), (3,)
+
+        Returns:
+            int: SEND, DROP or SLIP
+        """
+
+        slot = hash((self._network(client), key)) % self._table_size
+        now = time.monotonic()
+
+        # A slot never used has stamp 0 and refills to a full burst
+
+        credit = min(self._burst, self._credits[slot] + (now - self._stamps[slot]) * self._rate)
+        self._stamps[slot] = now
+
+        if credit >= 1:
+            self._credits[slot] = credit - 1
+            return SEND
+
+        self._credits[slot] = credit
+        self._limited += 1
+
+        if self._slip and self._limited % self._slip == 0:
+            self.slipped += 1
+            return SLIP
+
+        self.dropped += 1
+
+        return DROP
+
+
+if __name__ == "__main__":
+
+    # One client network flooding one name, and the cost of a check.
+    # Usage: python rrl.py [RATE] [QUERIES]
+
+    rate = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    queries = int(sys.argv[2]) if len(sys.argv) > 2 else 200000
+
+    limiter = ResponseRateLimiter(rate)
+    outcomes = [0, 0, 0]
+
+    start = time.perf_counter()
+
+    for i in range(queries):
+        outcomes[limiter.check("198.51.100.{}".format(i % 256), ("www.ricklantis.com", 1))] += 1
+
+    elapsed = time.perf_counter() - start
+
+    print("{:.2f} us per check, sent {} dropped {} slipped {}".format(
+        elapsed / queries * 1e6, outcomes[SEND], outcomes[DROP], outcomes[SLIP]))
@@ -0,0 +1,174 @@
+import itertools
+
+import question
+import rdata
+import resource_record
+
+# Answers for names with several addresses. Every record is encoded once,
+# and every rotation of the live records is joined into a ready to send
+# answer section up front. Picking an answer on the packet loop is then a
+# counter increment and a tuple index, no encoding at all.
+
+# Weights decide how often each record is placed first, using the smooth
+# weighted round robin order (the same one nginx uses), so a record with
+# weight 3 leads three out of every sum(weights) answers without bursts.
+
+
+RDATA_TYPES = {
+    resource_record.RrType.A: rdata.RdataType.IPV4,
+    resource_record.RrType.AAAA: rdata.RdataType.IPV6,
+    resource_record.RrType.NS: rdata.RdataType.DOMAIN,
+    resource_record.RrType.CNAME: rdata.RdataType.DOMAIN,
+    resource_record.RrType.PTR: rdata.RdataType.DOMAIN,
+}
+
+
+def smooth_weighted_order(weights: 'list[int]') -> 'list[int]':
+    """One full cycle of smooth weighted round robin. Ex: [5, 1, 1] gives
+    [0, 0, 1, 0, 2, 0, 0]
+    """
+
+    total = sum(weights)
+    current = [0] * len(weights)
+    order = []
+
+    for _ in range(total):
+        for i, weight in enumerate(weights):
+            current[i] += weight
+
+        chosen = max(range(len(weights)), key=lambda i: current[i])
+        current[chosen] -= total
+        order.append(chosen)
+
+    return order
+
+
+class RRset:
+    def __init__(self, name: str, rr_type: 'resource_record.RrType', ttl: int, values: 'list[bytes]', weights: 'list[int]' = None):
+        """All records of one name and type.
+
+        Args:
+            name (str): Owner name. Ex: 'www.ricklantis.com'
+            rr_type (resource_record.RrType): Record type, A or AAAA for addresses
+            ttl (int): TTL shared by the whole set
+            values (list[bytes]): Record values. Ex: [b'10.0.0.1', b'10.0.0.2']
+            weights (list[int]): How often each record is placed first, defaults to 1 each
+        """
+
+        if not values:
+            raise ValueError("An RRset needs at least one record")
+
+        if weights is None:
+            weights = [1] * len(values)
+
+        if len(weights) != len(values):
+            raise ValueError("Expected one weight per record")
+
+        if any(weight < 1 for weight in weights):
+            raise ValueError("Weights must be positive integers")
+
+        self._name = name.lower().rstrip(".")
+        self._type = rr_type
+        self._ttl = ttl
+        self._values = list(values)
+        self._weights = list(weights)
+        self._healthy = [True] * len(values)
+
+        owner = question.DnsQuestion(self._name, rr_type, resource_record.RrClass.IN)
+        rdata_type = RDATA_TYPES.get(rr_type, rdata.RdataType.RAW)
+
+        self._records = [
+            bytes(resource_record.ResourceRecord(owner, ttl, rdata.Rdata(rdata_type, value)).bytes)
+            for value in self._values
+        ]
+
+        self._counter = itertools.count()
+
+        # (answer count, schedule of ready to send answer sections, live records)
+        self._state: 'tuple[int, tuple[bytes, ...], tuple[bytes, ...]]' = (0, (), ())
+
+        self._build()
+
+    def _build(self) -> None:
+        live = [i for i, healthy in enumerate(self._healthy) if healthy]
+
+        # With every backend down it is better to keep answering than to
+        # return nothing, the checks may be the thing that is broken
+
+        if not live:
+            live = list(range(len(self._records)))
+
+        rotations = [
+            b"".join(self._records[live[(start + i) % len(live)]] for i in range(len(live)))
+            for start in range(len(live))
+        ]
+
+        schedule = tuple(
+            rotations[position]
+            for position in smooth_weighted_order([self._weights[i] for i in live])
+        )
+
+        # Swapped in one assignment so the packet loop never sees a half built state
+
+        self._state = (len(live), schedule, tuple(self._records[i] for i in live))
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def rr_type(self) -> 'resource_record.RrType':
+        return self._type
+
+    @property
+    def ttl(self) -> int:
+        return self._ttl
+
+    @property
+    def values(self) -> 'list[bytes]':
+        return self._values
+
+    @property
+    def weights(self) -> 'list[int]':
+        return self._weights
+
+    @property
+    def records(self) -> 'list[bytes]':
+        """Every record encoded on its own, in zone order
+        """
+        return self._records
+
+    @property
+    def live_records(self) -> 'tuple[bytes, ...]':
+        """The records answers are built from. The same tuple object is
+        returned until the health of a record changes
+        """
+        return self._state[2]
+
+    def is_healthy(self, index: int) -> bool:
+        return self._healthy[index]
+
+    def set_healthy(self, index: int, healthy: bool) -> None:
+        if self._healthy[index] == healthy:
+            return
+
+        self._healthy[index] = healthy
+        self._build()
+
+    def set_weight(self, index: int, weight: int) -> None:
+        if weight < 1:
+            raise ValueError("Weights must be positive integers")
+
+        self._weights[index] = weight
+        self._build()
+
+    def next_answer(self) -> 'tuple[int, bytes]':
+        """Returns the answer count and the encoded answer section to send next
+        """
+
+        answer_count, schedule, _ = self._state
+
+        return answer_count, schedule[next(self._counter) % len(schedule)]
+
+    def __len__(self) -> int:
+        return len(self._records)
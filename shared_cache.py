@@ -0,0 +1,343 @@
+import mmap
+import multiprocessing
+import os
+import struct
+import sys
+import time
+
+# Response template cache shared by every worker process.
+
+# The cache is one shared memory mapping created by the parent before it
+# forks, divided into fixed size slots. A response built by any worker is
+# reused by all of them, where per worker caches each have to miss once
+# for every question before they hit.
+
+# +--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+
+# |        SEQUENCE (4 bytes), odd while written  |
+# +--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+
+# |        NAME DIGEST (8 bytes), 0 empty 1 freed |
+# +--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+
+# |        EXPIRES (4 bytes, unix seconds)        |
+# +--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+
+# |  RESPONSE LENGTH (2 bytes) | KEY LENGTH (2)   |
+# +--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+
+# /   KEY: QNAME as sent, 0, QTYPE, interval      /
+# +--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+
+# /                 RESPONSE                      /
+# +--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+--+
+
+# Slots are found by open addressing: the digest of the lowercased name
+# picks a slot and the next MAX_PROBES slots are searched in order, so
+# every entry for a name sits in one window and the name can be
+# invalidated without an index.
+
+# Reads take no lock. A writer makes the sequence odd, writes the slot
+# and makes it even again, a reader that sees an odd sequence, or a
+# different one after copying the slot, treats it as a miss (a seqlock). Writers
+# take one of a fixed set of locks by slot number and skip the write when
+# another worker holds it, a cache can always decline to store.
+
+SLOT_HEADER = struct.Struct("<IQIHH")
+
+SEQUENCE = struct.Struct("<I")
+
+# QNAME terminator, QTYPE and signing interval after the name in a key
+KEY_SUFFIX = struct.Struct(">xHI")
+
+EMPTY = 0
+
+FREED = 1
+
+MAX_PROBES = 16
+
+WRITE_LOCKS = 64
+
+
+def _key_bytes(key: 'tuple[str, int, int]') -> bytes:
+    name, qtype, epoch = key
+
+    return name.encode() + KEY_SUFFIX.pack(qtype, epoch)
+
+
+def _name_digest(name: str) -> int:
+
+    # hash() is salted per interpreter, but the mapping is only shared with
+    # forked children, which keep the salt of the parent. The two digests
+    # that mark empty and freed slots are never used for a name.
+
+    return max(hash(name.lower()) & 0xFFFFFFFFFFFFFFFF, FREED + 1)
+
+
+class SharedResponseCache:
+    def __init__(self, slots: int = 65536, slot_size: int = 512, ttl: int = 60):
+        """Must be created before the workers are forked.
+
+        Args:
+            slots (int): Number of slots, the most responses held
+            slot_size (int): Octets per slot, larger responses are not stored
+            ttl (int): Seconds a stored response is served for
+        """
+
+        if slot_size < SLOT_HEADER.size + 64:
+            raise ValueError("slot_size too small to hold a response")
+
+        self._slots = slots
+        self._slot_size = slot_size
+        self._ttl = ttl
+
+        # Anonymous mappings are MAP_SHARED, forked children see the same pages
+
+        self._map = mmap.mmap(-1, slots * slot_size)
+        self._locks = [multiprocessing.Lock() for _ in range(WRITE_LOCKS)]
+
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def nbytes(self) -> int:
+        return self._slots * self._slot_size
+
+    def _probe(self, digest: int):
+        start = digest % self._slots
+
+        for i in range(min(MAX_PROBES, self._slots)):
+            yield (start + i) % self._slots
+
+    def _holds(self, offset: int, digest: int, key: bytes) -> bool:
+        sequence, slot_digest, _, _, key_length = SLOT_HEADER.unpack_from(self._map, offset)
+        start = offset + SLOT_HEADER.size
+
+        return slot_digest == digest and self._map[start:start+key_length] == key and \
+            SEQUENCE.unpack_from(self._map, offset)[0] == sequence
+
+    def get(self, transaction_id: int, key: 'tuple[str, int, int]') -> bytearray:
+        digest = _name_digest(key[0])
+        key_bytes = _key_bytes(key)
+        slot = digest % self._slots
+
+        for _ in range(min(MAX_PROBES, self._slots)):
+            offset = slot * self._slot_size
+            sequence, slot_digest, expires, length, key_length = SLOT_HEADER.unpack_from(self._map, offset)
+
+            if slot_digest == digest and not sequence & 1:
+                start = offset + SLOT_HEADER.size
+
+                if self._map[start:start+key_length] == key_bytes:
+                    response = bytearray(self._map[start+key_length:start+key_length+length])
+
+                    # A slot rewritten while it was copied, or expired, is a miss
+
+                    if SEQUENCE.unpack_from(self._map, offset)[0] != sequence or expires < time.time():
+                        break
+
+                    self.hits += 1
+                    response[:2] = transaction_id.to_bytes(2, "big")
+
+                    return response
+
+            elif slot_digest == EMPTY:
+                break
+
+            slot = slot + 1 if slot + 1 < self._slots else 0
+
+        self.misses += 1
+
+        return None
+
+    def _write(self, slot: int, digest: int, expires: int, key: bytes, response: bytes) -> bool:
+        lock = self._locks[slot % WRITE_LOCKS]
+
+        if not lock.acquire(False):
+            return False
+
+        try:
+            offset = slot * self._slot_size
+            sequence = SEQUENCE.unpack_from(self._map, offset)[0]
+
+            SEQUENCE.pack_into(self._map, offset, (sequence + 1) % 2**32)
+
+            start = offset + SLOT_HEADER.size
+            self._map[start:start+len(key)] = key
+            self._map[start+len(key):start+len(key)+len(response)] = response
+
+            SLOT_HEADER.pack_into(self._map, offset, (sequence + 1) % 2**32, digest, expires, len(response), len(key))
+            SEQUENCE.pack_into(self._map, offset, (sequence + 2) % 2**32)
+        finally:
+            lock.release()
+
+        return True
+
+    def put(self, key: 'tuple[str, int, int]', response: bytearray, ttl: int = None) -> None:
+        digest = _name_digest(key[0])
+        key_bytes = _key_bytes(key)
+
+        if SLOT_HEADER.size + len(key_bytes) + len(response) > self._slot_size:
+            return
+
+        now = time.time()
+        target = None
+        oldest = None
+
+        for slot in self._probe(digest):
+            offset = slot * self._slot_size
+            _, slot_digest, expires, _, _ = SLOT_HEADER.unpack_from(self._map, offset)
+
+            if slot_digest == digest and self._holds(offset, digest, key_bytes):
+                target = slot
+                break
+
+            if target is None and (slot_digest in (EMPTY, FREED) or expires < now):
+                target = slot
+
+            if slot_digest == EMPTY:
+                break
+
+            if oldest is None or expires < oldest[1]:
+                oldest = (slot, expires)
+
+        # Every slot in the window is live, the one closest to expiring goes
+
+        if target is None:
+            target = oldest[0]
+
+        self._write(target, digest, int(now) + (self._ttl if ttl is None else ttl), key_bytes, bytes(response))
+
+    def invalidate(self, domain: str) -> int:
+        """Drop every cached response for a name, returns how many were dropped
+        """
+
+        digest = _name_digest(domain.rstrip("."))
+        dropped = 0
+
+        for slot in self._probe(digest):
+            offset = slot * self._slot_size
+            slot_digest = SLOT_HEADER.unpack_from(self._map, offset)[1]
+
+            if slot_digest == EMPTY:
+                break
+
+            if slot_digest != digest:
+                continue
+
+            lock = self._locks[slot % WRITE_LOCKS]
+
+            with lock:
+                sequence = SEQUENCE.unpack_from(self._map, offset)[0]
+                SEQUENCE.pack_into(self._map, offset, (sequence + 1) % 2**32)
+                self._map[offset+4:offset+12] = FREED.to_bytes(8, "little")
+                SEQUENCE.pack_into(self._map, offset, (sequence + 2) % 2**32)
+
+            dropped += 1
+
+        return dropped
+
+    def clear(self) -> None:
+        for lock in self._locks:
+            lock.acquire()
+
+        try:
+            self._map[:] = bytes(len(self._map))
+        finally:
+            for lock in self._locks:
+                lock.release()
+
+    def __len__(self) -> int:
+        """Live entries, counted with a scan of every slot
+        """
+
+        now = time.time()
+        count = 0
+
+        for slot in range(self._slots):
+            _, digest, expires, _, _ = SLOT_HEADER.unpack_from(self._map, slot * self._slot_size)
+
+            if digest > FREED and expires >= now:
+                count += 1
+
+        return count
+
+
+if __name__ == "__main__":
+
+    # Per worker caches against the shared cache, every worker answering
+    # its own share of one skewed stream of questions. Both are given the
+    # same memory, capacity entries per worker. A miss costs one build of
+    # the response, 20 us is about build_response for a zone answer, online
+    # signing costs far more.
+    # Usage: python shared_cache.py [WORKERS] [NAMES] [QUERIES] [MISS_US]
+
+    import random
+
+    import response_cache
+
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    name_count = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    queries_per_worker = int(sys.argv[3]) if len(sys.argv) > 3 else 50000
+    build_seconds = (float(sys.argv[4]) if len(sys.argv) > 4 else 20) / 1e6
+    capacity = name_count // 10
+
+    def build(name: str) -> bytes:
+        deadline = time.process_time() + build_seconds
+
+        while time.process_time() < deadline:
+            pass
+
+        return b"\0" * 12 + name.encode() * 2
+
+    def run(cache, seed: int, results) -> None:
+        rng = random.Random(seed)
+        names = [
+            "host{}.ricklantis.com".format(int(rng.paretovariate(0.5)) % name_count)
+            for _ in range(queries_per_worker)
+        ]
+
+        # CPU time, wall time would count the other workers sharing a CPU
+
+        start = time.process_time()
+
+        for name in names:
+            key = (name, 1, 0)
+
+            if cache.get(1, key) is None:
+                cache.put(key, build(name))
+
+        results.put((time.process_time() - start, cache.hits, cache.misses))
+
+    for label, make_cache in (
+        ("per worker", lambda: None),
+        ("shared", lambda: SharedResponseCache(capacity * workers, 128, 3600)),
+    ):
+        shared = make_cache()
+        results = multiprocessing.Queue()
+        children = []
+
+        for worker in range(workers):
+            pid = os.fork()
+
+            if pid == 0:
+                cache = shared if shared is not None else response_cache.ResponseTemplateCache(capacity)
+                run(cache, worker, results)
+
+                # Let the queue's feeder thread hand the result over before exiting
+
+                results.close()
+                results.join_thread()
+                os._exit(0)
+
+            children.append(pid)
+
+        outcomes = [results.get() for _ in children]
+
+        for pid in children:
+            os.waitpid(pid, 0)
+
+        hits = sum(outcome[1] for outcome in outcomes)
+        misses = sum(outcome[2] for outcome in outcomes)
+        seconds = sum(outcome[0] for outcome in outcomes)
+
+        print("{:<11} workers {}  hit rate {:5.1f}%  {:.2f} us per query".format(
+            label,
+            workers,
+            100 * hits / (hits + misses),
+            seconds / (workers * queries_per_worker) * 1e6
+        ))
@@ -0,0 +1,258 @@
+import selectors
+import socket
+import threading
+import time
+
+import listeners
+import req_handler
+import resource_record
+import util
+import xfr
+
+# DNS over TCP. Every message is preceded by a two octet length.
+
+# https://datatracker.ietf.org/doc/html/rfc7766
+
+# Listening sockets and connections share the UDP selector, so ordinary
+# queries over TCP are answered from the packet loop. Zone transfers can
+# stream for a long time, so the connection is handed to its own thread
+# and removed from the selector for the rest of its life.
+
+# Connections on the packet loop never block it. An answer the socket
+# can not take at once is kept and written as the client reads, and no
+# further query of that connection is read until it is. A connection
+# without a query read or an answer written for idle_timeout seconds is
+# closed, so clients that stay connected without asking anything do not
+# hold max_connections.
+
+# https://datatracker.ietf.org/doc/html/rfc7766#section-6.2.3
+
+TRANSFER_TYPES = (resource_record.RrType.AXFR.value, resource_record.RrType.IXFR.value)
+
+# Seconds between idle sweeps on the packet loop
+SWEEP_INTERVAL = 1.0
+
+
+class _Connection:
+    def __init__(self, addr):
+        self.addr = addr
+        self.unread = bytearray()
+        self.unsent = bytearray()
+        self.last_active = time.monotonic()
+
+
+class TcpServer:
+    def __init__(self, udp_listeners: 'listeners.UdpListeners', transfer_allow: 'tuple[str, ...]' = (), max_connections: int = 256, idle_timeout: float = 10.0):
+        """Args:
+            udp_listeners (listeners.UdpListeners): Selector the TCP sockets are registered with
+            transfer_allow (tuple[str, ...]): Prefixes allowed to run AXFR and IXFR. Ex: ('10.0.0.0/8',)
+            max_connections (int): Open connections past this are closed right after accept
+            idle_timeout (float): Seconds a connection may go without reading a query or writing an
+                answer, and a zone transfer send may block, before it is closed
+        """
+
+        self._udp_listeners = udp_listeners
+        self._transfer_allow = transfer_allow
+        self._max_connections = max_connections
+        self._idle_timeout = idle_timeout
+        self._last_sweep = time.monotonic()
+
+        self._connections: 'dict[socket.socket, _Connection]' = {}
+        self._sockets: 'list[socket.socket]' = []
+
+    @property
+    def sockets(self) -> 'list[socket.socket]':
+        return self._sockets
+
+    @property
+    def connection_count(self) -> int:
+        return len(self._connections)
+
+    def add(self, sock: 'socket.socket') -> None:
+        sock.setblocking(False)
+        self._sockets.append(sock)
+        self._udp_listeners.register(sock, self._accept)
+
+    def bind(self, host: str, port: int, v6only: bool = True) -> 'socket.socket':
+        sock = listeners.open_tcp_socket(host, port, v6only)
+        self.add(sock)
+        return sock
+
+    def _accept(self, sock: 'socket.socket') -> None:
+        try:
+            connection, addr = sock.accept()
+        except (BlockingIOError, InterruptedError, ConnectionAbortedError):
+            return
+
+        if len(self._connections) >= self._max_connections:
+            self.sweep(force=True)
+
+        if len(self._connections) >= self._max_connections:
+            connection.close()
+            return
+
+        # Answers are written whole, waiting for more to coalesce only adds latency
+
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection.setblocking(False)
+        self._connections[connection] = _Connection(addr)
+        self._udp_listeners.register(connection, self._ready)
+
+    def _close(self, connection: 'socket.socket') -> None:
+        if self._connections.pop(connection, None) is not None:
+            self._udp_listeners.unregister(connection)
+
+        connection.close()
+
+    def sweep(self, force: bool = False) -> None:
+        """Close connections idle for longer than idle_timeout. Called from
+        the packet loop, does nothing until SWEEP_INTERVAL passed unless forced
+        """
+
+        now = time.monotonic()
+
+        if not force and now - self._last_sweep < SWEEP_INTERVAL:
+            return
+
+        self._last_sweep = now
+
+        for connection, state in list(self._connections.items()):
+            if now - state.last_active > self._idle_timeout:
+                self._close(connection)
+
+    def _ready(self, connection: 'socket.socket') -> None:
+        state = self._connections[connection]
+
+        if state.unsent:
+            self._flush(connection, state)
+            return
+
+        try:
+            data = connection.recv(65535)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b""
+
+        if not data:
+            self._close(connection)
+            return
+
+        state.unread += data
+        state.last_active = time.monotonic()
+        self._answer_unread(connection, state)
+
+    def _answer_unread(self, connection: 'socket.socket', state: '_Connection') -> None:
+        buffer = state.unread
+
+        # Stop at an answer left unsent, the rest is read once it is written
+
+        while len(buffer) >= 2 and not state.unsent:
+            length = int.from_bytes(buffer[:2], "big")
+
+            if len(buffer) < 2 + length:
+                return
+
+            message = buffer[2:2+length]
+            del buffer[:2+length]
+
+            if not self._handle(connection, state, message):
+                return
+
+    def _send(self, connection: 'socket.socket', state: '_Connection', data: bytes) -> bool:
+        """Write what the socket takes now, keep the rest for _flush. Returns
+        False when the connection was closed
+        """
+
+        try:
+            sent = connection.send(data)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            self._close(connection)
+            return False
+
+        if sent < len(data):
+            state.unsent += data[sent:]
+            self._udp_listeners.modify(connection, self._ready, selectors.EVENT_WRITE)
+
+        return True
+
+    def _flush(self, connection: 'socket.socket', state: '_Connection') -> None:
+        try:
+            sent = connection.send(state.unsent)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self._close(connection)
+            return
+
+        del state.unsent[:sent]
+        state.last_active = time.monotonic()
+
+        if not state.unsent:
+            self._udp_listeners.modify(connection, self._ready, selectors.EVENT_READ)
+            self._answer_unread(connection, state)
+
+    def _handle(self, connection: 'socket.socket', state: '_Connection', message: bytearray) -> bool:
+        """Answer one message. Returns False once the connection is no longer read here
+        """
+
+        try:
+            qname_length = util.label_length(message, 12)
+            qtype = int.from_bytes(message[12+qname_length:14+qname_length], "big")
+        except IndexError:
+            self._close(connection)
+            return False
+
+        if qtype in TRANSFER_TYPES:
+            self._connections.pop(connection)
+            self._udp_listeners.unregister(connection)
+
+            # The transfer thread may block on sendall, up to the idle timeout
+
+            connection.settimeout(self._idle_timeout)
+
+            threading.Thread(
+                target=self._transfer,
+                args=(connection, state.addr, message),
+                name="zone-transfer",
+                daemon=True
+            ).start()
+
+            return False
+
+        try:
+            response = req_handler.handle_query(message, state.addr)
+        except Exception:
+            self._close(connection)
+            return False
+
+        # Responses and other messages not worth an answer are dropped, the
+        # next message on the connection is still read
+
+        if response is None:
+            return True
+
+        return self._send(connection, state, len(response).to_bytes(2, "big") + response)
+
+    def _transfer(self, connection: 'socket.socket', addr, message: bytearray) -> None:
+        view = req_handler.view_table.select(addr[0]) if req_handler.view_table else req_handler.default_view
+
+        try:
+            for response in xfr.transfer(message, addr, view.zone_store, self._transfer_allow):
+                connection.sendall(len(response).to_bytes(2, "big") + response)
+        except OSError:
+            pass
+        finally:
+            connection.close()
+
+    def close(self) -> None:
+        for connection in list(self._connections):
+            self._close(connection)
+
+        for sock in self._sockets:
+            self._udp_listeners.unregister(sock)
+            sock.close()
+
+        self._sockets = []
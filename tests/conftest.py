@@ -0,0 +1,62 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import hamurai
+import req_handler
+
+# A zone with every type the response builder treats on its own: delegation
+# targets for glue, several addresses for rotation, a TXT past 512 octets
+
+ZONE = """
+ricklantis.com.            3600 IN SOA   ns1.ricklantis.com. admin.ricklantis.com. 1 7200 900 1209600 300
+ricklantis.com.            3600 IN NS    ns1.ricklantis.com.
+ricklantis.com.            3600 IN NS    ns2.ricklantis.com.
+ricklantis.com.            3600 IN MX    10 mail.ricklantis.com.
+ns1.ricklantis.com.        3600 IN A     10.0.0.1
+ns1.ricklantis.com.        3600 IN AAAA  2001:db8::1
+ns2.ricklantis.com.        3600 IN A     10.0.0.2
+mail.ricklantis.com.       3600 IN A     10.0.0.3
+www.ricklantis.com.        60   IN A     10.0.1.1
+www.ricklantis.com.        60   IN A     10.0.1.2
+big.ricklantis.com.        60   IN TXT   "{}" "{}"
+""".format("a" * 250, "b" * 250)
+
+
+@pytest.fixture
+def zone_file(tmp_path) -> str:
+    path = tmp_path / "ricklantis.zone"
+    path.write_text(ZONE)
+    return str(path)
+
+
+@pytest.fixture
+def serve(monkeypatch, zone_file):
+    """Set the request handler up like hamurai does at startup. Call it
+    with configuration overrides, again to simulate a restart. Every
+    module global it sets is restored afterwards
+    """
+
+    for name in ("server_config", "default_view", "view_table", "response_policy", "tracer", "traffic",
+                 "cookie_jar", "rate_limiter"):
+        monkeypatch.setattr(req_handler, name, getattr(req_handler, name))
+
+    monkeypatch.setattr(hamurai, "batch_handler", None)
+
+    def setup(**settings):
+        hamurai.close_journals()
+
+        values = {"zone_files": [zone_file], "log_every": 0, "debug_labels": False}
+        values.update(settings)
+
+        hamurai.setup(config.from_dict(values))
+
+        return req_handler.default_view
+
+    yield setup
+
+    hamurai.close_journals()
@@ -0,0 +1,47 @@
+import struct
+
+import util
+
+# Builds and reads the few message shapes the tests need, by hand so the
+# tests do not share the code they check
+
+
+def name(domain: str) -> bytes:
+    return bytes(util.domain_to_label(domain))
+
+
+def record(domain: str, rr_type: int, rr_class: int = 1, ttl: int = 0, rdata: bytes = b"") -> bytes:
+    return name(domain) + struct.pack(">HHIH", rr_type, rr_class, ttl, len(rdata)) + rdata
+
+
+def opt(udp_payload_size: int = 1232, options: bytes = b"") -> bytes:
+    return b"\x00" + struct.pack(">HHIH", 41, udp_payload_size, 0, len(options)) + options
+
+
+def query(domain: str, rr_type: int = 1, transaction_id: int = 0x1234, flags: int = 0x0100, additional: 'list[bytes]' = ()) -> bytearray:
+    return bytearray(
+        struct.pack(">HHHHHH", transaction_id, flags, 1, 0, 0, len(additional)) +
+        name(domain) + struct.pack(">HH", rr_type, 1) + b"".join(additional)
+    )
+
+
+def update(zone: str, prerequisites: 'list[bytes]' = (), updates: 'list[bytes]' = (), transaction_id: int = 7) -> bytearray:
+    return bytearray(
+        struct.pack(">HHHHHH", transaction_id, 5 << 11, 1, len(prerequisites), len(updates), 0) +
+        name(zone) + struct.pack(">HH", 6, 1) + b"".join(prerequisites) + b"".join(updates)
+    )
+
+
+def header(response: bytes) -> dict:
+    transaction_id, flags, qdcount, ancount, nscount, arcount = struct.unpack(">HHHHHH", bytes(response[:12]))
+
+    return {
+        "id": transaction_id,
+        "tc": bool(flags & 0x0200),
+        "opcode": flags >> 11 & 0xF,
+        "rcode": flags & 0xF,
+        "qdcount": qdcount,
+        "ancount": ancount,
+        "nscount": nscount,
+        "arcount": arcount,
+    }
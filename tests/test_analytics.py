@@ -0,0 +1,40 @@
+import struct
+
+import analytics
+import dnssec
+import req_handler
+
+import messages
+
+CLIENT = ("192.0.2.1", 1)
+
+
+def test_nxdomain_hot_spots_include_compact_denials(serve, tmp_path, monkeypatch):
+    dnssec.SigningKey.generate().save(str(tmp_path / "ricklantis.com.pem"))
+    serve(dnssec_key_dir=str(tmp_path), dnssec_presign_processes=1, zone_suffix="default")
+    monkeypatch.setattr(req_handler, "traffic", analytics.TrafficAnalytics(3600))
+
+    do_bit = b"\x00" + struct.pack(">HHIH", 41, 1232, 0x8000, 0)
+
+    for domain, rr_type, signed in [
+        ("missing.ricklantis.com", 1, True),
+        ("missing.ricklantis.com", 1, True),
+        ("nothing.example", 1, False),
+        ("www.ricklantis.com", 28, True),
+        ("www.ricklantis.com", 1, True),
+    ]:
+        req_handler.handle_query(messages.query(domain, rr_type, additional=[do_bit] if signed else []), CLIENT, True)
+
+    # The NODATA for www AAAA denies a type, not the name
+
+    assert dict(req_handler.traffic.nxdomain.top()) == {"missing.ricklantis.com": 2, "nothing.example": 1}
+
+
+def test_response_rcode_of_unsigned_answers(serve):
+    serve()
+
+    nodata = req_handler.handle_query(messages.query("www.ricklantis.com", 28), CLIENT, True)
+    answer = req_handler.handle_query(messages.query("www.ricklantis.com"), CLIENT, True)
+
+    assert analytics.response_rcode(nodata) == 0
+    assert analytics.response_rcode(answer) == 0
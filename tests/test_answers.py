@@ -0,0 +1,92 @@
+import struct
+
+import pytest
+
+import dnssec
+import req_handler
+import resource_record
+import zone
+
+import messages
+
+CLIENT = ("127.0.0.1", 1)
+
+
+def ask(domain: str, rr_type: int = 1) -> dict:
+    return messages.header(req_handler.handle_query(messages.query(domain, rr_type), CLIENT, True))
+
+
+def test_existing_name_without_the_type_is_nodata(serve):
+    serve()
+
+    answer = ask("www.ricklantis.com", 1)
+    nodata = ask("www.ricklantis.com", 28)
+
+    assert (answer["rcode"], answer["ancount"]) == (0, 2)
+    assert (nodata["rcode"], nodata["ancount"]) == (0, 0)
+
+
+def test_missing_name_is_nxdomain(serve):
+    serve()
+
+    assert ask("nothing.example", 28)["rcode"] == 3
+
+
+def test_zone_file_weights_order_the_answers(tmp_path):
+    path = tmp_path / "weighted.zone"
+    path.write_text(
+        "www.ricklantis.com. 60 IN A 10.0.1.1 ; weight=3\n"
+        "www.ricklantis.com. 60 IN A 10.0.1.2 ; primary site, weight=1\n"
+        'txt.ricklantis.com. 60 IN TXT "a;weight=5"\n'
+    )
+
+    store = zone.ZoneStore()
+    store.load(str(path))
+
+    record_set = store.get("www.ricklantis.com", resource_record.RrType.A)
+    answers = [record_set.next_answer()[1] for _ in range(8)]
+    led_by_second = [answer.index(bytes([10, 0, 1, 2])) < answer.index(bytes([10, 0, 1, 1])) for answer in answers]
+
+    assert record_set.weights == [3, 1]
+    assert led_by_second.count(True) == 2
+    assert store.get("txt.ricklantis.com", resource_record.RrType.TXT).weights == [1]
+
+
+def test_zone_file_weights_must_be_positive(tmp_path):
+    path = tmp_path / "weighted.zone"
+    path.write_text("www.ricklantis.com. 60 IN A 10.0.1.1 ; weight=0\n")
+
+    with pytest.raises(ValueError, match=":1 invalid weight"):
+        zone.ZoneStore().load(str(path))
+
+
+def do_bit_opt() -> bytes:
+    return b"\x00" + struct.pack(">HHIH", 41, 1232, 0x8000, 0)
+
+
+# RRsets, the default address, the RFC 8482 HINFO, then their signed
+# forms with an RRSIG each and a compact denial
+
+@pytest.mark.parametrize("domain, rr_type, signed, answers", [
+    ("www.ricklantis.com", 1, False, 2),
+    ("default.ricklantis.com", 1, False, 1),
+    ("default.ricklantis.com", 255, False, 1),
+    ("www.ricklantis.com", 1, True, 3),
+    ("default.ricklantis.com", 1, True, 2),
+    ("nothing.ricklantis.com", 1, True, 0),
+])
+def test_answers_echo_the_question(serve, tmp_path, domain, rr_type, signed, answers):
+    settings = {"zone_suffix": "default"}
+
+    if signed:
+        dnssec.SigningKey.generate().save(str(tmp_path / "ricklantis.com.pem"))
+        settings.update(dnssec_key_dir=str(tmp_path), dnssec_presign_processes=1)
+
+    serve(**settings)
+
+    query = messages.query(domain, rr_type, additional=[do_bit_opt()] if signed else [])
+    response = req_handler.handle_query(query, CLIENT, True)
+    question_wire = messages.name(domain) + struct.pack(">HH", rr_type, 1)
+
+    assert (messages.header(response)["qdcount"], messages.header(response)["ancount"]) == (1, answers)
+    assert response[12:12 + len(question_wire)] == question_wire
@@ -0,0 +1,37 @@
+import socket
+
+import pytest
+
+import config
+import listeners
+
+import messages
+
+
+def test_default_receive_buffer_takes_large_queries():
+    server_config = config.from_dict({})
+    udp_listeners = listeners.UdpListeners(server_config.recv_buffer_size)
+    server = udp_listeners.bind("127.0.0.1", 0)
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    # An UPDATE adding a TXT record of 1500 octets
+
+    txt = b"".join(bytes([250]) + b"a" * 250 for _ in range(6))
+    update = bytes(messages.update("ricklantis.com", updates=[messages.record("big.ricklantis.com", 16, 1, 30, txt)]))
+    received = []
+
+    try:
+        client.sendto(update, server.getsockname())
+
+        while not received:
+            udp_listeners.poll(lambda data, addr, sock: received.append(data), 1.0)
+    finally:
+        client.close()
+        udp_listeners.close()
+
+    assert bytes(received[0]) == update
+
+
+def test_receive_buffer_can_not_be_smaller_than_edns_udp_size():
+    with pytest.raises(config.ConfigError, match="recv_buffer_size"):
+        config.from_dict({"recv_buffer_size": 1024, "edns_udp_size": 1232})
@@ -0,0 +1,97 @@
+import os
+import struct
+
+import pytest
+
+import cookies
+import req_handler
+
+import messages
+
+CLIENT = ("192.0.2.1", 1)
+
+
+def cookie_opt(option: bytes) -> bytes:
+    return messages.opt(options=struct.pack(">HH", cookies.OPTION_COOKIE, len(option)) + option)
+
+
+def reply_cookie(response: bytes) -> bytes:
+    """Data of the COOKIE option, the only option the response carries
+    """
+
+    start = response.rindex(struct.pack(">H", cookies.OPTION_COOKIE) + b"\x00")
+    length = struct.unpack(">H", response[start+2:start+4])[0]
+
+    return bytes(response[start+4:start+4+length])
+
+
+@pytest.fixture
+def now(monkeypatch):
+    clock = [1700000000]
+    monkeypatch.setattr(cookies.time, "time", lambda: clock[0])
+    return clock
+
+
+def test_client_cookie_gets_a_server_cookie_that_verifies(now):
+    jar = cookies.CookieJar(bytes(16))
+    client_cookie = os.urandom(8)
+
+    state, option = jar.check(client_cookie, CLIENT[0])
+
+    assert state == cookies.CLIENT_ONLY
+    assert option[:8] == client_cookie and len(option) == 24
+    assert option[8] == cookies.VERSION and struct.unpack(">I", option[12:16])[0] == now[0]
+
+    # Returned unchanged while fresh, and accepted by any server sharing the secret
+
+    assert jar.check(option, CLIENT[0]) == (cookies.VALID, option)
+    assert cookies.CookieJar(bytes(16)).check(option, CLIENT[0]) == (cookies.VALID, option)
+
+    assert cookies.CookieJar(b"\x01" * 16).check(option, CLIENT[0])[0] == cookies.CLIENT_ONLY
+    assert jar.check(option, "192.0.2.2")[0] == cookies.CLIENT_ONLY
+    assert jar.check(option[:8] + option[8:12] + bytes(12), CLIENT[0])[0] == cookies.CLIENT_ONLY
+
+
+def test_server_cookie_ages(now):
+    jar = cookies.CookieJar(bytes(16), rotation=3600)
+    _, option = jar.check(os.urandom(8), "2001:db8::1")
+
+    # Past REFRESH_AGE still valid with a new cookie, past MAX_AGE only a client cookie
+
+    now[0] += cookies.REFRESH_AGE + 1
+    state, refreshed = jar.check(option, "2001:db8::1")
+
+    assert state == cookies.VALID and refreshed != option
+    assert struct.unpack(">I", refreshed[12:16])[0] == now[0]
+
+    now[0] += cookies.MAX_AGE
+    assert jar.check(option, "2001:db8::1")[0] == cookies.CLIENT_ONLY
+
+    # A cookie made by a server a little ahead of this one
+
+    now[0] -= cookies.MAX_AGE + cookies.REFRESH_AGE + 1 + 60
+    assert jar.check(option, "2001:db8::1")[0] == cookies.VALID
+
+
+@pytest.mark.parametrize("length", [0, 7, 9, 15, 41])
+def test_malformed_cookie_lengths(length):
+    assert cookies.CookieJar().check(bytes(length), CLIENT[0]) == (cookies.MALFORMED, None)
+
+
+def test_queries_with_cookies(serve, now):
+    serve(dns_cookies=True, cookie_secret="00" * 16)
+
+    client_cookie = os.urandom(8)
+    response = req_handler.handle_query(messages.query("www.ricklantis.com", additional=[cookie_opt(client_cookie)]), CLIENT, True)
+    server_cookie = reply_cookie(response)
+
+    assert messages.header(response)["arcount"] == 1
+    assert server_cookie[:8] == client_cookie and len(server_cookie) == 24
+
+    response = req_handler.handle_query(messages.query("www.ricklantis.com", additional=[cookie_opt(server_cookie)]), CLIENT, True)
+
+    assert reply_cookie(response) == server_cookie
+
+    malformed = req_handler.handle_query(messages.query("www.ricklantis.com", additional=[cookie_opt(bytes(5))]), CLIENT, True)
+
+    assert messages.header(malformed)["rcode"] == 1
@@ -0,0 +1,109 @@
+import socket
+import struct
+
+import pytest
+
+import batch
+import listeners
+import req_handler
+
+import messages
+
+TRUNCATED_QUESTION = messages.query("www.ricklantis.com")[:-3]
+
+UNKNOWN_TYPE = messages.query("www.ricklantis.com", 99)
+
+UNKNOWN_OPCODE = messages.query("www.ricklantis.com", flags=3 << 11)
+
+
+@pytest.mark.parametrize("data, rcode, question_count", [
+    (TRUNCATED_QUESTION, 1, 0),
+    (bytearray(struct.pack(">HHHHHH", 0x1234, 0, 0, 0, 0, 0)), 1, 0),
+    (messages.query("www.ricklantis.com", 64), 4, 1),
+    (UNKNOWN_TYPE, 4, 1),
+    (UNKNOWN_OPCODE, 4, 1),
+    (messages.query("www.ricklantis.com", flags=15 << 11), 4, 1),
+])
+def test_unparsable_queries_get_an_error(serve, data, rcode, question_count):
+    serve()
+
+    head = messages.header(req_handler.handle_query(data, ("127.0.0.1", 1), True))
+
+    assert (head["id"], head["rcode"], head["qdcount"]) == (0x1234, rcode, question_count)
+
+
+def test_responses_and_short_datagrams_are_not_answered(serve):
+    serve()
+
+    assert req_handler.handle_query(bytearray(b"\x12\x34\x81"), ("127.0.0.1", 1), True) is None
+    assert req_handler.handle_query(messages.query("www.ricklantis.com", 99, flags=0x8000), ("127.0.0.1", 1), True) is None
+
+
+@pytest.mark.parametrize("batch_parse", [False, True])
+def test_bad_datagrams_do_not_stop_the_loop(serve, batch_parse):
+    serve()
+
+    udp_listeners = listeners.UdpListeners()
+    server = udp_listeners.bind("127.0.0.1", 0)
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.settimeout(2)
+
+    try:
+        for data in (TRUNCATED_QUESTION, UNKNOWN_TYPE, UNKNOWN_OPCODE, messages.query("www.ricklantis.com")):
+            client.sendto(data, server.getsockname())
+
+        handled = 0
+
+        while handled < 4:
+            handled += udp_listeners.poll(
+                req_handler.request_handler, 1.0, batch.BatchHandler() if batch_parse else None)
+
+        rcodes = sorted(messages.header(client.recv(512))["rcode"] for _ in range(4))
+
+        assert rcodes == [0, 1, 4, 4]
+    finally:
+        client.close()
+        udp_listeners.close()
+
+
+def test_unexpected_errors_answer_servfail(serve, monkeypatch):
+    serve()
+
+    def fail(*args):
+        raise RuntimeError("bug")
+
+    monkeypatch.setattr(req_handler, "build_response", fail)
+
+    sent = []
+
+    class Socket:
+        def sendto(self, data, addr):
+            sent.append(bytes(data))
+
+    req_handler.request_handler(messages.query("nothing.example"), ("127.0.0.1", 1), Socket())
+
+    assert messages.header(sent[0])["rcode"] == 2
+
+
+def test_failing_callbacks_do_not_stop_the_loop():
+    udp_listeners = listeners.UdpListeners()
+    reader, writer = socket.socketpair()
+    calls = []
+
+    def callback(sock):
+        calls.append(sock.recv(16))
+        raise RuntimeError("bug")
+
+    try:
+        udp_listeners.register(reader, callback)
+        writer.send(b"a")
+        udp_listeners.poll(None, 1.0)
+        writer.send(b"b")
+        udp_listeners.poll(None, 1.0)
+
+        assert calls == [b"a", b"b"]
+    finally:
+        udp_listeners.unregister(reader)
+        udp_listeners.close()
+        reader.close()
+        writer.close()
@@ -0,0 +1,35 @@
+import os
+import subprocess
+import sys
+
+import policy
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_compile_command_writes_a_list_open_can_map(tmp_path):
+    source = tmp_path / "blocklist.txt"
+    source.write_text("# ads\nads.example\n*.tracker.example\n")
+    destination = tmp_path / "blocklist.hpol"
+
+    subprocess.run([sys.executable, os.path.join(REPOSITORY, "policy.py"), "compile", str(source), str(destination)],
+                   check=True, capture_output=True)
+
+    engine = policy.PolicyEngine([policy.PolicyList.open(str(destination), policy.PolicyAction.NXDOMAIN)])
+
+    assert engine.lookup("ads.example") is not None
+    assert engine.lookup("a.b.tracker.example") is not None
+    assert engine.lookup("tracker.example") is None
+    assert sorted(os.listdir(tmp_path)) == ["blocklist.hpol", "blocklist.txt"]
+
+
+def test_compile_replaces_a_mapped_list(tmp_path):
+    path = str(tmp_path / "blocklist.hpol")
+
+    policy.PolicyList.from_names(["old.example"], policy.PolicyAction.NXDOMAIN).compile(path)
+    mapped = policy.PolicyList.open(path, policy.PolicyAction.NXDOMAIN)
+
+    policy.PolicyList.from_names(["new.example", "other.example"], policy.PolicyAction.NXDOMAIN).compile(path)
+
+    assert mapped.matches(policy.PolicyEngine.name_digests("old.example"))
+    assert len(policy.PolicyList.open(path, policy.PolicyAction.NXDOMAIN)) == 2
@@ -0,0 +1,43 @@
+import replay
+import req_handler
+import resource_record
+
+
+def test_in_process_replay_counts_packets_the_handler_raises_on(serve, monkeypatch):
+    serve()
+
+    queries = [
+        replay.ReplayQuery(0.0, replay.build_query(name, resource_record.RrType.A, number), 0)
+        for number, name in enumerate(["www.ricklantis.com", "crash.ricklantis.com", "ns1.ricklantis.com"])
+    ]
+
+    request_handler = req_handler.request_handler
+
+    def crashing_handler(data, addr, sock):
+        if b"crash" in data:
+            raise RuntimeError("boom")
+
+        request_handler(data, addr, sock)
+
+    monkeypatch.setattr(req_handler, "request_handler", crashing_handler)
+
+    report = replay.replay_in_process(queries)
+
+    assert (report.sent, report.answered, report.errors) == (3, 2, 1)
+    assert "errors:           1 (first: RuntimeError('boom'))" in str(report)
+
+
+def test_query_log_lines_that_can_not_be_read_are_skipped(tmp_path, capsys):
+    path = tmp_path / "queries.jsonl"
+    path.write_text("\n".join([
+        '{"name": "www.ricklantis.com", "rcode": "NOERROR"}',
+        '{"name": "www.ricklantis.com", "rcode": "BADVERS"}',
+        '{"name": "www.ricklantis.com", "type": "NOTATYPE"}',
+        'not json',
+        '{"name": "mail.ricklantis.com", "type": "aaaa", "rcode": "nxdomain"}',
+    ]))
+
+    queries = replay.read_query_log(str(path))
+
+    assert [query.expected_rcode for query in queries] == [0, 3]
+    assert "Skipped 3 unreadable lines" in capsys.readouterr().out
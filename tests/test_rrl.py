@@ -0,0 +1,92 @@
+import os
+import struct
+
+import pytest
+
+import cookies
+import req_handler
+import rrl
+
+import messages
+
+WWW = ("www.ricklantis.com", 1)
+
+
+@pytest.fixture
+def now(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(rrl.time, "monotonic", lambda: clock[0])
+    return clock
+
+
+def test_bucket_bursts_then_drops_and_slips(now):
+    limiter = rrl.ResponseRateLimiter(responses_per_second=1, window=3, slip=2)
+
+    decisions = [limiter.check("198.51.100.7", WWW) for _ in range(7)]
+
+    assert decisions == [rrl.SEND] * 3 + [rrl.DROP, rrl.SLIP, rrl.DROP, rrl.SLIP]
+    assert (limiter.dropped, limiter.slipped) == (2, 2)
+
+    # One second refills one response
+
+    now[0] += 1
+    assert limiter.check("198.51.100.7", WWW) == rrl.SEND
+    assert limiter.check("198.51.100.7", WWW) != rrl.SEND
+
+
+def test_buckets_are_per_network_and_answer(now):
+    limiter = rrl.ResponseRateLimiter(responses_per_second=1, window=1, slip=0, ipv4_prefix=24, ipv6_prefix=56)
+
+    assert limiter.check("198.51.100.7", WWW) == rrl.SEND
+    assert limiter.check("198.51.100.200", WWW) == rrl.DROP
+    assert limiter.check("198.51.101.7", WWW) == rrl.SEND
+    assert limiter.check("198.51.100.7", ("mail.ricklantis.com", 1)) == rrl.SEND
+
+    assert limiter.check("2001:db8:0:1::1", WWW) == rrl.SEND
+    assert limiter.check("2001:db8:0:2::1", WWW) == rrl.DROP
+    assert limiter.check("2001:db8:0:100::1", WWW) == rrl.SEND
+
+
+def query(*additional: bytes) -> bytearray:
+    return messages.query("www.ricklantis.com", additional=list(additional))
+
+
+def cookie_opt(option: bytes) -> bytes:
+    return messages.opt(options=struct.pack(">HH", cookies.OPTION_COOKIE, len(option)) + option)
+
+
+def test_limited_udp_responses(serve, now):
+    serve(rrl_responses_per_second=1, rrl_window=1, rrl_slip=2, dns_cookies=True)
+
+    client = ("198.51.100.7", 1)
+
+    assert messages.header(req_handler.handle_query(query(), client, True))["rcode"] == 0
+    assert req_handler.handle_query(query(), client, True) is None
+
+    slipped = messages.header(req_handler.handle_query(query(), client, True))
+
+    assert slipped["tc"] and slipped["ancount"] == 0
+
+    # TCP proves the address, it is never limited
+
+    assert messages.header(req_handler.handle_query(query(), client, False))["ancount"] == 2
+
+
+def test_cookies_lift_the_limit(serve, now):
+    serve(rrl_responses_per_second=1, rrl_window=1, rrl_slip=1, dns_cookies=True)
+
+    client = ("198.51.100.7", 1)
+    client_cookie = os.urandom(8)
+
+    assert messages.header(req_handler.handle_query(query(cookie_opt(client_cookie)), client, True))["rcode"] == 0
+
+    # A limited client that sent a cookie gets BADCOOKIE with a server cookie to send back
+
+    bad_cookie = req_handler.handle_query(query(cookie_opt(client_cookie)), client, True)
+    server_cookie = bytes(bad_cookie[-24:])
+
+    assert messages.header(bad_cookie)["rcode"] == cookies.BADCOOKIE & 0x0F
+    assert server_cookie[:8] == client_cookie
+
+    for _ in range(3):
+        assert messages.header(req_handler.handle_query(query(cookie_opt(server_cookie)), client, True))["ancount"] == 2
@@ -0,0 +1,210 @@
+import socket
+import struct
+import time
+
+import pytest
+
+import listeners
+import req_handler
+import tcp_server
+
+import messages
+
+AXFR = 252
+
+IXFR = 251
+
+
+@pytest.fixture
+def tcp(serve):
+    """A TcpServer on a loopback port, set up with serve(**settings)
+    """
+
+    udp_listeners = listeners.UdpListeners()
+    servers = []
+
+    def start(max_connections: int = 256, idle_timeout: float = 10.0, **settings) -> 'tcp_server.TcpServer':
+        serve(**settings)
+
+        server = tcp_server.TcpServer(udp_listeners, ("127.0.0.1/32",), max_connections, idle_timeout)
+        server.bind("127.0.0.1", 0, v6only=False)
+        servers.append(server)
+
+        return server
+
+    yield start
+
+    for server in servers:
+        server.close()
+
+    udp_listeners.close()
+
+
+def pump(server: 'tcp_server.TcpServer', rounds: int = 20, timeout: float = 0.01) -> None:
+    for _ in range(rounds):
+        server._udp_listeners.poll(None, timeout)
+
+
+def connect(server: 'tcp_server.TcpServer', rcvbuf: int = None) -> 'socket.socket':
+    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+    if rcvbuf is not None:
+        client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+
+    client.connect(server.sockets[0].getsockname())
+    client.settimeout(2.0)
+
+    return client
+
+
+def framed(message: bytes) -> bytes:
+    return struct.pack(">H", len(message)) + message
+
+
+def read_messages(client: 'socket.socket', server: 'tcp_server.TcpServer', count: int = 1) -> 'list[bytes]':
+    """count length prefixed messages, polling server while waiting for them
+    """
+
+    data = bytearray()
+    messages_read = []
+    client.settimeout(0.001)
+
+    while len(messages_read) < count:
+        pump(server, 1, 0)
+
+        try:
+            chunk = client.recv(65535)
+        except socket.timeout:
+            continue
+
+        if not chunk:
+            raise ConnectionError("Closed")
+
+        data += chunk
+
+        while len(data) >= 2 and len(data) >= 2 + struct.unpack(">H", data[:2])[0]:
+            length = struct.unpack(">H", data[:2])[0]
+            messages_read.append(bytes(data[2:2+length]))
+            del data[:2+length]
+
+    return messages_read
+
+
+def read_message(client: 'socket.socket', server: 'tcp_server.TcpServer') -> bytes:
+    return read_messages(client, server)[0]
+
+
+def test_idle_connections_make_room_for_new_ones(tcp):
+    server = tcp(max_connections=4, idle_timeout=0.2)
+
+    idle = [connect(server) for _ in range(4)]
+    pump(server)
+
+    assert server.connection_count == 4
+
+    time.sleep(0.3)
+
+    active = connect(server)
+    active.sendall(framed(messages.query("www.ricklantis.com")))
+
+    assert messages.header(read_message(active, server))["ancount"] == 2
+    assert server.connection_count == 1
+    assert all(client.recv(1) == b"" for client in idle)
+
+
+def test_slow_reader_does_not_block_the_loop(tcp):
+    server = tcp()
+    client = connect(server, rcvbuf=4096)
+    pump(server)
+
+    for connection in server._connections:
+        connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+
+    # Far more answers than the socket buffers hold, written without reading any
+
+    count = 300
+    client.sendall(b"".join(framed(messages.query("big.ricklantis.com", 16, number)) for number in range(count)))
+
+    start = time.monotonic()
+    pump(server, 50, 0)
+
+    assert time.monotonic() - start < 2.0
+    assert any(state.unsent for state in server._connections.values())
+
+    # A second client is answered while the first one is backed up
+
+    other = connect(server)
+    other.sendall(framed(messages.query("www.ricklantis.com")))
+
+    assert messages.header(read_message(other, server))["ancount"] == 2
+
+    ids = [messages.header(response)["id"] for response in read_messages(client, server, count)]
+
+    assert ids == list(range(count))
+
+
+def test_axfr_streams_the_whole_zone(tcp):
+    server = tcp()
+    client = connect(server)
+
+    client.sendall(framed(messages.query("ricklantis.com", AXFR)))
+
+    # SOA, the ten other records, SOA again
+
+    answers = 0
+
+    while answers < 12:
+        response = read_message(client, server)
+        head = messages.header(response)
+
+        assert head["rcode"] == 0
+        answers += head["ancount"]
+
+    assert answers == 12
+
+
+def test_ixfr_sends_the_journal_deltas(tcp, tmp_path):
+    server = tcp(journal_dir=str(tmp_path), update_allow=["127.0.0.0/8"])
+
+    added = messages.record("host1.ricklantis.com", 1, 1, 30, socket.inet_aton("10.2.0.1"))
+    assert messages.header(req_handler.handle_query(messages.update("ricklantis.com", updates=[added]), ("127.0.0.1", 1)))["rcode"] == 0
+
+    soa = messages.record("ricklantis.com", 6, 1, 3600, messages.name("ns1.ricklantis.com") +
+                          messages.name("admin.ricklantis.com") + struct.pack(">IIIII", 1, 7200, 900, 1209600, 300))
+    query = messages.query("ricklantis.com", IXFR)
+    query[8:10] = b"\x00\x01"
+
+    client = connect(server)
+    client.sendall(framed(bytes(query) + soa))
+
+    response = read_message(client, server)
+
+    # New SOA, old SOA, nothing deleted, new SOA, the added record, new SOA
+
+    assert messages.header(response)["ancount"] == 5
+    assert b"\x05host1" in response
+
+
+def test_transfer_is_refused_outside_transfer_allow(tcp, monkeypatch):
+    server = tcp()
+    monkeypatch.setattr(server, "_transfer_allow", ("192.0.2.0/24",))
+
+    client = connect(server)
+    client.sendall(framed(messages.query("ricklantis.com", AXFR)))
+
+    assert messages.header(read_message(client, server))["rcode"] == 5
+
+
+def test_responses_sent_to_the_server_are_dropped(tcp):
+    server = tcp()
+    client = connect(server)
+
+    # QR set, root QNAME, a type no parser knows
+
+    response = bytes(messages.query("", 9999, flags=0x8000))
+    client.sendall(framed(response) + framed(messages.query("www.ricklantis.com")))
+
+    answer = read_message(client, server)
+
+    assert messages.header(answer)["id"] == 0x1234 and messages.header(answer)["ancount"] == 2
+    assert server.connection_count == 1
@@ -0,0 +1,114 @@
+import datetime
+import http.client
+import socket
+import ssl
+import struct
+import threading
+
+import pytest
+
+import listeners
+import tls_server
+
+import messages
+
+x509 = pytest.importorskip("cryptography.x509")
+
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+
+# QR set, root QNAME, a type no parser knows, handle_query answers nothing
+
+RESPONSE = bytes(messages.query("", 9999, flags=0x8000))
+
+
+@pytest.fixture
+def certificate(tmp_path) -> 'tuple[str, str]':
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(x509.NameOID.COMMON_NAME, "localhost")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key()) \
+        .serial_number(1).not_valid_before(now - datetime.timedelta(days=1)) \
+        .not_valid_after(now + datetime.timedelta(days=1)).sign(key, hashes.SHA256())
+
+    cert_path = tmp_path / "cert.pem"
+    key_path = tmp_path / "key.pem"
+    cert_path.write_bytes(cert.public_bytes(serialization.Encoding.PEM))
+    key_path.write_bytes(key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()))
+
+    return str(cert_path), str(key_path)
+
+
+@pytest.fixture
+def tls(serve, certificate):
+    """A running TlsServer, and the addresses of its DoT and DoH listeners
+    """
+
+    serve()
+
+    udp_listeners = listeners.UdpListeners()
+    server = tls_server.TlsServer(
+        udp_listeners,
+        tls_server.new_context(*certificate, ["dot"]),
+        tls_server.new_context(*certificate, ["http/1.1"]),
+        idle_timeout=5.0
+    )
+    dot = server.bind("127.0.0.1", 0, v6only=False).getsockname()
+    doh = server.bind("127.0.0.1", 0, doh=True, v6only=False).getsockname()
+    server.start()
+
+    stop = threading.Event()
+
+    def loop():
+        while not stop.is_set():
+            udp_listeners.poll(None, 0.05)
+
+    thread = threading.Thread(target=loop, daemon=True)
+    thread.start()
+
+    yield dot, doh
+
+    stop.set()
+    thread.join()
+    server.close()
+    udp_listeners.close()
+
+
+def client_context() -> 'ssl.SSLContext':
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+def test_dot_closes_on_a_message_it_does_not_answer(tls):
+    dot, _ = tls
+
+    with socket.create_connection(dot, timeout=5) as raw, client_context().wrap_socket(raw) as client:
+        client.sendall(struct.pack(">H", len(RESPONSE)) + RESPONSE)
+
+        assert client.recv(2) == b""
+
+    # The server still answers the next client
+
+    with socket.create_connection(dot, timeout=5) as raw, client_context().wrap_socket(raw) as client:
+        query = bytes(messages.query("www.ricklantis.com"))
+        client.sendall(struct.pack(">H", len(query)) + query)
+
+        assert len(client.recv(2)) == 2
+
+
+def test_doh_answers_400_to_a_message_it_does_not_answer(tls):
+    _, doh = tls
+
+    connection = http.client.HTTPSConnection(*doh, timeout=5, context=client_context())
+
+    for body, status in ((RESPONSE, 400), (bytes(messages.query("www.ricklantis.com")), 200)):
+        connection.request("POST", "/dns-query", body, {"Content-Type": "application/dns-message"})
+        response = connection.getresponse()
+        response.read()
+
+        assert response.status == status
+
+    connection.close()
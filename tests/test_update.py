@@ -0,0 +1,101 @@
+import os
+import socket
+import tempfile
+
+import pytest
+
+import config
+import journal
+import req_handler
+import resource_record
+
+import messages
+
+A = resource_record.RrType.A
+
+
+def add_host(number: int) -> bytearray:
+    return messages.update("ricklantis.com", updates=[
+        messages.record("host{}.ricklantis.com".format(number), 1, 1, 30, socket.inet_aton("10.2.0.{}".format(number)))
+    ])
+
+
+def send(message: bytearray) -> int:
+    return messages.header(req_handler.handle_query(message, ("127.0.0.1", 1)))["rcode"]
+
+
+def test_updates_survive_restarts_past_compaction(serve, tmp_path, monkeypatch):
+
+    # A journal keeping 5 deltas is compacted on the first restart after 12 updates
+
+    class SmallJournal(journal.FileJournal):
+        def __init__(self, path, fsync_interval=0.05):
+            super().__init__(path, fsync_interval, max_deltas=5)
+
+    monkeypatch.setattr(journal, "FileJournal", SmallJournal)
+
+    settings = {"journal_dir": str(tmp_path), "update_allow": ["127.0.0.0/8"]}
+    store = serve(**settings).zone_store
+
+    for number in range(1, 13):
+        assert send(add_host(number)) == 0
+
+    assert store.serial("ricklantis.com") == 13
+
+    for restart in range(3):
+        store = serve(**settings).zone_store
+
+        assert store.serial("ricklantis.com") == 13
+        assert all(store.get("host{}.ricklantis.com".format(number), A) is not None for number in range(1, 13))
+
+        # Secondaries can still follow the newest deltas with IXFR
+
+        assert len(store.journal.deltas_since("ricklantis.com", 8)) == 5
+        assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
+
+    assert send(add_host(13)) == 0
+
+    store = serve(**settings).zone_store
+
+    assert store.serial("ricklantis.com") == 14
+    assert store.get("host13.ricklantis.com", A) is not None
+
+
+def test_failed_journal_write_leaves_the_zone_unchanged(serve, tmp_path):
+    store = serve(journal_dir=str(tmp_path), update_allow=["127.0.0.0/8"]).zone_store
+
+    def fail(apex, delta):
+        raise OSError("disk full")
+
+    store.journal.append = fail
+
+    assert send(add_host(1)) == 2  # SERVFAIL
+    assert store.get("host1.ricklantis.com", A) is None
+    assert store.serial("ricklantis.com") == 1
+
+
+def test_compaction_writes_through_a_file_of_its_own(tmp_path, monkeypatch):
+    path = str(tmp_path / "default.journal")
+    names = []
+    mkstemp = tempfile.mkstemp
+
+    def recording_mkstemp(*args, **kwargs):
+        names.append(mkstemp(*args, **kwargs))
+        return names[-1]
+
+    monkeypatch.setattr(tempfile, "mkstemp", recording_mkstemp)
+
+    for _ in range(2):
+        file_journal = journal.FileJournal(path)
+        file_journal.compact({})
+        file_journal.close()
+
+    assert names[0][1] != names[1][1] and os.path.dirname(names[0][1]) == str(tmp_path)
+    assert os.listdir(tmp_path) == ["default.journal"]
+
+
+def test_journal_with_workers_needs_prefork_warmup(tmp_path):
+    with pytest.raises(config.ConfigError, match="prefork_warmup"):
+        config.from_dict({"journal_dir": str(tmp_path), "workers": 2, "prefork_warmup": False})
+
+    config.from_dict({"journal_dir": str(tmp_path), "workers": 2})
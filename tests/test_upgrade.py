@@ -0,0 +1,85 @@
+import json
+import os
+import socket
+import threading
+
+import pytest
+
+import upgrade
+
+
+def open_fds() -> int:
+    return len(os.listdir("/proc/self/fd"))
+
+
+def old_server(path: str, manifest: bytes, sockets: 'list[socket.socket]') -> threading.Thread:
+    """Hand manifest and sockets to the first server connecting to path
+    """
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    listener.bind(path)
+    listener.listen(1)
+
+    def serve():
+        connection, _ = listener.accept()
+
+        with connection, listener:
+            socket.send_fds(connection, [manifest], [sock.fileno() for sock in sockets])
+            connection.recv(16)
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+
+    return thread
+
+
+@pytest.fixture
+def listening():
+    sockets = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in range(2)]
+
+    for sock in sockets:
+        sock.bind(("127.0.0.1", 0))
+
+    yield sockets
+
+    for sock in sockets:
+        sock.close()
+
+
+def manifest_of(sockets: 'list[socket.socket]') -> bytes:
+    return json.dumps([["udp", *sock.getsockname()] for sock in sockets]).encode()
+
+
+def test_take_over_matches_sockets_to_the_manifest(tmp_path, listening):
+    path = str(tmp_path / "upgrade.sock")
+    thread = old_server(path, manifest_of(listening), listening)
+
+    sockets, connection = upgrade.take_over(path)
+    upgrade.report_ready(connection)
+    thread.join()
+
+    for sock in listening:
+        taken = sockets[upgrade.endpoint_key("udp", *sock.getsockname())]
+
+        assert taken.getsockname() == sock.getsockname()
+        taken.close()
+
+
+@pytest.mark.parametrize("manifest_count, socket_count, max_sockets", [
+    (2, 1, upgrade.MAX_SOCKETS),
+    (1, 2, upgrade.MAX_SOCKETS),
+    (2, 2, 1),
+])
+def test_take_over_refuses_a_mismatched_handoff(tmp_path, monkeypatch, listening, manifest_count, socket_count, max_sockets):
+    monkeypatch.setattr(upgrade, "MAX_SOCKETS", max_sockets)
+
+    path = str(tmp_path / "upgrade.sock")
+    fds_before = open_fds()
+    thread = old_server(path, manifest_of(listening[:manifest_count]), listening[:socket_count])
+
+    with pytest.raises(ConnectionError):
+        upgrade.take_over(path)
+
+    thread.join()
+
+    assert open_fds() == fds_before
@@ -0,0 +1,96 @@
+import os
+import struct
+
+import pytest
+
+import edns
+import req_handler
+
+import messages
+
+LAB_ZONE = """
+ricklantis.com.      3600 IN SOA ns1.ricklantis.com. admin.ricklantis.com. 1 7200 900 1209600 300
+www.ricklantis.com.  60   IN A   192.168.7.7
+"""
+
+
+def client_subnet(address: bytes, source_prefix_length: int) -> bytes:
+    data = struct.pack(">HBB", 1, source_prefix_length, 0) + address
+    return struct.pack(">HH", edns.OPTION_CLIENT_SUBNET, len(data)) + data
+
+
+def reply_options(response: bytes) -> 'dict[int, bytes]':
+    """Options of the OPT record ending response, which must be its only one
+    """
+
+    head = messages.header(response)
+    opt = edns.parse_opt(response, len(response) - _opt_length(response), 1)
+
+    assert head["arcount"] == 1 and opt is not None
+
+    return opt.options
+
+
+def _opt_length(response: bytes) -> int:
+
+    # Walk back over options until the fixed part of an OPT record lines up
+
+    for length in range(11, len(response)):
+        start = len(response) - length
+        if response[start] == 0 and response[start+1:start+3] == b"\x00\x29" and \
+                int.from_bytes(response[start+9:start+11], "big") == length - 11:
+            return length
+
+    raise AssertionError("No OPT record")
+
+
+@pytest.fixture
+def lab(serve, tmp_path):
+    path = tmp_path / "lab.zone"
+    path.write_text(LAB_ZONE)
+
+    def setup(**settings):
+        return serve(view=[{"name": "lab", "zone_files": [str(path)], "prefixes": ["10.1.0.0/16"]}], **settings)
+
+    return setup
+
+
+def test_client_subnet_is_echoed_with_the_view_scope(lab):
+    lab()
+
+    inside = req_handler.handle_query(messages.query("www.ricklantis.com", additional=[
+        messages.opt(options=client_subnet(bytes([10, 1, 2]), 24))]), ("127.0.0.1", 1), True)
+
+    assert bytes([192, 168, 7, 7]) in inside
+    assert reply_options(inside)[edns.OPTION_CLIENT_SUBNET] == struct.pack(">HBB", 1, 24, 16) + bytes([10, 1, 2])
+
+    outside = req_handler.handle_query(messages.query("www.ricklantis.com", additional=[
+        messages.opt(options=client_subnet(bytes([192, 0, 2]), 24))]), ("127.0.0.1", 1), True)
+
+    assert bytes([192, 168, 7, 7]) not in outside
+
+    # 128.0.0.0/1 holds no view prefix
+
+    assert reply_options(outside)[edns.OPTION_CLIENT_SUBNET][3] == 1
+
+
+def test_client_subnet_and_cookie_share_one_opt_record(lab):
+    lab(dns_cookies=True)
+
+    client_cookie = os.urandom(8)
+    response = req_handler.handle_query(messages.query("www.ricklantis.com", additional=[messages.opt(options=(
+        client_subnet(bytes([10, 1, 2]), 24) + struct.pack(">HH", 10, 8) + client_cookie))]), ("127.0.0.1", 1), True)
+
+    options = reply_options(response)
+
+    assert options[edns.OPTION_CLIENT_SUBNET][3] == 16
+    assert options[10][:8] == client_cookie
+
+
+def test_no_client_subnet_without_views(serve):
+    serve(dns_cookies=True)
+
+    response = req_handler.handle_query(messages.query("www.ricklantis.com", additional=[
+        messages.opt(options=client_subnet(bytes([10, 1, 2]), 24))]), ("127.0.0.1", 1), True)
+
+    assert messages.header(response)["arcount"] == 0
@@ -0,0 +1,353 @@
+import base64
+import binascii
+import collections
+import concurrent.futures
+import http.server
+import socket
+import ssl
+import threading
+import urllib.parse
+
+import listeners
+import req_handler
+
+# DNS over TLS and DNS over HTTPS.
+
+# https://datatracker.ietf.org/doc/html/rfc7858
+
+# https://datatracker.ietf.org/doc/html/rfc8484
+
+# DoT carries the same two octet length framed messages as TCP. DoH
+# carries one message per HTTP/1.1 request, POSTed as
+# application/dns-message or sent in the dns parameter of a GET:
+
+# GET /dns-query?dns=AAABAAABAAAAAAAAA3d3dwdleGFtcGxlA2NvbQAAAQAB
+
+# Listening sockets share the UDP selector and are accepted from the
+# packet loop. Every connection then gets a thread for its handshake,
+# reads and writes, which may block for as long as the client likes.
+# Queries are still answered by the packet loop: a thread queues the
+# message, wakes the loop through a socket pair and waits for the answer,
+# so handle_query, its caches and counters stay single threaded.
+
+# Handshakes are what make TLS expensive. Contexts are created before the
+# workers are forked, so every worker holds the same session ticket keys
+# and a client resumes its session whichever worker accepts it. Clients
+# keep connections open for idle_timeout seconds between queries.
+
+# Octets of a DoH request body accepted, one DNS message
+MAX_BODY = 65535
+
+
+def new_context(certificate: str, private_key: str, alpn: 'list[str]', session_tickets: int = 2) -> 'ssl.SSLContext':
+    """Server side TLS context for one protocol.
+
+    Args:
+        certificate (str): PEM certificate chain, the server's certificate first
+        private_key (str): PEM private key of the certificate
+        alpn (list[str]): ALPN protocol ids offered. Ex: ['dot'], ['http/1.1']
+        session_tickets (int): TLS 1.3 tickets sent after every full handshake
+    """
+
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certificate, private_key)
+    context.set_alpn_protocols(alpn)
+
+    # TLS 1.2 resumes through tickets and the server session cache, which
+    # OpenSSL keeps on by default, TLS 1.3 through num_tickets tickets
+
+    context.num_tickets = session_tickets
+
+    return context
+
+
+class MainLoopBridge:
+    def __init__(self, udp_listeners: 'listeners.UdpListeners', timeout: float = 5.0):
+        """Answers queries from connection threads on the packet loop.
+
+        Args:
+            udp_listeners (listeners.UdpListeners): Selector of the packet loop
+            timeout (float): Seconds a thread waits for its answer
+        """
+
+        self._timeout = timeout
+        self._pending: 'collections.deque[tuple]' = collections.deque()
+
+        self._wake, self._waker = socket.socketpair()
+        self._wake.setblocking(False)
+        self._waker.setblocking(False)
+
+        udp_listeners.register(self._wake, self._drain)
+
+    def answer(self, message: bytearray, addr) -> bytearray:
+        """Called from a connection thread, returns handle_query's response
+        """
+
+        future = concurrent.futures.Future()
+        self._pending.append((message, addr, future))
+
+        # A full socket buffer already holds a wake up
+
+        try:
+            self._waker.send(b"\0")
+        except BlockingIOError:
+            pass
+
+        return future.result(self._timeout)
+
+    def _drain(self, sock: 'socket.socket') -> None:
+        try:
+            while sock.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+        while self._pending:
+            message, addr, future = self._pending.popleft()
+
+            try:
+                future.set_result(req_handler.handle_query(message, addr))
+            except Exception as error:
+                future.set_exception(error)
+
+
+class _DohRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "hamurai"
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        url = urllib.parse.urlsplit(self.path)
+
+        if url.path != self.server.doh_path:
+            self.send_error(404)
+            return
+
+        values = urllib.parse.parse_qs(url.query).get("dns")
+
+        if not values:
+            self.send_error(400, "Missing dns parameter")
+            return
+
+        # base64url without padding, RFC 8484 section 4.1
+
+        try:
+            message = base64.urlsafe_b64decode(values[0] + "=" * (-len(values[0]) % 4))
+        except (binascii.Error, ValueError):
+            self.send_error(400, "Invalid dns parameter")
+            return
+
+        self._answer(message)
+
+    def do_POST(self) -> None:
+        try:
+            length = int(self.headers.get("Content-Length", ""))
+        except ValueError:
+            self.close_connection = True
+            self.send_error(411)
+            return
+
+        if not 0 <= length <= MAX_BODY:
+            self.close_connection = True
+            self.send_error(413)
+            return
+
+        # Read before any error, the body would be taken for the next request
+
+        body = self.rfile.read(length)
+
+        if urllib.parse.urlsplit(self.path).path != self.server.doh_path:
+            self.send_error(404)
+            return
+
+        if self.headers.get("Content-Type", "").split(";")[0].strip() != "application/dns-message":
+            self.send_error(415)
+            return
+
+        self._answer(body)
+
+    def _answer(self, message: bytes) -> None:
+        if len(message) < 12:
+            self.send_error(400, "Not a DNS message")
+            return
+
+        try:
+            response = self.server.bridge.answer(bytearray(message), self.client_address)
+        except concurrent.futures.TimeoutError:
+            self.send_error(503)
+            return
+        except Exception:
+            self.send_error(400, "Not a DNS message")
+            return
+
+        if response is None:
+            self.send_error(400, "Not a DNS query")
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/dns-message")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+
+class TlsServer:
+    def __init__(self, udp_listeners: 'listeners.UdpListeners', dot_context: 'ssl.SSLContext' = None, doh_context: 'ssl.SSLContext' = None,
+                 max_connections: int = 256, idle_timeout: float = 30.0, doh_path: str = "/dns-query"):
+        """Args:
+            udp_listeners (listeners.UdpListeners): Selector the listening sockets are registered with
+            dot_context (ssl.SSLContext): Context of DoT listeners, see new_context
+            doh_context (ssl.SSLContext): Context of DoH listeners
+            max_connections (int): Open connections past this are closed right after accept
+            idle_timeout (float): Seconds a connection may wait for its handshake or next query
+            doh_path (str): URL path DoH is served on
+        """
+
+        self._udp_listeners = udp_listeners
+        self._dot_context = dot_context
+        self._doh_context = doh_context
+        self._max_connections = max_connections
+        self._idle_timeout = idle_timeout
+        self._sockets: 'list[socket.socket]' = []
+        self._doh_sockets: 'list[socket.socket]' = []
+
+        self._connection_count = 0
+        self._count_lock = threading.Lock()
+
+        self.doh_path = doh_path
+
+        # Keep alive for as long as any other connection may idle
+        self._doh_handler = type("DohRequestHandler", (_DohRequestHandler,), {"timeout": idle_timeout})
+
+        # Made in the worker, the packet loop it wakes is the worker's
+        self.bridge: 'MainLoopBridge' = None
+
+    @property
+    def sockets(self) -> 'list[socket.socket]':
+        return self._sockets
+
+    def contexts(self) -> 'dict[str, ssl.SSLContext]':
+        return {name: context for name, context in (("dot", self._dot_context), ("doh", self._doh_context)) if context is not None}
+
+    @property
+    def connection_count(self) -> int:
+        return self._connection_count
+
+    def is_doh(self, sock: 'socket.socket') -> bool:
+        return sock in self._doh_sockets
+
+    def add(self, sock: 'socket.socket', doh: bool = False) -> None:
+        sock.setblocking(False)
+        self._sockets.append(sock)
+
+        if doh:
+            self._doh_sockets.append(sock)
+
+        self._udp_listeners.register(sock, self._accept_doh if doh else self._accept_dot)
+
+    def bind(self, host: str, port: int, doh: bool = False, v6only: bool = True) -> 'socket.socket':
+        sock = listeners.open_tcp_socket(host, port, v6only)
+        self.add(sock, doh)
+        return sock
+
+    def start(self) -> None:
+        """Start answering, in the process that runs the packet loop
+        """
+
+        self.bridge = MainLoopBridge(self._udp_listeners, self._idle_timeout)
+
+    def _accept_dot(self, sock: 'socket.socket') -> None:
+        self._accept(sock, self._dot_context, self._serve_dot)
+
+    def _accept_doh(self, sock: 'socket.socket') -> None:
+        self._accept(sock, self._doh_context, self._serve_doh)
+
+    def _accept(self, sock: 'socket.socket', context: 'ssl.SSLContext', serve) -> None:
+        try:
+            connection, addr = sock.accept()
+        except (BlockingIOError, InterruptedError, ConnectionAbortedError):
+            return
+
+        with self._count_lock:
+            if self._connection_count >= self._max_connections:
+                connection.close()
+                return
+
+            self._connection_count += 1
+
+        threading.Thread(target=self._serve, args=(connection, addr, context, serve), name="tls-connection", daemon=True).start()
+
+    def _serve(self, connection: 'socket.socket', addr, context: 'ssl.SSLContext', serve) -> None:
+        try:
+            connection.setblocking(True)
+            connection.settimeout(self._idle_timeout)
+
+            # Answers are small writes, Nagle would hold each one back for
+            # the client's delayed ACK
+
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            with context.wrap_socket(connection, server_side=True) as tls_connection:
+                serve(tls_connection, addr)
+        except OSError:
+            pass
+        finally:
+            connection.close()
+
+            with self._count_lock:
+                self._connection_count -= 1
+
+    def _serve_dot(self, connection: 'ssl.SSLSocket', addr) -> None:
+        reader = connection.makefile("rb")
+
+        while True:
+            prefix = reader.read(2)
+
+            if len(prefix) < 2:
+                return
+
+            length = int.from_bytes(prefix, "big")
+            message = reader.read(length)
+
+            if len(message) < max(length, 12):
+                return
+
+            try:
+                response = self.bridge.answer(bytearray(message), addr)
+            except Exception:
+                return
+
+            # Responses sent to the server and the like get no answer, the
+            # connection is closed like for any other message it can not take
+
+            if response is None:
+                return
+
+            connection.sendall(len(response).to_bytes(2, "big") + response)
+
+    def _serve_doh(self, connection: 'ssl.SSLSocket', addr) -> None:
+
+        # Serves requests until the client closes, asks to, or stays idle too long
+
+        self._doh_handler(connection, addr, self)
+
+    def session_stats(self) -> str:
+        lines = []
+
+        for name, context in self.contexts().items():
+            stats = context.session_stats()
+            lines.append("{} handshakes {} resumed {} cached sessions {} connections {}".format(
+                name, stats["accept_good"], stats["hits"], stats["number"], self._connection_count))
+
+        return "\n".join(lines)
+
+    def close(self) -> None:
+        for sock in self._sockets:
+            self._udp_listeners.unregister(sock)
+            sock.close()
+
+        self._sockets = []
+        self._doh_sockets = []
@@ -0,0 +1,602 @@
+import socket
+
+import dns_header
+import journal
+import resource_record
+import rrset
+import util
+import views
+import xfr
+import zone
+
+# Dynamic updates. An UPDATE message names one zone, a list of
+# prerequisites that must hold, and a list of record additions and
+# deletions that are applied together or not at all.
+
+# https://datatracker.ietf.org/doc/html/rfc2136
+
+# Only the RRsets an update touches are rebuilt, every other RRset of the
+# zone and every other cached response stays as it is. The changes become
+# one journal.Delta, so secondaries pick them up with IXFR and a file
+# journal can replay them after a restart.
+
+#  +---------------------+
+#  |        Header       |
+#  +---------------------+
+#  |         Zone        | the zone to update, one SOA question
+#  +---------------------+
+#  |     Prerequisite    | RRs or RRsets which must (not) preexist
+#  +---------------------+
+#  |        Update       | RRs or RRsets to be added or deleted
+#  +---------------------+
+#  |   Additional Data   | additional data
+#  +---------------------+
+
+# Types that only exist in queries and can never be stored
+META_TYPES = (
+    resource_record.RrType.OPT.value,
+    resource_record.RrType.IXFR.value,
+    resource_record.RrType.AXFR.value,
+    resource_record.RrType.ANY.value,
+)
+
+# Types that may not be removed from a zone apex
+APEX_TYPES = (
+    resource_record.RrType.SOA.value,
+    resource_record.RrType.NS.value,
+)
+
+
+class UpdateError(Exception):
+    def __init__(self, rcode: 'dns_header.Rcode'):
+        super().__init__(rcode.name)
+        self.rcode = rcode
+
+
+def _read_records(message: bytearray, offset: int, count: int) -> 'tuple[list[tuple], int]':
+    """Read count records. Returns (name, type, class, ttl, rdata offset, rdata length)
+    for each and the offset after the last one
+    """
+
+    records = []
+
+    for _ in range(count):
+        name, offset = util.read_name(message, offset)
+
+        if offset + 10 > len(message):
+            raise UpdateError(dns_header.Rcode.FORMAT_ERROR)
+
+        rr_type = int.from_bytes(message[offset:offset+2], "big")
+        rr_class = int.from_bytes(message[offset+2:offset+4], "big")
+        ttl = int.from_bytes(message[offset+4:offset+8], "big")
+        rdata_length = int.from_bytes(message[offset+8:offset+10], "big")
+        offset += 10
+
+        if offset + rdata_length > len(message):
+            raise UpdateError(dns_header.Rcode.FORMAT_ERROR)
+
+        records.append((zone.normalize(name), rr_type, rr_class, ttl, offset, rdata_length))
+        offset += rdata_length
+
+    return records, offset
+
+
+def wire_to_value(rr_type: int, message: bytes, offset: int, length: int) -> bytes:
+    """Convert RDATA from a message to the value an rrset.RRset stores.
+    Names inside the RDATA may be compressed against the whole message.
+    """
+
+    end = offset + length
+
+    if rr_type == resource_record.RrType.A.value and length == 4:
+        return socket.inet_ntop(socket.AF_INET, bytes(message[offset:end])).encode()
+
+    if rr_type == resource_record.RrType.AAAA.value and length == 16:
+        return socket.inet_ntop(socket.AF_INET6, bytes(message[offset:end])).encode()
+
+    if rr_type in (resource_record.RrType.NS.value, resource_record.RrType.CNAME.value, resource_record.RrType.PTR.value):
+        return zone.normalize(util.read_name(message, offset)[0]).encode()
+
+    if rr_type == resource_record.RrType.MX.value:
+        exchange = util.read_name(message, offset + 2)[0]
+        return bytes(message[offset:offset+2]) + zone._name_wire(exchange)
+
+    if rr_type == resource_record.RrType.SRV.value:
+        target = util.read_name(message, offset + 6)[0]
+        return bytes(message[offset:offset+6]) + zone._name_wire(target)
+
+    if rr_type == resource_record.RrType.SOA.value:
+        mname, rname_offset = util.read_name(message, offset)
+        rname, numbers_offset = util.read_name(message, rname_offset)
+
+        if numbers_offset + 20 != end:
+            raise UpdateError(dns_header.Rcode.FORMAT_ERROR)
+
+        return zone._name_wire(mname) + zone._name_wire(rname) + bytes(message[numbers_offset:end])
+
+    if rr_type == resource_record.RrType.TXT.value:
+        return bytes(message[offset:end])
+
+    if rr_type in (resource_record.RrType.A.value, resource_record.RrType.AAAA.value):
+        raise UpdateError(dns_header.Rcode.FORMAT_ERROR)
+
+    raise UpdateError(dns_header.Rcode.NOT_IMPLEMENTED)
+
+
+def serial_greater(new: int, old: int) -> bool:
+    """Serial number arithmetic, RFC 1982 section 3.2
+    """
+
+    return 0 < (new - old) % 2**32 < 2**31
+
+
+def _with_serial(soa_value: bytes, serial: int) -> bytes:
+    offset = util.label_length(soa_value)
+    offset += util.label_length(soa_value, offset)
+
+    return soa_value[:offset] + serial.to_bytes(4, "big") + soa_value[offset+4:]
+
+
+class ZoneUpdate:
+    def __init__(self, store: 'zone.ZoneStore', apex: str):
+        """Changes to one zone, collected on top of the store and applied by commit.
+
+        Args:
+            store (zone.ZoneStore): Store holding the zone
+            apex (str): Name of the zone. Ex: 'ricklantis.com'
+        """
+
+        self._store = store
+        self._apex = apex
+
+        # (name, type value) -> [ttl, values, weights], or None once deleted
+        self._changes: 'dict[tuple[str, int], list]' = {}
+
+    def _current(self, name: str, rr_type: int) -> list:
+        key = (name, rr_type)
+
+        if key in self._changes:
+            return self._changes[key]
+
+        try:
+            record_set = self._store.get(name, resource_record.RrType(rr_type))
+        except ValueError:
+            return None
+
+        if record_set is None:
+            return None
+
+        return [record_set.ttl, list(record_set.values), list(record_set.weights)]
+
+    def values(self, name: str, rr_type: int) -> 'list[bytes]':
+        current = self._current(name, rr_type)
+
+        return current[1] if current is not None else []
+
+    def types_at(self, name: str) -> 'set[int]':
+        types = {record_set.rr_type.value for record_set in self._store.rrsets_at(name)}
+
+        for (changed_name, rr_type), current in self._changes.items():
+            if changed_name != name:
+                continue
+
+            if current is None:
+                types.discard(rr_type)
+            else:
+                types.add(rr_type)
+
+        return types
+
+    def add(self, name: str, rr_type: int, ttl: int, value: bytes) -> None:
+        types = self.types_at(name)
+        cname = resource_record.RrType.CNAME.value
+
+        # A CNAME can not share its name with other data, RFC 2136 section 3.4.2.2
+
+        if rr_type == cname and types - {cname}:
+            return
+
+        if rr_type != cname and cname in types:
+            return
+
+        current = self._current(name, rr_type)
+
+        if rr_type == resource_record.RrType.SOA.value:
+            if name != self._apex or current is None:
+                return
+
+            # An older serial is ignored, RFC 2136 section 3.4.2.2
+
+            if not serial_greater(journal.soa_serial(value), journal.soa_serial(current[1][0])):
+                return
+
+            self._changes[(name, rr_type)] = [ttl, [value], [1]]
+            return
+
+        if rr_type == cname:
+            current = None
+
+        if current is None:
+            self._changes[(name, rr_type)] = [ttl, [value], [1]]
+            return
+
+        _, values, weights = current
+
+        if value not in values:
+            values = values + [value]
+            weights = weights + [1]
+
+        # Every record of an RRset shares one TTL, the newest one wins
+
+        self._changes[(name, rr_type)] = [ttl, values, weights]
+
+    def delete_rrset(self, name: str, rr_type: int) -> None:
+        if name == self._apex and rr_type in APEX_TYPES:
+            return
+
+        if self._current(name, rr_type) is not None:
+            self._changes[(name, rr_type)] = None
+
+    def delete_name(self, name: str) -> None:
+        for rr_type in self.types_at(name):
+            self.delete_rrset(name, rr_type)
+
+    def delete_value(self, name: str, rr_type: int, value: bytes) -> None:
+        if name == self._apex and rr_type == resource_record.RrType.SOA.value:
+            return
+
+        current = self._current(name, rr_type)
+
+        if current is None or value not in current[1]:
+            return
+
+        ttl, values, weights = current
+        index = values.index(value)
+        values = values[:index] + values[index+1:]
+        weights = weights[:index] + weights[index+1:]
+
+        if not values:
+            if name == self._apex and rr_type == resource_record.RrType.NS.value:
+                return
+
+            self._changes[(name, rr_type)] = None
+            return
+
+        self._changes[(name, rr_type)] = [ttl, values, weights]
+
+    def set_soa(self, ttl: int, value: bytes) -> None:
+        self._changes[(self._apex, resource_record.RrType.SOA.value)] = [ttl, [value], [1]]
+
+    def commit(self) -> 'tuple[journal.Delta, set[str]]':
+        """Apply every change to the store. Returns the journal.Delta and the
+        names whose RRsets changed, or (None, empty set) when nothing changed.
+        """
+
+        delta, rebuilt = self.prepare()
+
+        return delta, self.apply(rebuilt)
+
+    def prepare(self) -> 'tuple[journal.Delta, dict[tuple[str, int], rrset.RRset]]':
+        """Build every changed RRset without touching the store. Returns the
+        journal.Delta and the RRsets for apply, None for deleted ones, or
+        (None, {}) when nothing changed. The SOA serial is incremented
+        unless the update set it.
+        """
+
+        soa_key = (self._apex, resource_record.RrType.SOA.value)
+        old_soa = self._store.get(self._apex, resource_record.RrType.SOA)
+        rebuilt: 'dict[tuple[str, int], rrset.RRset]' = {}
+        deleted = []
+        added = []
+
+        for (name, rr_type), current in self._changes.items():
+            old = self._store.get(name, resource_record.RrType(rr_type))
+            old_records = old.records if old is not None else []
+            new = None
+
+            if current is not None:
+                ttl, values, weights = current
+                new = rrset.RRset(name, resource_record.RrType(rr_type), ttl, values, weights)
+
+            new_records = new.records if new is not None else []
+
+            if old_records == new_records and (old is None or old.weights == new.weights):
+                continue
+
+            rebuilt[(name, rr_type)] = new
+
+            if (name, rr_type) != soa_key:
+                deleted += [record for record in old_records if record not in new_records]
+                added += [record for record in new_records if record not in old_records]
+
+        if not rebuilt:
+            return None, {}
+
+        if soa_key not in rebuilt:
+
+            # Serial arithmetic wraps at 32 bits, RFC 1982
+
+            serial = (journal.soa_serial(old_soa.values[0]) + 1) % 2**32
+            rebuilt[soa_key] = rrset.RRset(
+                self._apex,
+                resource_record.RrType.SOA,
+                old_soa.ttl,
+                [_with_serial(old_soa.values[0], serial)]
+            )
+
+        return journal.Delta(old_soa.records[0], rebuilt[soa_key].records[0], deleted, added), rebuilt
+
+    def apply(self, rebuilt: 'dict[tuple[str, int], rrset.RRset]') -> 'set[str]':
+        """Swap the RRsets from prepare into the store. Returns the names that changed
+        """
+
+        for (name, rr_type), new in rebuilt.items():
+            if new is None:
+                self._store.remove(name, resource_record.RrType(rr_type))
+            else:
+                self._store.add(new)
+
+        return {name for name, _ in rebuilt}
+
+
+def _in_zone(name: str, apex: str) -> bool:
+    return name == apex or name.endswith("." + apex)
+
+
+def _check_prerequisites(message: bytearray, prerequisites: 'list[tuple]', change: 'ZoneUpdate', apex: str) -> None:
+    """Raise UpdateError with the RCODE of the first prerequisite that does not hold,
+    RFC 2136 section 3.2
+    """
+
+    # (name, type) -> values every record of the RRset must match exactly
+    expected: 'dict[tuple[str, int], set[bytes]]' = {}
+
+    for name, rr_type, rr_class, ttl, offset, length in prerequisites:
+        if ttl != 0:
+            raise UpdateError(dns_header.Rcode.FORMAT_ERROR)
+
+        if not _in_zone(name, apex):
+            raise UpdateError(dns_header.Rcode.NOT_ZONE)
+
+        if rr_class == resource_record.RrClass.ANY.value:
+            if length != 0:
+                raise UpdateError(dns_header.Rcode.FORMAT_ERROR)
+
+            if rr_type == resource_record.RrType.ANY.value:
+                if not change.types_at(name):
+                    raise UpdateError(dns_header.Rcode.NAME_ERROR)
+
+            elif not change.values(name, rr_type):
+                raise UpdateError(dns_header.Rcode.NX_RRSET)
+
+        elif rr_class == resource_record.RrClass.NONE.value:
+            if length != 0:
+                raise UpdateError(dns_header.Rcode.FORMAT_ERROR)
+
+            if rr_type == resource_record.RrType.ANY.value:
+                if change.types_at(name):
+                    raise UpdateError(dns_header.Rcode.YX_DOMAIN)
+
+            elif change.values(name, rr_type):
+                raise UpdateError(dns_header.Rcode.YX_RRSET)
+
+        elif rr_class == resource_record.RrClass.IN.value:
+            if rr_type in META_TYPES:
+                raise UpdateError(dns_header.Rcode.FORMAT_ERROR)
+
+            value = wire_to_value(rr_type, message, offset, length)
+            expected.setdefault((name, rr_type), set()).add(value)
+
+        else:
+            raise UpdateError(dns_header.Rcode.FORMAT_ERROR)
+
+    for (name, rr_type), values in expected.items():
+        if set(change.values(name, rr_type)) != values:
+            raise UpdateError(dns_header.Rcode.NX_RRSET)
+
+
+def _prescan(message: bytearray, updates: 'list[tuple]', apex: str) -> 'list[tuple]':
+    """Check every update before anything is changed, RFC 2136 section 3.4.1.
+    Returns (name, type, class, ttl, value) for each
+    """
+
+    checked = []
+
+    for name, rr_type, rr_class, ttl, offset, length in updates:
+        if not _in_zone(name, apex):
+            raise UpdateError(dns_header.Rcode.NOT_ZONE)
+
+        value = None
+
+        if rr_class == resource_record.RrClass.IN.value:
+            if rr_type in META_TYPES:
+                raise UpdateError(dns_header.Rcode.FORMAT_ERROR)
+
+            value = wire_to_value(rr_type, message, offset, length)
+
+        elif rr_class == resource_record.RrClass.ANY.value:
+            if ttl != 0 or length != 0 or rr_type in META_TYPES[:3]:
+                raise UpdateError(dns_header.Rcode.FORMAT_ERROR)
+
+        elif rr_class == resource_record.RrClass.NONE.value:
+            if ttl != 0 or rr_type in META_TYPES:
+                raise UpdateError(dns_header.Rcode.FORMAT_ERROR)
+
+            value = wire_to_value(rr_type, message, offset, length)
+
+        else:
+            raise UpdateError(dns_header.Rcode.FORMAT_ERROR)
+
+        checked.append((name, rr_type, rr_class, ttl, value))
+
+    return checked
+
+
+def _apply(change: 'ZoneUpdate', updates: 'list[tuple]') -> None:
+    """RFC 2136 section 3.4.2
+    """
+
+    for name, rr_type, rr_class, ttl, value in updates:
+        if rr_class == resource_record.RrClass.IN.value:
+            change.add(name, rr_type, ttl, value)
+
+        elif rr_class == resource_record.RrClass.ANY.value:
+            if rr_type == resource_record.RrType.ANY.value:
+                change.delete_name(name)
+            else:
+                change.delete_rrset(name, rr_type)
+
+        else:
+            change.delete_value(name, rr_type, value)
+
+
+def _response(query: bytearray, zone_end: int, rcode: 'dns_header.Rcode') -> bytes:
+    """The header and zone section of the query, everything else is left out
+    """
+
+    head = dns_header.DnsHeaderSection(bytearray(query[:12]))
+    head.query_or_response = dns_header.QueryOrResponse.RESPONSE
+    head.response_code = rcode
+    head.answer_count = 0
+    head.name_server_count = 0
+    head.additional_record_count = 0
+
+    if zone_end is None:
+        head.question_count = 0
+        return bytes(head.bytes)
+
+    return bytes(head.bytes) + bytes(query[12:zone_end])
+
+
+def _record_fields(record: bytes) -> 'tuple[str, int, int, bytes]':
+    """Owner, type value, TTL and stored value of an encoded record
+    """
+
+    name, offset = util.read_name(record, 0)
+    rr_type = int.from_bytes(record[offset:offset+2], "big")
+    ttl = int.from_bytes(record[offset+4:offset+8], "big")
+    value = wire_to_value(rr_type, record, offset + 10, len(record) - offset - 10)
+
+    return zone.normalize(name), rr_type, ttl, value
+
+
+def apply_delta(store: 'zone.ZoneStore', apex: str, delta: 'journal.Delta') -> 'set[str]':
+    """Replay a journal.Delta on a store whose serial is delta.old_serial.
+    Returns the names that changed
+    """
+
+    change = ZoneUpdate(store, apex)
+
+    for record in delta.deleted:
+        name, rr_type, _, value = _record_fields(record)
+        change.delete_value(name, rr_type, value)
+
+    for record in delta.added:
+        change.add(*_record_fields(record))
+
+    _, _, ttl, value = _record_fields(delta.new_soa)
+    change.set_soa(ttl, value)
+
+    return change.commit()[1]
+
+
+def snapshot(store: 'zone.ZoneStore', apex: str) -> 'journal.Delta':
+    """Every record of a zone as a snapshot journal.Delta, see journal.py
+    """
+
+    records = [record for record_set in store.zone_rrsets(apex) for record in record_set.records]
+
+    return journal.Delta(b"", store.get(apex, resource_record.RrType.SOA).records[0], [], records)
+
+
+def apply_snapshot(store: 'zone.ZoneStore', apex: str, delta: 'journal.Delta') -> None:
+    """Replace every RRset of a zone with those of a snapshot. Records
+    the zone files gave a weight keep it
+    """
+
+    weights: 'dict[tuple[str, int], dict[bytes, int]]' = {}
+
+    for record_set in list(store.zone_rrsets(apex)):
+        weights[(record_set.name, record_set.rr_type.value)] = dict(zip(record_set.values, record_set.weights))
+        store.remove(record_set.name, record_set.rr_type)
+
+    # (name, type value) -> [ttl, values]
+    pending: 'dict[tuple[str, int], list]' = {}
+
+    for record in delta.added + [delta.new_soa]:
+        name, rr_type, ttl, value = _record_fields(record)
+        pending.setdefault((name, rr_type), [ttl, []])[1].append(value)
+
+    for key, (ttl, values) in pending.items():
+        old_weights = weights.get(key, {})
+        store.add(rrset.RRset(key[0], resource_record.RrType(key[1]), ttl, values, [old_weights.get(value, 1) for value in values]))
+
+
+def handle(message: bytearray, addr, view: 'views.View', allowed: 'tuple[str, ...]') -> bytes:
+    """Process one UPDATE message against a view and build its response
+    """
+
+    zone_end = None
+
+    try:
+        req_head = dns_header.DnsHeaderSection(message[:12])
+
+        if req_head.question_count != 1:
+            raise UpdateError(dns_header.Rcode.FORMAT_ERROR)
+
+        zone_name, offset = util.read_name(message, 12)
+        zone_type = int.from_bytes(message[offset:offset+2], "big")
+        zone_end = offset + 4
+
+        if zone_end > len(message) or zone_type != resource_record.RrType.SOA.value:
+            zone_end = None
+            raise UpdateError(dns_header.Rcode.FORMAT_ERROR)
+
+        if not allowed or not xfr.transfer_allowed(addr[0], allowed):
+            raise UpdateError(dns_header.Rcode.REFUSED)
+
+        apex = zone.normalize(zone_name)
+        store = view.zone_store
+
+        if store.get(apex, resource_record.RrType.SOA) is None:
+            raise UpdateError(dns_header.Rcode.NOT_AUTHORITATIVE)
+
+        prerequisites, offset = _read_records(message, zone_end, req_head.answer_count)
+        updates, offset = _read_records(message, offset, req_head.name_server_count)
+
+        change = ZoneUpdate(store, apex)
+
+        _check_prerequisites(message, prerequisites, change, apex)
+        _apply(change, _prescan(message, updates, apex))
+
+        delta, rebuilt = change.prepare()
+
+    except UpdateError as error:
+        return _response(message, zone_end, error.rcode)
+
+    except (IndexError, ValueError, UnicodeDecodeError):
+        return _response(message, zone_end, dns_header.Rcode.FORMAT_ERROR)
+
+    # Journaled before it is applied, an update the journal does not hold
+    # would be served now and gone after a restart
+
+    if delta is not None:
+        try:
+            store.journal.append(apex, delta)
+        except OSError as error:
+            print("Journal write failed: {}".format(error))
+            return _response(message, zone_end, dns_header.Rcode.SERVER_FAILURE)
+
+    changed_names = change.apply(rebuilt)
+
+    # Only responses for the names that changed are dropped, negative
+    # answers included, and those carrying their addresses as additional
+    # records. Every other cached response stays valid
+
+    for name in changed_names:
+        view.response_cache.invalidate(name)
+
+        for owner in store.referrers(name):
+            view.response_cache.invalidate(owner)
+
+    return _response(message, zone_end, dns_header.Rcode.NO_ERROR_CONDITION)
@@ -0,0 +1,162 @@
+import ipaddress
+import json
+import os
+import socket
+import threading
+
+# Restarts without dropping queries.
+
+# The running server listens on upgrade_socket. A new server started with
+# --upgrade connects to it and receives every listening socket, UDP, TCP,
+# DoT and DoH, as file descriptors (SCM_RIGHTS), with a manifest saying
+# what each one is:
+
+# [["udp", "0.0.0.0", 53], ["tcp", "0.0.0.0", 53], ["dot", "::", 853]]
+
+# Both processes now read the same sockets, so nothing is queued on a
+# socket nobody reads. The new server loads its zones and fills its
+# caches, then sends "ready". Only then does the old server stop reading,
+# finish the TCP and TLS connections it has (see hamurai.py) and exit.
+# If the new server dies before it is ready the old one keeps serving.
+
+# https://man7.org/linux/man-pages/man7/unix.7.html
+
+# Most sockets passed in one message, SCM_MAX_FD on Linux
+MAX_SOCKETS = 253
+
+MAX_MANIFEST = 65536
+
+READY = b"ready"
+
+
+def endpoint_key(kind: str, host: str, port: int) -> 'tuple[str, str, int]':
+    """How a listening socket is matched between the old and new server.
+    Ex: ('udp', '::', 53)
+    """
+
+    try:
+        host = ipaddress.ip_address(host.partition("%")[0]).compressed
+    except ValueError:
+        pass
+
+    return kind, host, port
+
+
+def take_over(path: str, timeout: float = 10.0) -> 'tuple[dict[tuple[str, str, int], socket.socket], socket.socket]':
+    """Receive the listening sockets of the server serving path. Raises
+    ConnectionError, with every received socket closed, unless the handoff
+    holds one socket per manifest entry.
+
+    Returns:
+        tuple[dict, socket.socket]: Sockets by endpoint_key, and the
+        connection to send READY on with report_ready
+    """
+
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    connection.settimeout(timeout)
+
+    try:
+        connection.connect(path)
+        manifest, fds, flags, _ = socket.recv_fds(connection, MAX_MANIFEST, MAX_SOCKETS)
+    except OSError:
+        connection.close()
+        raise
+
+    # With the manifest or the descriptors cut short, or not one descriptor
+    # per entry, sockets would be matched to the wrong endpoints. Closing
+    # the connection tells the old server to keep serving
+
+    try:
+        if flags & (socket.MSG_TRUNC | socket.MSG_CTRUNC):
+            raise ConnectionError("Handoff message truncated, {} descriptors received".format(len(fds)))
+
+        try:
+            endpoints = json.loads(manifest)
+        except ValueError:
+            raise ConnectionError("Handoff manifest is not JSON")
+
+        if len(fds) != len(endpoints):
+            raise ConnectionError("Handoff manifest lists {} sockets, {} descriptors received".format(
+                len(endpoints), len(fds)))
+    except ConnectionError:
+        for fd in fds:
+            os.close(fd)
+
+        connection.close()
+        raise
+
+    connection.settimeout(None)
+
+    sockets = {}
+
+    for (kind, host, port), fd in zip(endpoints, fds):
+        sockets[endpoint_key(kind, host, port)] = socket.socket(fileno=fd)
+
+    return sockets, connection
+
+
+def report_ready(connection: 'socket.socket') -> None:
+    try:
+        connection.send(READY)
+    except OSError:
+        pass
+
+    connection.close()
+
+
+class HandoffListener:
+    def __init__(self, path: str, sockets: 'list[tuple[str, socket.socket]]', on_ready):
+        """Hands sockets over to the next server from a thread of its own.
+
+        Args:
+            path (str): Filesystem path of the Unix socket, replaced if it exists
+            sockets (list[tuple[str, socket.socket]]): (kind, socket) of every listening socket
+            on_ready: Called without arguments once a new server is ready
+        """
+
+        self._sockets = sockets
+        self._on_ready = on_ready
+
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self._listener.bind(path)
+        self._listener.listen(1)
+
+        self._thread = threading.Thread(target=self._serve, name="upgrade-handoff", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def _manifest(self) -> bytes:
+        return json.dumps([
+            [kind, *sock.getsockname()[:2]] for kind, sock in self._sockets
+        ]).encode()
+
+    def _serve(self) -> None:
+        while True:
+            connection, _ = self._listener.accept()
+
+            with connection:
+                try:
+                    socket.send_fds(connection, [self._manifest()], [sock.fileno() for _, sock in self._sockets])
+
+                    # Loading zones can take a while, a closed connection means the new server failed
+
+                    ready = connection.recv(16) == READY
+                except OSError:
+                    ready = False
+
+            if ready:
+                print("Upgrade ready, handing over to the new server")
+
+                # The path now belongs to the new server, only the socket is closed
+
+                self._listener.close()
+                self._on_ready()
+                return
+
+            print("Upgrade abandoned by the new server, still serving")
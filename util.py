@@ -1,3 +1,8 @@
+# Print every label generated by domain_to_label, set from the server configuration
+
+debug_labels = True
+
+
 def create_ipv4_address_rdata(octet_array: [int]) -> bytearray:
     return bytearray(octet_array)
 
@@ -11,6 +16,56 @@ def domain_to_label(domain_name: str) -> bytearray:
 
     labels += bytearray(b'\0')
 
-    print("GENERATED LABEL:", labels.hex())
+    if debug_labels:
+        print("GENERATED LABEL:", labels.hex())
 
     return labels
+
+
+def label_length(data: bytes, offset: int = 0) -> int:
+    """Length in octets of the uncompressed domain name starting at offset,
+    terminating zero octet included
+    """
+
+    start = offset
+
+    while data[offset] != 0:
+        offset += data[offset] + 1
+
+    return offset + 1 - start
+
+
+def read_name(data: bytes, offset: int) -> 'tuple[str, int]':
+    """Decode the possibly compressed domain name at offset.
+    Returns the name and the offset right after it in the message
+    """
+
+    labels = []
+    end = None
+    jumps = 0
+
+    while True:
+        label_length = data[offset]
+
+        if label_length & 0b11000000 == 0b11000000:
+
+            # Pointer to a prior occurrence of the rest of the name
+
+            if end is None:
+                end = offset + 2
+
+            jumps += 1
+
+            if jumps > 64:
+                raise ValueError("Compression pointer loop")
+
+            offset = int.from_bytes(data[offset:offset+2], "big") & 0b0011111111111111
+            continue
+
+        if label_length == 0:
+            break
+
+        labels.append(bytes(data[offset+1:offset+1+label_length]).decode())
+        offset += label_length + 1
+
+    return ".".join(labels), end if end is not None else offset + 1
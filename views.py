@@ -0,0 +1,333 @@
+import array
+import bisect
+import ipaddress
+import socket
+import sys
+import time
+
+import response_cache
+import zone
+
+# Answer views. Clients are mapped to a view by their source address, or by
+# the EDNS client subnet when the query carries one, and the view decides
+# which zone store and which response cache answer the query.
+
+# CIDR prefixes are flattened into a sorted table of non overlapping
+# intervals, one table per address family. Every interval start is an
+# integer and the view index for the interval sits at the same position in
+# a second array, so a lookup is one bisect over packed integers. Nested
+# prefixes are resolved at build time, the most specific prefix wins.
+
+# Bisecting a packed array boxes an integer per comparison, so the top 16
+# bits of the address first pick a bucket of the table and the bisect only
+# runs inside that bucket.
+
+#  10.0.0.0/8 -> a,  10.1.0.0/16 -> b
+#
+#  starts:  10.0.0.0   10.1.0.0   10.2.0.0   11.0.0.0
+#  views:   a          b          a          (none)
+
+NO_VIEW = -1
+
+BUCKET_BITS = 16
+
+
+def _bucket_index(starts, shift: int) -> 'array.array':
+    """For every value of the top BUCKET_BITS bits, the position of the first
+    interval starting at or after that value. One extra entry closes the last bucket.
+    """
+
+    index = array.array("I", [0] * ((1 << BUCKET_BITS) + 1))
+    position = 0
+
+    for bucket in range(1 << BUCKET_BITS):
+        while position < len(starts) and starts[position] >> shift < bucket:
+            position += 1
+        index[bucket] = position
+
+    index[1 << BUCKET_BITS] = len(starts)
+
+    return index
+
+
+def _flatten(prefixes: 'list[tuple[int, int, int]]') -> 'tuple[list[int], list[int]]':
+    """Turn (first address, last address, view index) ranges into interval starts and views
+    """
+
+    starts: 'list[int]' = []
+    values: 'list[int]' = []
+
+    def emit(position: int, value: int) -> None:
+        if starts and starts[-1] == position:
+            values[-1] = value
+        elif not values or values[-1] != value:
+            starts.append(position)
+            values.append(value)
+
+    # Wider prefixes sort before the prefixes nested inside them
+
+    stack: 'list[tuple[int, int]]' = []
+
+    for first, last, value in sorted(prefixes, key=lambda prefix: (prefix[0], -prefix[1])):
+        while stack and stack[-1][0] < first:
+            end, _ = stack.pop()
+            emit(end + 1, stack[-1][1] if stack else NO_VIEW)
+
+        emit(first, value)
+        stack.append((last, value))
+
+    while stack:
+        end, _ = stack.pop()
+        emit(end + 1, stack[-1][1] if stack else NO_VIEW)
+
+    return starts, values
+
+
+class PrefixTable:
+    def __init__(self):
+        self._v4_starts = array.array("I")
+        self._v4_views = array.array("i")
+        self._v4_buckets = _bucket_index(self._v4_starts, 32 - BUCKET_BITS)
+        self._v6_starts: 'list[int]' = []
+        self._v6_views = array.array("i")
+        self._v6_buckets = _bucket_index(self._v6_starts, 128 - BUCKET_BITS)
+
+    def build(self, prefixes: 'list[tuple[str, int]]') -> None:
+        """Replace the table.
+
+        Args:
+            prefixes (list[tuple[str, int]]): (CIDR, view index) pairs. Ex: [('10.0.0.0/8', 1)]
+        """
+
+        v4: 'list[tuple[int, int, int]]' = []
+        v6: 'list[tuple[int, int, int]]' = []
+
+        # inet_pton is an order of magnitude faster than ipaddress.ip_network
+        # which matters with a million prefixes
+
+        for cidr, value in prefixes:
+            address, _, length = cidr.partition("/")
+
+            if ":" in address:
+                bucket, bits = v6, 128
+                first = int.from_bytes(socket.inet_pton(socket.AF_INET6, address), "big")
+            else:
+                bucket, bits = v4, 32
+                first = int.from_bytes(socket.inet_aton(address), "big")
+
+            host_bits = bits - int(length) if length else 0
+
+            if not 0 <= host_bits <= bits:
+                raise ValueError("Invalid prefix {}".format(cidr))
+
+            first = first >> host_bits << host_bits
+            bucket.append((first, first | ((1 << host_bits) - 1), value))
+
+        v4_starts, v4_views = _flatten(v4)
+        v6_starts, v6_views = _flatten(v6)
+
+        # The end of the last /0 lands one past the address space
+        # which does not fit in 32 bits and is never looked up
+
+        if v4_starts and v4_starts[-1] > 0xFFFFFFFF:
+            v4_starts.pop()
+            v4_views.pop()
+
+        self._v4_starts = array.array("I", v4_starts)
+        self._v4_views = array.array("i", v4_views)
+        self._v6_starts = v6_starts
+        self._v6_views = array.array("i", v6_views)
+        self._v4_buckets = _bucket_index(self._v4_starts, 32 - BUCKET_BITS)
+        self._v6_buckets = _bucket_index(self._v6_starts, 128 - BUCKET_BITS)
+
+    def lookup_v4(self, address: int) -> int:
+        bucket = address >> (32 - BUCKET_BITS)
+        index = bisect.bisect_right(
+            self._v4_starts, address, self._v4_buckets[bucket], self._v4_buckets[bucket + 1]) - 1
+        return self._v4_views[index] if index >= 0 else NO_VIEW
+
+    def lookup_v6(self, address: int) -> int:
+        bucket = address >> (128 - BUCKET_BITS)
+        index = bisect.bisect_right(
+            self._v6_starts, address, self._v6_buckets[bucket], self._v6_buckets[bucket + 1]) - 1
+        return self._v6_views[index] if index >= 0 else NO_VIEW
+
+    def lookup(self, address: str) -> int:
+        """View index for a textual address, NO_VIEW when no prefix covers it
+        """
+
+        if ":" not in address:
+            return self.lookup_v4(int.from_bytes(socket.inet_aton(address), "big"))
+
+        # Dual stack sockets report IPv4 clients as ::ffff:a.b.c.d
+
+        if address.startswith("::ffff:") and "." in address:
+            return self.lookup_v4(int.from_bytes(socket.inet_aton(address[7:]), "big"))
+
+        return self.lookup_v6(int.from_bytes(socket.inet_pton(socket.AF_INET6, address.split("%", 1)[0]), "big"))
+
+    def lookup_network(self, network: 'ipaddress._BaseNetwork') -> int:
+        if network.version == 4:
+            return self.lookup_v4(int(network.network_address))
+        return self.lookup_v6(int(network.network_address))
+
+    def scope(self, network: 'ipaddress._BaseNetwork') -> int:
+        """Shortest prefix length around the address of network whose whole
+        block maps to one view, the SCOPE PREFIX-LENGTH of RFC 7871
+        """
+
+        if network.version == 4:
+            starts, bits = self._v4_starts, 32
+        else:
+            starts, bits = self._v6_starts, 128
+
+        address = int(network.network_address)
+        position = bisect.bisect_right(starts, address) - 1
+
+        # Intervals of one view are merged, so the interval holding the
+        # address is every address answered the same way around it
+
+        first = starts[position] if position >= 0 else 0
+        last = starts[position + 1] - 1 if position + 1 < len(starts) else (1 << bits) - 1
+
+        for length in range(bits + 1):
+            host_bits = bits - length
+            block = address >> host_bits << host_bits
+
+            if block >= first and block | ((1 << host_bits) - 1) <= last:
+                return length
+
+        return bits
+
+    def __len__(self) -> int:
+        return len(self._v4_starts) + len(self._v6_starts)
+
+
+class View:
+    def __init__(self, name: str, zone_store: 'zone.ZoneStore' = None, cache: 'response_cache.ResponseTemplateCache' = None):
+        self.name = name
+        self.zone_store = zone_store if zone_store is not None else zone.ZoneStore()
+        self.response_cache = cache if cache is not None else response_cache.ResponseTemplateCache()
+
+        # dnssec.Signer for the signed zones of this view, None answers everything unsigned
+        self.signer = None
+
+
+class ViewTable:
+    def __init__(self, default_view: 'View'):
+        """Maps client addresses to views. Clients outside every prefix get default_view.
+        """
+
+        self._views: 'list[View]' = [default_view]
+        self._default_view = default_view
+        self._prefixes: 'list[tuple[str, int]]' = []
+        self._table = PrefixTable()
+
+    @property
+    def default_view(self) -> 'View':
+        return self._default_view
+
+    @property
+    def views(self) -> 'list[View]':
+        return self._views
+
+    def add_view(self, view: 'View') -> None:
+        self._views.append(view)
+
+    def view(self, name: str) -> 'View':
+        for view in self._views:
+            if view.name == name:
+                return view
+
+        raise KeyError("Unknown view {}".format(name))
+
+    def set_prefixes(self, prefixes: 'list[tuple[str, str]]') -> None:
+        """Replace every prefix mapping.
+
+        Args:
+            prefixes (list[tuple[str, str]]): (CIDR, view name) pairs. Ex: [('2001:db8::/32', 'lab')]
+        """
+
+        index_by_name = {view.name: index for index, view in enumerate(self._views)}
+
+        self._prefixes = []
+
+        for cidr, name in prefixes:
+            if name not in index_by_name:
+                raise KeyError("Unknown view {}".format(name))
+            self._prefixes.append((cidr, index_by_name[name]))
+
+        self._table.build(self._prefixes)
+
+    def load_prefixes(self, path: str) -> None:
+        """Load "CIDR VIEW_NAME" lines, lines starting with # are ignored
+        """
+
+        prefixes = []
+
+        with open(path, "r") as prefix_file:
+            for line in prefix_file:
+                fields = line.split("#", 1)[0].split()
+                if fields:
+                    prefixes.append((fields[0], fields[1]))
+
+        self.set_prefixes(prefixes)
+
+    def select(self, address: str, client_subnet: 'ipaddress._BaseNetwork' = None) -> 'View':
+        if client_subnet is not None:
+            index = self._table.lookup_network(client_subnet)
+        else:
+            index = self._table.lookup(address)
+
+        return self._default_view if index == NO_VIEW else self._views[index]
+
+    def scope(self, client_subnet: 'ipaddress._BaseNetwork') -> int:
+        return self._table.scope(client_subnet)
+
+
+if __name__ == "__main__":
+
+    # Prefix lookup benchmark. Usage: python views.py [PREFIX_COUNT]
+
+    import random
+
+    prefix_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+
+    random.seed(53)
+
+    prefixes = []
+
+    for i in range(prefix_count):
+        if i % 4:
+            length = random.randint(8, 32)
+            address = random.getrandbits(32) >> (32 - length) << (32 - length)
+            prefixes.append(("{}/{}".format(ipaddress.IPv4Address(address), length), i % 16))
+        else:
+            length = random.randint(16, 64)
+            address = random.getrandbits(128) >> (128 - length) << (128 - length)
+            prefixes.append(("{}/{}".format(ipaddress.IPv6Address(address), length), i % 16))
+
+    table = PrefixTable()
+
+    start = time.perf_counter()
+    table.build(prefixes)
+    build_seconds = time.perf_counter() - start
+
+    v4_queries = [str(ipaddress.IPv4Address(random.getrandbits(32))) for _ in range(200000)]
+    v6_queries = [str(ipaddress.IPv6Address(random.getrandbits(128))) for _ in range(200000)]
+
+    start = time.perf_counter()
+    for address in v4_queries:
+        table.lookup(address)
+    v4_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for address in v6_queries:
+        table.lookup(address)
+    v6_seconds = time.perf_counter() - start
+
+    print("prefixes:      {}".format(prefix_count))
+    print("intervals:     {}".format(len(table)))
+    print("build:         {:.3f} s".format(build_seconds))
+    print("ipv4 lookup:   {:.2f} us".format(v4_seconds / len(v4_queries) * 1e6))
+    print("ipv6 lookup:   {:.2f} us".format(v6_seconds / len(v6_queries) * 1e6))
@@ -0,0 +1,258 @@
+import ipaddress
+
+import dns_header
+import edns
+import journal
+import resource_record
+import util
+import zone
+
+# AXFR and IXFR zone transfers over TCP.
+
+# https://datatracker.ietf.org/doc/html/rfc5936
+# https://datatracker.ietf.org/doc/html/rfc1995
+
+# A transfer is a generator of messages. Records are read one RRset at a
+# time straight from the zone store and packed into messages of up to
+# 64 KB, so memory use does not depend on the size of the zone and the
+# socket always has a full message to write. Owner names are compressed
+# against every name already written to the same message.
+
+# Largest DNS message that fits the two octet TCP length prefix
+MAX_MESSAGE_SIZE = 65535
+
+# Compression pointers only reach the first 16 KB of a message
+MAX_POINTER_OFFSET = 0x3FFF
+
+
+class CompressedMessage:
+    def __init__(self, transaction_id: int, question_wire: bytes = None, limit: int = MAX_MESSAGE_SIZE):
+        """A response message that owner names are compressed into.
+
+        Args:
+            transaction_id (int): ID copied from the query
+            question_wire (bytes): The question to echo, only the first message of a transfer has one
+            limit (int): Largest message size in octets
+        """
+
+        self._transaction_id = transaction_id
+        self._limit = limit
+        self._data = bytearray(12)
+        self._answer_count = 0
+
+        # Lowercased name suffix in wire format -> offset in the message
+        self._suffixes: 'dict[bytes, int]' = {}
+
+        if question_wire is not None:
+            self._remember_name(bytes(question_wire), 12)
+            self._data += question_wire
+
+        self._question_count = 1 if question_wire is not None else 0
+
+    def _remember_name(self, name_wire: bytes, offset: int) -> None:
+        position = 0
+
+        while name_wire[position] != 0 and offset + position <= MAX_POINTER_OFFSET:
+            self._suffixes.setdefault(name_wire[position:].lower(), offset + position)
+            position += name_wire[position] + 1
+
+    def _compress(self, name_wire: bytes) -> bytes:
+        position = 0
+
+        while name_wire[position] != 0:
+            pointer = self._suffixes.get(name_wire[position:].lower())
+
+            if pointer is not None:
+                return name_wire[:position] + (0b1100000000000000 | pointer).to_bytes(2, "big")
+
+            position += name_wire[position] + 1
+
+        return name_wire
+
+    def add(self, record: bytes) -> bool:
+        """Append an encoded ResourceRecord. Returns False when it does not fit
+        """
+
+        owner_length = util.label_length(record)
+        owner = record[:owner_length]
+        compressed = self._compress(owner)
+
+        if len(self._data) + len(compressed) + len(record) - owner_length > self._limit:
+            return False
+
+        self._remember_name(owner, len(self._data))
+        self._data += compressed
+        self._data += record[owner_length:]
+        self._answer_count += 1
+
+        return True
+
+    def __len__(self) -> int:
+        return self._answer_count
+
+    @property
+    def bytes(self) -> bytearray:
+        head = dns_header.DnsHeaderSection(self._data[:12])
+        head.transaction_id = self._transaction_id
+        head.query_or_response = dns_header.QueryOrResponse.RESPONSE
+        head.authoritative_answer = True
+        head.question_count = self._question_count
+        head.answer_count = self._answer_count
+        self._data[:12] = head.bytes
+
+        return self._data
+
+
+def pack_messages(transaction_id: int, question_wire: bytes, records):
+    """Yield messages holding every record from the records iterable, in order
+    """
+
+    message = CompressedMessage(transaction_id, question_wire)
+
+    for record in records:
+        if message.add(record):
+            continue
+
+        if not len(message):
+            raise ValueError("Record larger than a single message")
+
+        yield bytes(message.bytes)
+
+        message = CompressedMessage(transaction_id)
+
+        if not message.add(record):
+            raise ValueError("Record larger than a single message")
+
+    yield bytes(message.bytes)
+
+
+def axfr_records(store: 'zone.ZoneStore', apex: str):
+    """The SOA, every other record of the zone, and the SOA again
+    """
+
+    soa = store.get(apex, resource_record.RrType.SOA).records[0]
+
+    yield soa
+
+    for record_set in store.zone_rrsets(apex):
+        yield from record_set.records
+
+    yield soa
+
+
+def ixfr_records(store: 'zone.ZoneStore', apex: str, client_serial: int):
+    """The incremental answer from client_serial, None when the journal can not provide it
+    """
+
+    soa = store.get(apex, resource_record.RrType.SOA).records[0]
+
+    if store.serial(apex) == client_serial:
+        return iter([soa])
+
+    deltas = store.journal.deltas_since(apex, client_serial)
+
+    # Deltas left over from before the zone file was edited do not end at the current serial
+
+    if not deltas or deltas[-1].new_serial != store.serial(apex):
+        return None
+
+    def records():
+        yield soa
+
+        for delta in deltas:
+            yield delta.old_soa
+            yield from delta.deleted
+            yield delta.new_soa
+            yield from delta.added
+
+        yield soa
+
+    return records()
+
+
+def _client_serial(query: bytearray, offset: int, authority_count: int) -> int:
+    """SERIAL of the SOA a client puts in the authority section of an IXFR query
+    """
+
+    for _ in range(authority_count):
+        offset = edns.skip_name(query, offset)
+        rr_type = int.from_bytes(query[offset:offset+2], "big")
+        rdata_length = int.from_bytes(query[offset+8:offset+10], "big")
+        offset += 10
+
+        if rr_type == resource_record.RrType.SOA.value:
+            rdata_offset = edns.skip_name(query, offset)
+            rdata_offset = edns.skip_name(query, rdata_offset)
+            return int.from_bytes(query[rdata_offset:rdata_offset+4], "big")
+
+        offset += rdata_length
+
+    return None
+
+
+def _error(transaction_id: int, question_wire: bytes, rcode: 'dns_header.Rcode') -> bytes:
+    head = dns_header.DnsHeaderSection(bytearray(12))
+    head.transaction_id = transaction_id
+    head.query_or_response = dns_header.QueryOrResponse.RESPONSE
+    head.question_count = 1
+    head.response_code = rcode
+
+    return bytes(head.bytes) + bytes(question_wire)
+
+
+def transfer_allowed(address: str, allowed: 'tuple[str, ...]') -> bool:
+    client = ipaddress.ip_address(address.split("%", 1)[0])
+
+    if client.version == 6 and client.ipv4_mapped is not None:
+        client = client.ipv4_mapped
+
+    return any(client in ipaddress.ip_network(prefix, strict=False) for prefix in allowed)
+
+
+def transfer(query: bytearray, addr, store: 'zone.ZoneStore', allowed: 'tuple[str, ...]'):
+    """Yield every response message for an AXFR or IXFR query
+    """
+
+    req_head = dns_header.DnsHeaderSection(query[:12])
+    question_end = 12 + util.label_length(query, 12) + 4
+    question_wire = bytes(query[12:question_end])
+    qname_length = question_end - 16
+    qtype = int.from_bytes(query[12+qname_length:14+qname_length], "big")
+    domain = ".".join(
+        label.decode() for label in _labels(question_wire)
+    )
+
+    if not transfer_allowed(addr[0], allowed):
+        yield _error(req_head.transaction_id, question_wire, dns_header.Rcode.REFUSED)
+        return
+
+    if store.get(domain, resource_record.RrType.SOA) is None:
+        yield _error(req_head.transaction_id, question_wire, dns_header.Rcode.NOT_AUTHORITATIVE)
+        return
+
+    apex = zone.normalize(domain)
+    records = None
+
+    if qtype == resource_record.RrType.IXFR.value:
+        client_serial = _client_serial(query, question_end, req_head.name_server_count)
+
+        if client_serial is not None:
+            records = ixfr_records(store, apex, client_serial)
+
+    # AXFR, or an IXFR the journal can not answer, which RFC 1995 answers with the full zone
+
+    if records is None:
+        records = axfr_records(store, apex)
+
+    yield from pack_messages(req_head.transaction_id, question_wire, records)
+
+
+def _labels(name_wire: bytes) -> 'list[bytes]':
+    labels = []
+    position = 0
+
+    while name_wire[position] != 0:
+        labels.append(name_wire[position+1:position+1+name_wire[position]])
+        position += name_wire[position] + 1
+
+    return labels
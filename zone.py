@@ -0,0 +1,380 @@
+import shlex
+
+import journal
+import resource_record
+import rrset
+import util
+
+# In memory record store. RRsets are indexed by (owner name, type) so the
+# packet loop does one dict lookup per question.
+
+# Zone files use a subset of the RFC 1035 master file format, one record
+# per line with absolute owner names and an explicit TTL and class:
+
+# www.ricklantis.com.   10  IN  A     147.182.185.61
+# www.ricklantis.com.   10  IN  A     147.182.185.62   ; comments are ignored
+
+# A comment holding weight=N sets how often that record leads the answers
+# of its RRset, see rrset.py. Records without one weigh 1:
+
+# www.ricklantis.com.   10  IN  A     147.182.185.63   ; weight=3
+
+# https://datatracker.ietf.org/doc/html/rfc1035#section-5.1
+
+# Types with more than one field are encoded to wire format while loading:
+
+# ricklantis.com.       3600 IN  SOA   ns1.ricklantis.com. admin.ricklantis.com. 2023101401 7200 900 1209600 300
+# ricklantis.com.       3600 IN  MX    10 mail.ricklantis.com.
+# ricklantis.com.       3600 IN  TXT   "v=spf1 -all"
+# _sip._udp.ricklantis.com. 60 IN SRV  10 5 5060 sip.ricklantis.com.
+
+# A name holding a SOA record is a zone apex, every name below it belongs
+# to that zone for transfers.
+
+# Answers naming other hosts carry the addresses the store holds for
+# them in the additional section, so resolvers need no follow up query:
+
+# ricklantis.com.       3600 IN  MX    10 mail.ricklantis.com.
+# mail.ricklantis.com.  3600 IN  A     147.182.185.70     <- additional
+
+# https://datatracker.ietf.org/doc/html/rfc1034#section-4.3.2
+
+# The additional section of every such RRset is encoded once, when the
+# zone loads, and again only after the addresses it holds change.
+
+
+def normalize(domain: str) -> str:
+    return domain.lower().rstrip(".")
+
+
+def _split_comment(line: str) -> 'tuple[str, str]':
+    in_quotes = False
+
+    for index, character in enumerate(line):
+        if character == '"':
+            in_quotes = not in_quotes
+        elif character == ";" and not in_quotes:
+            return line[:index], line[index+1:]
+
+    return line, ""
+
+
+def _weight(comment: str) -> int:
+    """The weight=N of a record comment, 1 without one
+    """
+
+    for field in comment.split():
+        if field.lower().startswith("weight="):
+            weight = int(field[len("weight="):])
+
+            if weight < 1:
+                raise ValueError("weights must be positive integers")
+
+            return weight
+
+    return 1
+
+
+def _name_wire(domain: str) -> bytes:
+    return bytes(util.domain_to_label(normalize(domain)))
+
+
+def _encode_soa(fields: 'list[str]') -> bytes:
+    mname, rname = fields[:2]
+    numbers = [int(field) for field in fields[2:7]]
+
+    if len(numbers) != 5:
+        raise ValueError("SOA needs MNAME RNAME SERIAL REFRESH RETRY EXPIRE MINIMUM")
+
+    return _name_wire(mname) + _name_wire(rname) + b"".join(number.to_bytes(4, "big") for number in numbers)
+
+
+def _encode_mx(fields: 'list[str]') -> bytes:
+    return int(fields[0]).to_bytes(2, "big") + _name_wire(fields[1])
+
+
+def _encode_txt(fields: 'list[str]') -> bytes:
+    data = b""
+
+    for text in fields:
+        text = text.encode()
+
+        # Every character string is at most 255 octets
+
+        for start in range(0, max(len(text), 1), 255):
+            chunk = text[start:start+255]
+            data += len(chunk).to_bytes(1, "big") + chunk
+
+    return data
+
+
+def _encode_srv(fields: 'list[str]') -> bytes:
+    priority, weight, port = (int(field) for field in fields[:3])
+
+    return priority.to_bytes(2, "big") + weight.to_bytes(2, "big") + port.to_bytes(2, "big") + _name_wire(fields[3])
+
+
+# Types whose records name a host, and the offset of that name in the
+# RDATA as stored. NS targets are stored as text, see rrset.RDATA_TYPES
+ADDITIONAL_TARGETS = {
+    resource_record.RrType.NS.value: None,
+    resource_record.RrType.MX.value: 2,
+    resource_record.RrType.SRV.value: 6,
+}
+
+ADDRESS_TYPES = (resource_record.RrType.A.value, resource_record.RrType.AAAA.value)
+
+
+def target_names(record_set: 'rrset.RRset') -> 'list[str]':
+    """Host names the records of an NS, MX or SRV RRset point at, in record order
+    """
+
+    offset = ADDITIONAL_TARGETS[record_set.rr_type.value]
+    names = []
+
+    for value in record_set.values:
+        name = normalize(value.decode()) if offset is None else util.read_name(value, offset)[0]
+
+        if name not in names:
+            names.append(name)
+
+    return names
+
+
+# Encoders from the master file text of a record to its RDATA
+RDATA_ENCODERS = {
+    resource_record.RrType.SOA: _encode_soa,
+    resource_record.RrType.MX: _encode_mx,
+    resource_record.RrType.TXT: _encode_txt,
+    resource_record.RrType.SRV: _encode_srv,
+}
+
+
+class ZoneStore:
+    def __init__(self):
+        self._rrsets: 'dict[tuple[str, int], rrset.RRset]' = {}
+
+        # Name -> values of every type it has an RRset of
+        self._names: 'dict[str, set[int]]' = {}
+        self._apexes: 'set[str]' = set()
+
+        # (owner, type value) -> (record count, encoded additional section)
+        self._additional: 'dict[tuple[str, int], tuple[int, bytes]]' = {}
+
+        # Target name -> keys of the additional sections holding its addresses
+        self._referrers: 'dict[str, set[tuple[str, int]]]' = {}
+
+        # Deltas between SOA serials, served to secondaries as IXFR
+        self.journal = journal.Journal()
+
+    def add(self, record_set: 'rrset.RRset') -> None:
+        self._rrsets[(record_set.name, record_set.rr_type.value)] = record_set
+        self._names.setdefault(record_set.name, set()).add(record_set.rr_type.value)
+
+        if record_set.rr_type == resource_record.RrType.SOA:
+            self._apexes.add(record_set.name)
+
+        self._changed(record_set.name, record_set.rr_type.value)
+
+    def remove(self, domain: str, rr_type: 'resource_record.RrType') -> 'rrset.RRset':
+        """Drop one RRset, returns it or None when it did not exist
+        """
+
+        name = normalize(domain)
+        record_set = self._rrsets.pop((name, rr_type.value), None)
+
+        if record_set is None:
+            return None
+
+        types = self._names[name]
+        types.discard(rr_type.value)
+
+        if not types:
+            del self._names[name]
+
+        if rr_type == resource_record.RrType.SOA:
+            self._apexes.discard(name)
+
+        self._changed(name, rr_type.value)
+
+        return record_set
+
+    def _changed(self, name: str, rr_type: int) -> None:
+        self._additional.pop((name, rr_type), None)
+
+        if rr_type in ADDRESS_TYPES:
+            for key in self._referrers.get(name, ()):
+                self._additional.pop(key, None)
+
+    def additional(self, record_set: 'rrset.RRset') -> 'tuple[int, bytes]':
+        """The additional section answers with record_set carry, the A and
+        AAAA records of every target the store holds. Returns (0, b'') for
+        types without targets
+        """
+
+        key = (record_set.name, record_set.rr_type.value)
+        section = self._additional.get(key)
+
+        if section is not None:
+            return section
+
+        if key[1] not in ADDITIONAL_TARGETS:
+            return 0, b""
+
+        records = []
+
+        for target in target_names(record_set):
+
+            # Remembered even while the target has no address, one added later refreshes the section
+
+            self._referrers.setdefault(target, set()).add(key)
+
+            for rr_type in ADDRESS_TYPES:
+                address_set = self._rrsets.get((target, rr_type))
+
+                if address_set is not None:
+                    records += address_set.records
+
+        section = (len(records), b"".join(records))
+        self._additional[key] = section
+
+        return section
+
+    def referrers(self, domain: str) -> 'set[str]':
+        """Owners of the RRsets whose additional section holds the addresses of domain
+        """
+
+        return {owner for owner, _ in self._referrers.get(normalize(domain), ())}
+
+    def any_answer(self, domain: str) -> 'rrset.RRset':
+        """The one RRset answering ANY at a name, the smallest, or None when
+        the name has none. RFC 8482 section 4.1
+        """
+
+        name = normalize(domain)
+        candidates = [self._rrsets[(name, rr_type)] for rr_type in sorted(self._names.get(name, ()))]
+
+        if not candidates:
+            return None
+
+        return min(candidates, key=lambda record_set: sum(len(record) for record in record_set.records))
+
+    def rrsets_at(self, domain: str) -> 'list[rrset.RRset]':
+        name = normalize(domain)
+
+        return [self._rrsets[(name, rr_type)] for rr_type in self._names.get(name, ())]
+
+    def get(self, domain: str, rr_type: 'resource_record.RrType') -> 'rrset.RRset':
+        return self._rrsets.get((normalize(domain), rr_type.value))
+
+    def has_name(self, domain: str) -> bool:
+        return normalize(domain) in self._names
+
+    def apex_of(self, domain: str) -> str:
+        """The closest enclosing zone apex of a name, None when no zone holds it
+        """
+
+        labels = normalize(domain).split(".")
+
+        for i in range(len(labels)):
+            candidate = ".".join(labels[i:])
+            if candidate in self._apexes:
+                return candidate
+
+        return None
+
+    def serial(self, apex: str) -> int:
+        soa = self.get(apex, resource_record.RrType.SOA)
+
+        return journal.soa_serial(soa.values[0]) if soa is not None else None
+
+    def zone_rrsets(self, apex: str):
+        """Yield every RRset of a zone except its SOA without copying the
+        RRsets. Names that belong to a deeper zone are left out. Only the keys
+        are snapshotted, so updates may run while a transfer is streaming.
+        """
+
+        apex = normalize(apex)
+        suffix = "." + apex
+
+        for name, rr_type in list(self._rrsets):
+            if rr_type == resource_record.RrType.SOA.value:
+                continue
+
+            if name == apex or (name.endswith(suffix) and self.apex_of(name) == apex):
+                record_set = self._rrsets.get((name, rr_type))
+
+                if record_set is not None:
+                    yield record_set
+
+    def __iter__(self):
+        return iter(self._rrsets.values())
+
+    def __len__(self) -> int:
+        return len(self._rrsets)
+
+    def load(self, path: str) -> None:
+        """Load a zone file, records of the same name and type become one RRset
+        """
+
+        # (name, type value) -> [type, ttl, [values], [weights]]
+        pending: 'dict[tuple[str, int], list]' = {}
+
+        with open(path, "r") as zone_file:
+            for line_number, line in enumerate(zone_file, 1):
+                line, comment = _split_comment(line)
+                line = line.strip()
+
+                if not line:
+                    continue
+
+                fields = line.split(None, 4)
+
+                if len(fields) < 5:
+                    raise ValueError("{}:{} expected NAME TTL CLASS TYPE RDATA".format(path, line_number))
+
+                name, ttl, rr_class, rr_type_name, value = fields
+
+                if rr_class.upper() != resource_record.RrClass.IN.name:
+                    raise ValueError("{}:{} only class IN is supported".format(path, line_number))
+
+                try:
+                    rr_type = resource_record.RrType[rr_type_name.upper()]
+                except KeyError:
+                    raise ValueError("{}:{} unknown type {}".format(path, line_number, rr_type_name))
+
+                if rr_type in RDATA_ENCODERS:
+                    try:
+                        encoded = RDATA_ENCODERS[rr_type](shlex.split(value))
+                    except (ValueError, IndexError) as error:
+                        raise ValueError("{}:{} invalid {} record: {}".format(
+                            path, line_number, rr_type.name, error))
+
+                elif rr_type in rrset.RDATA_TYPES:
+                    if rrset.RDATA_TYPES[rr_type].name == "DOMAIN":
+                        value = normalize(value)
+                    encoded = value.encode()
+
+                else:
+                    raise ValueError("{}:{} type {} is not supported in zone files".format(
+                        path, line_number, rr_type.name))
+
+                try:
+                    weight = _weight(comment)
+                except ValueError as error:
+                    raise ValueError("{}:{} invalid weight: {}".format(path, line_number, error))
+
+                key = (normalize(name), rr_type.value)
+
+                if key not in pending:
+                    pending[key] = [rr_type, int(ttl), [], []]
+
+                pending[key][2].append(encoded)
+                pending[key][3].append(weight)
+
+        for (name, _), (rr_type, ttl, values, weights) in pending.items():
+            self.add(rrset.RRset(name, rr_type, ttl, values, weights))
+
+        for (name, rr_type) in pending:
+            if rr_type in ADDITIONAL_TARGETS:
+                self.additional(self._rrsets[(name, rr_type)])